@@ -1,10 +1,12 @@
+import os
 from fastapi.security import HTTPBearer
 from auth.security.password_hasher import hash_password, verify_password
 from auth.security.jwt_handler import decode_access_token
 from users.schemas import User, UserCreate
 from users.models import Users
-from sqlalchemy.orm import Session
-from db.connection import get_db
+from users.users_dao import AsyncUserDAO
+from sqlalchemy.ext.asyncio import AsyncSession
+from db.connection import get_async_db
 from fastapi import HTTPException, status
 from fastapi import Depends
 
@@ -17,8 +19,8 @@ def confirm_password(password1 :str , password2 : str):
                 detail="Пароли не совпадают"
         )
     
-def check_email_not_exists(email : str, db : Session = Depends(get_db)):
-    user_with_email = db.query(Users).filter(Users.email == email).all()
+async def check_email_not_exists(email : str, db : AsyncSession = Depends(get_async_db)):
+    user_with_email = await AsyncUserDAO(db).get_by_email(email)
     if user_with_email:
         raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -29,7 +31,7 @@ security = HTTPBearer()
 
 async def get_current_user(
     credentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ) -> Users:
     
     try:
@@ -39,7 +41,7 @@ async def get_current_user(
         if user_data is None:
             raise HTTPException(status_code=401, detail="Invalid token")
 
-        user = db.query(Users).filter(Users.id == user_data["id"]).first()
+        user = await AsyncUserDAO(db).get_by_id(user_data["id"])
         
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
@@ -52,11 +54,30 @@ async def get_current_user(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# ID администраторов через запятую: служебная статистика и рекомендации для других пользователей
+ADMIN_USER_IDS = frozenset(
+    int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()
+)
+
+
+def is_admin(user : Users) -> bool:
+    return user.id in ADMIN_USER_IDS
+
+
+async def get_current_admin(current_user : Users = Depends(get_current_user)) -> Users:
+    if not is_admin(current_user):
+        raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="Недостаточно прав"
+        )
+    return current_user
+
+
 class UserService:
     @staticmethod
-    def register(user_data : UserCreate, db : Session = Depends(get_db)):
+    async def register(user_data : UserCreate, db : AsyncSession = Depends(get_async_db)):
         confirm_password(user_data.password, user_data.password)
-        check_email_not_exists(user_data.email, db)
+        await check_email_not_exists(user_data.email, db)
 
         new_user = Users(
             nickname = user_data.nickname,
@@ -65,13 +86,13 @@ class UserService:
         )
 
         db.add(new_user)
-        db.commit()
-        db.refresh(new_user)
+        await db.commit()
+        await db.refresh(new_user)
 
         return new_user
     
-    def verify_creditals(user_data : int, db : Session = Depends(get_db)):
-        user = db.query(Users).filter(Users.nickname == user_data.nickname).first()
+    async def verify_creditals(user_data : int, db : AsyncSession = Depends(get_async_db)):
+        user = await AsyncUserDAO(db).get_by_nickname(user_data.nickname)
         if not user or not verify_password(user_data.password, user.password_enc):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,8 +1,10 @@
 import os
 import logging
 from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy.pool import QueuePool
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from contextlib import contextmanager
 
 
@@ -34,6 +36,34 @@ SessionLocal = sessionmaker(
     expire_on_commit=False
 )
 
+# асинхронный драйвер для того же URL (postgresql -> asyncpg)
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def make_async_url(url: str) -> str:
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))\
+        .render_as_string(hide_password=False)
+
+
+async_db_url = os.getenv('ASYNC_DATABASE_URL') or make_async_url(db_url)
+
+# те же параметры пула, но с пулом для asyncio
+ASYNC_POOL_CONFIG = dict(POOL_CONFIG, poolclass=AsyncAdaptedQueuePool)
+
+async_db_engine = create_async_engine(async_db_url, **ASYNC_POOL_CONFIG)
+
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_db_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
+
+
 def init_db():
     logger.info('Создание таблиц БД')
     try:
@@ -61,4 +91,23 @@ def get_db():
 
     finally:
         session.close()
-        logger.debug(f'Сессия закрыта')
\ No newline at end of file
+        logger.debug(f'Сессия закрыта')
+
+
+async def get_async_db():
+    # для async-маршрутов: ожидание ответа БД не блокирует цикл событий
+    session = AsyncSessionLocal()
+
+    try:
+        yield session
+        await session.commit()
+        logger.info(f'Транзакция выполнена')
+
+    except Exception as e:
+        await session.rollback()
+        logger.error(f'Ошибка транзакции: {e}')
+        raise
+
+    finally:
+        await session.close()
+        logger.debug(f'Сессия закрыта')
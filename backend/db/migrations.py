@@ -0,0 +1,86 @@
+import logging
+from typing import Callable, List, Tuple
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from db.connection import db_engine
+from perfumes.perfumes_dao import PerfumeDAO
+from ratings.ratings_dao import RatingDAO
+
+logger = logging.getLogger(__name__)
+
+# Однократные изменения схемы, которых не делает create_all: триггеры, индексы на уже
+# существующих таблицах, чистка данных перед ними. Применённые записываются в schema_migrations.
+# В PostgreSQL запуск идёт под advisory-блокировкой: воркеры, стартующие одновременно,
+# ждут друг друга, и каждая миграция выполняется один раз
+MIGRATIONS_LOCK_ID = 7_316_204_118
+
+MIGRATIONS_TABLE = """
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        name VARCHAR(255) PRIMARY KEY,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+
+def _unique_ratings(db: Session):
+    # уникальный индекс оценок на таблице, созданной до него: дубли удаляются в транзакции,
+    # индекс строится после её фиксации (в PostgreSQL - CONCURRENTLY, вне транзакции)
+    dao = RatingDAO(db)
+    if dao.has_unique_ratings_index():
+        return
+    removed = dao.remove_duplicate_ratings()
+    db.commit()
+    if removed:
+        logger.info(f'Удалено повторных оценок: {removed}')
+    dao.create_unique_ratings_index()
+
+
+# (имя, функция(сессия)) - в порядке применения; запись о миграции фиксируется после функции
+MIGRATIONS: List[Tuple[str, Callable[[Session], object]]] = [
+    ('0001_catalog_version', lambda db: PerfumeDAO(db).ensure_catalog_version()),
+    ('0002_unique_ratings', _unique_ratings),
+    # DROP/CREATE TRIGGER берёт ACCESS EXCLUSIVE на журнал - однократно, а не при старте каждого воркера
+    ('0003_rating_change_notify', lambda db: RatingDAO(db).ensure_change_notify()),
+]
+
+
+def run_migrations(engine=db_engine) -> List[str]:
+    # применяет недостающие миграции, возвращает их имена
+    applied_now = []
+    with engine.connect() as connection:
+        postgres = connection.dialect.name == 'postgresql'
+        if postgres:
+            connection.execute(text('SELECT pg_advisory_lock(:lock_id)'), {'lock_id': MIGRATIONS_LOCK_ID})
+            connection.commit()
+
+        try:
+            # сессия на том же соединении, что держит блокировку
+            with Session(bind=connection) as db:
+                db.execute(text(MIGRATIONS_TABLE))
+                db.commit()
+                applied = set(db.scalars(text('SELECT name FROM schema_migrations')))
+
+                for name, migrate in MIGRATIONS:
+                    if name in applied:
+                        continue
+                    logger.info(f'Применение миграции {name}')
+                    try:
+                        migrate(db)
+                        db.execute(text('INSERT INTO schema_migrations (name) VALUES (:name)'), {'name': name})
+                        db.commit()
+                    except Exception:
+                        db.rollback()
+                        raise
+                    applied_now.append(name)
+        finally:
+            if postgres:
+                connection.execute(text('SELECT pg_advisory_unlock(:lock_id)'), {'lock_id': MIGRATIONS_LOCK_ID})
+                connection.commit()
+
+    return applied_now
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    logger.info(f'Применено миграций: {len(run_migrations())}')
@@ -1,17 +1,42 @@
 import logging
+from contextlib import asynccontextmanager
 from urllib.request import Request
-from db.connection import init_db, Base, db_engine
+from db.connection import init_db, Base, db_engine, async_db_engine
+from db.migrations import run_migrations
 from fastapi.openapi.utils import get_openapi
 from fastapi import FastAPI
 from perfumes.routes import perfumes_router
 from auth.routes import auth_router
 from ratings.routes import ratings_router
+from recommendations.routes import recommendations_router
+from services.recomendation_service.engine import RecommendationEngine
 from fastapi.middleware.cors import CORSMiddleware
 
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("Приложение запускается...")
+    init_db()
+    # триггеры, индексы на существующих таблицах - однократно, под блокировкой
+    applied = run_migrations()
+    if applied:
+        logger.info(f'Применены миграции: {", ".join(applied)}')
+
+    # движок рекомендаций общий для процесса: тёплый старт со снапшота, обновление в фоне
+    app.state.recommendation_engine = RecommendationEngine()
+    app.state.recommendation_engine.start()
+
+    yield
+
+    logger.info("Приложение останавливается...")
+    app.state.recommendation_engine.stop()
+    await async_db_engine.dispose()
+
+
 app = FastAPI(
     title="Perfume Recommendation System",
     version="1.0.0",
@@ -21,7 +46,8 @@ app = FastAPI(
         "defaultModelsExpandDepth": -1,
         "displayRequestDuration": True,
     },
-    security=[{"HTTPBearer": []}]
+    security=[{"HTTPBearer": []}],
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -43,11 +69,6 @@ async def log_headers(request: Request, call_next):
     print(f"Response Status: {response.status_code}")
     return response
 
-@app.on_event("startup")
-async def app_start():
-    logger.info("Приложение запускается...")
-    init_db()
-
 @app.get('/')
 async def root():
     return {'message' : 'Perfumes Recomendarion System'}
@@ -56,3 +77,4 @@ async def root():
 app.include_router(perfumes_router)
 app.include_router(auth_router)
 app.include_router(ratings_router)
+app.include_router(recommendations_router)
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Text, Date, ForeignKey
+from sqlalchemy import BigInteger, Column, Integer, String, Float, Text, Date, ForeignKey
 from sqlalchemy.orm import relationship
 from db.connection import Base
 
@@ -71,4 +71,10 @@ class PerfumeNotes(Base):
     note_type = relationship('NoteTypes', back_populates='perfume_note')
 
 
+class CatalogVersion(Base):
+    # Счётчик изменений каталога (одна строка, id = 1): увеличивается триггерами на таблицах
+    # каталога при любой записи, в том числе SQL в обход приложения. Читатели сравнивают одно число
+    __tablename__ = "catalog_version"
 
+    id = Column(Integer, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=0)
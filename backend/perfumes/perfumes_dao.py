@@ -1,51 +1,248 @@
-from typing import List, Optional
-from perfumes.schemas import Perfume
-from ratings.models import Ratings
-from sqlalchemy import Session
-from sqlalchemy import func, desc
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from perfumes.models import Brands, CatalogVersion, Concentration, Notes, NoteTypes, PerfumeNotes, Perfumes as Perfume
+from ratings.models import PerfumeRatingStats
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy import Select, desc, select, text
 
-class PerfumeDAO:
+# Таблицы, из которых собирается каталог: любая запись в них увеличивает catalog_version
+CATALOG_TABLES = ('perfumes', 'brands', 'concentration', 'notes', 'note_types', 'perfume_notes')
+
+CATALOG_VERSION_ROW = """
+    INSERT INTO catalog_version (id, version)
+    SELECT 1, 0 WHERE NOT EXISTS (SELECT 1 FROM catalog_version WHERE id = 1)
+"""
+
+# PostgreSQL: триггер на оператор (массовая загрузка - одно увеличение), включая TRUNCATE.
+# Строка счётчика одна - пишущие в каталог транзакции ждут друг друга, каталог меняется редко
+CATALOG_VERSION_FUNCTION = """
+    CREATE OR REPLACE FUNCTION bump_catalog_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+"""
+CATALOG_VERSION_POSTGRESQL_TRIGGER = (
+    'DROP TRIGGER IF EXISTS catalog_version_bump ON {table}',
+    """
+    CREATE TRIGGER catalog_version_bump AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table}
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_catalog_version()
+    """,
+)
+# SQLite: триггеры только на строку, по одному на событие
+CATALOG_VERSION_SQLITE_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS catalog_version_{table}_{event} AFTER {event} ON {table}
+    BEGIN
+        UPDATE catalog_version SET version = version + 1 WHERE id = 1;
+    END
+"""
+
+
+class _PerfumeQueries:
+    # запросы в стиле SQLAlchemy 2.0 - общие для синхронного DAO (фоновые потоки и процессы
+    # рекомендаций) и асинхронного (маршруты FastAPI)
+    @staticmethod
+    def _by_id_query(perfume_id: int) -> Select:
+        return select(Perfume).where(Perfume.id == perfume_id)
+
+    @staticmethod
+    def _all_query(limit: int) -> Select:
+        return select(Perfume).order_by(Perfume.id).limit(limit)
+
+    @staticmethod
+    def _page_query(after_id: Optional[int], limit: int) -> Select:
+        # страница каталога по ключу id > after_id: индексный поиск, стоимость не зависит от номера страницы.
+        # Бренд и концентрация - JOIN (одна строка на парфюм), ноты - отдельным запросом selectinload,
+        # оценки - агрегат из perfume_rating_stats вместо строк оценок
+        query = select(Perfume, PerfumeRatingStats.rating_count, PerfumeRatingStats.rating_mean)\
+            .outerjoin(PerfumeRatingStats, Perfume.id == PerfumeRatingStats.perfume_id)\
+            .options(
+                joinedload(Perfume.brand),
+                joinedload(Perfume.concentration),
+                selectinload(Perfume.perfume_note).joinedload(PerfumeNotes.note),
+                selectinload(Perfume.perfume_note).joinedload(PerfumeNotes.note_type)
+            )\
+            .order_by(Perfume.id)\
+            .limit(limit)
+        if after_id is not None:
+            query = query.where(Perfume.id > after_id)
+        return query
+
+    @staticmethod
+    def _feature_queries(
+        perfume_ids: Optional[Iterable[int]] = None,
+        after_id: Optional[int] = None
+    ) -> Tuple[Select, Select]:
+        perfumes = select(
+            Perfume.id,
+            Perfume.name,
+            Perfume.price,
+            Brands.name,
+            Concentration.concentration_title
+        ).join(Brands, Perfume.brand_id == Brands.id)\
+            .join(Concentration, Perfume.concentration_id == Concentration.id)
+        note_rows = select(
+            PerfumeNotes.perfume_id,
+            NoteTypes.note_type_data,
+            Notes.note_name
+        ).join(Notes, PerfumeNotes.note_id == Notes.id)\
+            .join(NoteTypes, PerfumeNotes.note_type_id == NoteTypes.id)
+
+        if perfume_ids is not None:
+            perfume_ids = list(perfume_ids)
+            perfumes = perfumes.where(Perfume.id.in_(perfume_ids))
+            note_rows = note_rows.where(PerfumeNotes.perfume_id.in_(perfume_ids))
+        if after_id is not None:
+            perfumes = perfumes.where(Perfume.id > after_id)
+            note_rows = note_rows.where(PerfumeNotes.perfume_id > after_id)
+
+        return perfumes.order_by(Perfume.id), note_rows.order_by(PerfumeNotes.id)
+
+    @staticmethod
+    def _group_feature_rows(perfume_rows, note_rows) -> List[Dict[str, Any]]:
+        notes = defaultdict(lambda: defaultdict(list))
+        for perfume_id, note_type, note_name in note_rows:
+            notes[perfume_id][note_type].append(note_name)
+
+        return [
+            {
+                'id': perfume_id,
+                'name': name,
+                'price': price,
+                'brand': brand,
+                'intensity': concentration,
+                'notes': {note_type: list(names) for note_type, names in notes.get(perfume_id, {}).items()}
+            }
+            for perfume_id, name, price, brand, concentration in perfume_rows
+        ]
+
+    @staticmethod
+    def _catalog_version_query() -> Select:
+        return select(CatalogVersion.version).where(CatalogVersion.id == 1)
+
+    @staticmethod
+    def _search_by_name_query(name: str, limit: int) -> Select:
+        return select(Perfume)\
+            .where(Perfume.name.ilike(f'%{name}%'))\
+            .order_by(Perfume.name)\
+            .limit(limit)
+
+    @staticmethod
+    def _by_brand_query(brand: str, limit: int) -> Select:
+        return select(Perfume)\
+            .join(Brands, Perfume.brand_id == Brands.id)\
+            .where(Brands.name == brand)\
+            .order_by(Perfume.name)\
+            .limit(limit)
+
+    @staticmethod
+    def _popular_query(limit: int, by: str = 'count') -> Select:
+        # агрегаты поддерживаются при записи оценок: top-N - чтение по индексу, без GROUP BY
+        order_columns = {
+            'count': (PerfumeRatingStats.rating_count, PerfumeRatingStats.popularity),
+            'popularity': (PerfumeRatingStats.popularity, PerfumeRatingStats.rating_count),
+            'rating': (PerfumeRatingStats.rating_mean, PerfumeRatingStats.rating_count),
+        }
+        if by not in order_columns:
+            raise ValueError(f'Неизвестный порядок популярности: {by}')
+
+        return select(Perfume)\
+            .join(PerfumeRatingStats, Perfume.id == PerfumeRatingStats.perfume_id)\
+            .order_by(*(desc(column) for column in order_columns[by]))\
+            .limit(limit)
+
+
+class PerfumeDAO(_PerfumeQueries):
     def __init__(self, db_session: Session):
         self.db = db_session
-    
+
     def get_by_id(self, perfume_id: int) -> Optional[Perfume]:
-        return self.db.query(Perfume).filter(Perfume.id == perfume_id).first()
-    
+        return self.db.scalars(self._by_id_query(perfume_id)).first()
+
     def get_all(self, limit: int = 1000) -> List[Perfume]:
-        return self.db.query(Perfume)\
-            .order_by(Perfume.id)\
-            .limit(limit)\
-            .all()
-    
+        return list(self.db.scalars(self._all_query(limit)))
+
+    def get_page(self, after_id: Optional[int] = None, limit: int = 50) -> List[Tuple[Perfume, Optional[int], Optional[float]]]:
+        # (парфюм, число оценок, средняя оценка) для парфюмов с id > after_id
+        return list(self.db.execute(self._page_query(after_id, limit)).unique().all())
+
+    def get_feature_rows(
+        self,
+        perfume_ids: Optional[Iterable[int]] = None,
+        after_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        # признаки каталога (только perfume_ids / только id > after_id) двумя запросами,
+        # без ленивой подгрузки связей по парфюму
+        perfumes, note_rows = self._feature_queries(perfume_ids, after_id)
+        return self._group_feature_rows(self.db.execute(perfumes).all(), self.db.execute(note_rows).all())
+
+    def get_catalog_signature(self) -> Tuple:
+        # отпечаток каталога - счётчик catalog_version: меняется при любой записи в таблицы каталога
+        # (названия, бренды, цены, ноты), чтение одной строки по первичному ключу
+        return (self.db.execute(self._catalog_version_query()).scalar() or 0,)
+
+    def ensure_catalog_version(self) -> bool:
+        # строка счётчика и триггеры на таблицах каталога (однократно, из миграции). Фиксирует вызывающий
+        dialect = self.db.get_bind().dialect.name
+        if dialect not in ('postgresql', 'sqlite'):
+            return False
+
+        self.db.execute(text(CATALOG_VERSION_ROW))
+        if dialect == 'postgresql':
+            self.db.execute(text(CATALOG_VERSION_FUNCTION))
+            for table in CATALOG_TABLES:
+                for statement in CATALOG_VERSION_POSTGRESQL_TRIGGER:
+                    self.db.execute(text(statement.format(table=table)))
+        else:
+            for table in CATALOG_TABLES:
+                for event in ('INSERT', 'UPDATE', 'DELETE'):
+                    self.db.execute(text(CATALOG_VERSION_SQLITE_TRIGGER.format(table=table, event=event)))
+        return True
+
     def search_by_name(self, name: str, limit: int = 50) -> List[Perfume]:
-        return self.db.query(Perfume)\
-            .filter(Perfume.name.ilike(f'%{name}%'))\
-            .order_by(Perfume.name)\
-            .limit(limit)\
-            .all()
-    
+        return list(self.db.scalars(self._search_by_name_query(name, limit)))
+
     def get_by_brand(self, brand: str, limit: int = 100) -> List[Perfume]:
-        return self.db.query(Perfume)\
-            .filter(Perfume.brand == brand)\
-            .order_by(Perfume.name)\
-            .limit(limit)\
-            .all()
-    
-    def get_popular(self, limit: int = 50) -> List[Perfume]:
-        popular_ids = self.db.query(
-            Ratings.perfume_id,
-            func.count(Ratings.id).label('rating_count')
-        ).group_by(
-            Ratings.perfume_id
-        ).order_by(
-            desc('rating_count')
-        ).limit(limit).all()
-        
-        perfume_ids = [pid for pid, _ in popular_ids]
-        
-        if not perfume_ids:
-            return []
-        
-        return self.db.query(Perfume)\
-            .filter(Perfume.id.in_(perfume_ids))\
-            .all()
\ No newline at end of file
+        return list(self.db.scalars(self._by_brand_query(brand, limit)))
+
+    def get_popular(self, limit: int = 50, by: str = 'count') -> List[Perfume]:
+        return list(self.db.scalars(self._popular_query(limit, by)))
+
+
+class AsyncPerfumeDAO(_PerfumeQueries):
+    def __init__(self, db_session: AsyncSession):
+        self.db = db_session
+
+    async def get_by_id(self, perfume_id: int) -> Optional[Perfume]:
+        return (await self.db.scalars(self._by_id_query(perfume_id))).first()
+
+    async def get_all(self, limit: int = 1000) -> List[Perfume]:
+        return list(await self.db.scalars(self._all_query(limit)))
+
+    async def get_page(self, after_id: Optional[int] = None, limit: int = 50) -> List[Tuple[Perfume, Optional[int], Optional[float]]]:
+        return list((await self.db.execute(self._page_query(after_id, limit))).unique().all())
+
+    async def get_feature_rows(
+        self,
+        perfume_ids: Optional[Iterable[int]] = None,
+        after_id: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        perfumes, note_rows = self._feature_queries(perfume_ids, after_id)
+        return self._group_feature_rows(
+            (await self.db.execute(perfumes)).all(),
+            (await self.db.execute(note_rows)).all()
+        )
+
+    async def get_catalog_signature(self) -> Tuple:
+        return ((await self.db.execute(self._catalog_version_query())).scalar() or 0,)
+
+    async def search_by_name(self, name: str, limit: int = 50) -> List[Perfume]:
+        return list(await self.db.scalars(self._search_by_name_query(name, limit)))
+
+    async def get_by_brand(self, brand: str, limit: int = 100) -> List[Perfume]:
+        return list(await self.db.scalars(self._by_brand_query(brand, limit)))
+
+    async def get_popular(self, limit: int = 50, by: str = 'count') -> List[Perfume]:
+        return list(await self.db.scalars(self._popular_query(limit, by)))
@@ -1,66 +1,257 @@
+import base64
+import json
 from auth.user_service import get_current_user
-from ratings.models import Ratings
-from perfumes.models import Brands, PerfumeNotes, Perfumes
-from db.connection import get_db
-from perfumes.schemas import MessageResponse, PerfumeCreate, PerfumeUpdate, PerfumeResponse, PerfumeDelete
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func
-from sqlalchemy.sql.expression import or_
-from typing import List, Optional, Union
+from perfumes.models import PerfumeNotes, Perfumes
+from db.connection import AsyncSessionLocal, get_async_db
+from perfumes.perfumes_dao import AsyncPerfumeDAO
+from users.users_dao import AsyncUserDAO
+from perfumes.schemas import (
+    FacetCount, MessageResponse, PerfumeCreate, PerfumeUpdate, PerfumeResponse, PerfumeDelete, PerfumeListItem, PerfumeNoteItem,
+    PerfumeFilterResponse, PerfumePage, PopularPerfumeResponse
+)
+from services.catalog_service.perfume_facets import DEFAULT_FACET_LIMIT, FacetQuery, PerfumeFacetIndex
+from services.catalog_service.perfume_search import DEFAULT_SEARCH_LIMIT, PerfumeSearchIndex
+from services.catalog_service.perfume_sampler import SAMPLER_STRATA, sample_unrated_perfumes
+from services.catalog_service.perfume_stats import STATS_RANKINGS
+from services.recomendation_service.engine import RecommendationEngine, get_recommendation_engine
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+from sqlalchemy import select
+from typing import AsyncIterator, List, Optional, Union
 
 
 perfumes_router = APIRouter(prefix='/perfumes', tags=['perfumes'])
 
-@perfumes_router.get('/', response_model=List[PerfumeResponse])
-async def get_all_perfumes(db: Session = Depends(get_db)):
-    perfumes = db.query(Perfumes)\
+# размер страницы каталога; для NDJSON - размер пачки, читаемой из БД за раз
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def _encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({'after_id': last_id}).encode()).decode().rstrip('=')
+
+
+def _decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    if not cursor:
+        return None
+    try:
+        after_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))['after_id']
+        if not isinstance(after_id, int):
+            raise ValueError(after_id)
+        return after_id
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Некорректный курсор страницы')
+
+
+def _perfume_list_item(perfume: Perfumes, rating_count: Optional[int], rating_mean: Optional[float]) -> PerfumeListItem:
+    item = PerfumeListItem.model_validate(perfume, from_attributes=True)
+    item.notes = [
+        PerfumeNoteItem(note_type=perfume_note.note_type.note_type_data, note_name=perfume_note.note.note_name)
+        for perfume_note in perfume.perfume_note
+    ]
+    item.rating_count = rating_count or 0
+    item.rating_mean = rating_mean
+    return item
+
+
+async def _stream_perfumes(after_id: Optional[int], batch_size: int) -> AsyncIterator[str]:
+    # весь каталог построчно (NDJSON) пачками по batch_size: в памяти одна пачка.
+    # Своя сессия - сессия зависимости закрывается раньше, чем отправится ответ
+    async with AsyncSessionLocal() as db:
+        dao = AsyncPerfumeDAO(db)
+        while True:
+            rows = await dao.get_page(after_id, batch_size)
+            for perfume, rating_count, rating_mean in rows:
+                yield _perfume_list_item(perfume, rating_count, rating_mean).model_dump_json() + '\n'
+            if len(rows) < batch_size:
+                break
+            after_id = rows[-1][0].id
+            # объекты прочитанной пачки больше не нужны
+            db.expunge_all()
+
+
+@perfumes_router.get('/', response_model=PerfumePage)
+async def get_all_perfumes(
+    limit : int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor : Optional[str] = None,
+    response_format : str = Query('json', alias='format', pattern='^(json|ndjson)$'),
+    db : AsyncSession = Depends(get_async_db)
+):
+    # Страница каталога по курсору (next_cursor предыдущей страницы).
+    # format=ndjson - потоковая выгрузка от курсора до конца каталога, по парфюму в строке
+    after_id = _decode_cursor(cursor)
+    if response_format == 'ndjson':
+        return StreamingResponse(_stream_perfumes(after_id, limit), media_type='application/x-ndjson')
+
+    # лишняя строка показывает, есть ли следующая страница
+    rows = await AsyncPerfumeDAO(db).get_page(after_id, limit + 1)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    return PerfumePage(
+        items=[_perfume_list_item(perfume, rating_count, rating_mean) for perfume, rating_count, rating_mean in rows],
+        next_cursor=_encode_cursor(rows[-1][0].id) if has_more else None
+    )
+
+@perfumes_router.get('/popular', response_model=List[PopularPerfumeResponse])
+async def get_popular_perfumes(
+    by : str = 'popularity',
+    limit : int = Query(10, ge=1, le=MAX_PAGE_SIZE),
+    min_ratings : int = Query(1, ge=0),
+    db : AsyncSession = Depends(get_async_db),
+    engine : RecommendationEngine = Depends(get_recommendation_engine)
+):
+    # by: popularity (с затуханием), count (число оценок), rating (средняя оценка).
+    # Порядок берётся из агрегатов в памяти за O(limit), из БД читаются только limit парфюмов
+    if by not in STATS_RANKINGS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'Неизвестный порядок: {by}, доступны: {", ".join(STATS_RANKINGS)}'
+        )
+
+    stats = engine.perfume_stats.current
+    perfume_ids = stats.top(by, limit, min_ratings=min_ratings)
+    perfumes = (await db.scalars(
+        select(Perfumes)
         .options(
             joinedload(Perfumes.brand),
-            joinedload(Perfumes.concentration),
-            joinedload(Perfumes.rating),
-            joinedload(Perfumes.perfume_note) 
-        )\
-        .all()
+            joinedload(Perfumes.concentration)
+        )
+        .where(Perfumes.id.in_(perfume_ids))
+    )).unique().all()
 
-    return perfumes
+    by_id = {perfume.id: perfume for perfume in perfumes}
+    return [
+        dict(PerfumeResponse.model_validate(by_id[perfume_id], from_attributes=True).model_dump(), **stats.get(perfume_id))
+        for perfume_id in perfume_ids
+        if perfume_id in by_id
+    ]
 
 @perfumes_router.get('/5rand_perfumes', response_model=Union[List[PerfumeResponse], dict])
-async def get_5_rand_perfumes(user_id : int, perfumes_to_rate_n : int = 5, db: Session = Depends(get_db)):
-    # смотрим оцененные парфюмы пользователя:
-    rated_ids = db.query(Ratings).with_entities(Ratings.perfume_id).filter(Ratings.user_id == user_id).subquery()
+async def get_5_rand_perfumes(
+    user_id : int,
+    perfumes_to_rate_n : int = Query(5, ge=1, le=50),
+    stratify : Optional[str] = Query(None, pattern=f'^({"|".join(SAMPLER_STRATA)})$'),
+    db: AsyncSession = Depends(get_async_db),
+    engine : RecommendationEngine = Depends(get_recommendation_engine)
+):
+    # Выборка из каталога в памяти отбором с отклонением: O(perfumes_to_rate_n) вместо
+    # ORDER BY random() по всем неоценённым. stratify=brand|concentration - парфюмы разных брендов/концентраций
+    catalog = engine.catalog.current
+    if len(catalog) == 0:
+        return {'message' : 'Нет парфюмов для оценки :('}
 
-    rated_cnt =db.query(Ratings).filter(Ratings.user_id == user_id).count()
-    perfumes_cnt = db.query(Perfumes).count()
+    # смотрим оцененные парфюмы пользователя:
+    rated_ids = [rating['perfume_id'] for rating in await AsyncUserDAO(db).get_ratings(user_id)]
+    perfume_ids = sample_unrated_perfumes(catalog, rated_ids, perfumes_to_rate_n, stratify)
 
     # если пользователь уже оценил все парфюмы в системе
-    if rated_cnt == perfumes_cnt:
-
-        if perfumes_cnt == 0:
-            return {'message' : 'Нет парфюмов для оценки :('}
-
+    if not perfume_ids:
         return {'message' : 'Все парфюмы уже оценены :('}
-    
-    rand_perfumes = db.query(Perfumes).filter(~Perfumes.id.in_(rated_ids)).order_by(func.random()).limit(perfumes_to_rate_n)
 
-    return rand_perfumes
+    rand_perfumes = await db.scalars(
+        select(Perfumes)
+        .options(
+            joinedload(Perfumes.brand),
+            joinedload(Perfumes.concentration)
+        )
+        .where(Perfumes.id.in_(perfume_ids))
+    )
+
+    # порядок выборки случайный - сохраняем его
+    by_id = {perfume.id: perfume for perfume in rand_perfumes.unique().all()}
+    return [by_id[perfume_id] for perfume_id in perfume_ids if perfume_id in by_id]
 
 @perfumes_router.get('/search', response_model=Union[List[PerfumeResponse], MessageResponse])
-async def search_perfumes(user_query : Optional[str] = None, db : Session = Depends(get_db)):
-    perfumes = db.query(Perfumes)\
+async def search_perfumes(
+    user_query : Optional[str] = None,
+    limit : int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_PAGE_SIZE),
+    mode : str = Query('fuzzy', pattern='^(fuzzy|prefix)$'),
+    db : AsyncSession = Depends(get_async_db),
+    engine : RecommendationEngine = Depends(get_recommendation_engine)
+):
+    # Поиск по названию и бренду в индексе триграмм каталога (без скана таблицы и JOIN в БД):
+    # mode=fuzzy - с опечатками, по доле общих триграмм; mode=prefix - автодополнение по началу слова.
+    # Из БД читаются только найденные limit парфюмов по первичному ключу
+    search_index = PerfumeSearchIndex.of(engine.catalog.current)
+    if not user_query:
+        perfume_ids = search_index.catalog.ids[:limit].tolist()
+    elif mode == 'prefix':
+        perfume_ids = search_index.autocomplete(user_query, limit)
+    else:
+        perfume_ids = [perfume_id for perfume_id, _ in search_index.search(user_query, limit)]
+
+    if not perfume_ids:
+        return []
+
+    perfumes = await db.scalars(
+        select(Perfumes)
         .options(
             joinedload(Perfumes.brand),
-            joinedload(Perfumes.concentration),
-            joinedload(Perfumes.perfume_note) 
-        )\
-        .join(Brands, Perfumes.brand_id == Brands.id) 
-
-    if user_query:
-        perfumes = perfumes.filter(
-                or_(
-                    Perfumes.name.ilike(f"%{user_query}%"),
-                    Brands.name.ilike(f"%{user_query}%"),
-                )
+            joinedload(Perfumes.concentration)
+        )
+        .where(Perfumes.id.in_(perfume_ids))
+    )
+
+    # порядок - по релевантности из индекса
+    by_id = {perfume.id: perfume for perfume in perfumes.unique().all()}
+    return [by_id[perfume_id] for perfume_id in perfume_ids if perfume_id in by_id]
+
+@perfumes_router.get('/filter', response_model=PerfumeFilterResponse)
+async def filter_perfumes(
+    note : List[str] = Query([]),
+    any_note : List[str] = Query([]),
+    exclude_note : List[str] = Query([]),
+    brand : List[str] = Query([]),
+    concentration : List[str] = Query([]),
+    price_min : Optional[float] = Query(None, ge=0),
+    price_max : Optional[float] = Query(None, ge=0),
+    limit : int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    offset : int = Query(0, ge=0),
+    facet_limit : int = Query(DEFAULT_FACET_LIMIT, ge=0, le=MAX_PAGE_SIZE),
+    db : AsyncSession = Depends(get_async_db),
+    engine : RecommendationEngine = Depends(get_recommendation_engine)
+):
+    # Фасетный фильтр по битовым множествам каталога в памяти, без JOIN нот в БД.
+    # note - все ноты (AND), any_note - хотя бы одна (OR), exclude_note - ни одной (NOT);
+    # нота задаётся как «слой:нота» (top:жасмин) или просто «нота» - в любом слое.
+    # brand, concentration - любое из значений. Из БД читается только страница найденных парфюмов
+    if price_min is not None and price_max is not None and price_min > price_max:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='price_min больше price_max')
+
+    query = FacetQuery(
+        all_notes=tuple(note),
+        any_notes=tuple(any_note),
+        exclude_notes=tuple(exclude_note),
+        brands=tuple(brand),
+        concentrations=tuple(concentration),
+        price_min=price_min,
+        price_max=price_max
+    )
+    result = PerfumeFacetIndex.of(engine.catalog.current).filter(
+        query, limit, offset, facet_limit, with_facets=facet_limit > 0
+    )
+
+    perfumes = []
+    if result.perfume_ids:
+        found = await db.scalars(
+            select(Perfumes)
+            .options(
+                joinedload(Perfumes.brand),
+                joinedload(Perfumes.concentration)
             )
-        
-    return perfumes.all()
+            .where(Perfumes.id.in_(result.perfume_ids))
+        )
+        by_id = {perfume.id: perfume for perfume in found.unique().all()}
+        perfumes = [by_id[perfume_id] for perfume_id in result.perfume_ids if perfume_id in by_id]
+
+    return PerfumeFilterResponse(
+        total=result.total,
+        items=[PerfumeResponse.model_validate(perfume, from_attributes=True) for perfume in perfumes],
+        facets={
+            group: [FacetCount(value=value, count=count) for value, count in counts]
+            for group, counts in result.facets.items()
+        }
+    )
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Optional
 from uuid import UUID
 from datetime import datetime
 
@@ -109,6 +109,38 @@ class PerfumeDelete(Perfume):
     ...
 
 
+class PerfumeNoteItem(BaseModel):
+    note_type : Optional[str] = None
+    note_name : Optional[str] = None
+
+
+class PerfumeListItem(PerfumeResponse):
+    notes : List[PerfumeNoteItem] = Field(default_factory=list)
+    rating_count : int = Field(default=0)
+    rating_mean : Optional[float] = None
+
+
+class PerfumePage(BaseModel):
+    items : List[PerfumeListItem] = Field(...)
+    next_cursor : Optional[str] = None   # None - последняя страница
+
+
+class PopularPerfumeResponse(PerfumeResponse):
+    rating_count : int = Field(...)
+    rating_mean : float = Field(...)
+    popularity : float = Field(...)
+
+
+class FacetCount(BaseModel):
+    value : str = Field(...)
+    count : int = Field(...)
+
+
+class PerfumeFilterResponse(BaseModel):
+    total : int = Field(...)
+    items : List[PerfumeResponse] = Field(...)
+    facets : Dict[str, List[FacetCount]] = Field(default_factory=dict)
+
 
 class MessageResponse(BaseModel):
     message : str = Field(...)
\ No newline at end of file
@@ -1,11 +1,15 @@
 from db.connection import Base
-from sqlalchemy import Column, Integer, Text, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, Float, Text, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 
 class Ratings(Base):
     __tablename__ = 'ratings'
+    # одна оценка на пару (пользователь, парфюм) - цель INSERT ... ON CONFLICT
+    __table_args__ = (
+        Index('uq_ratings_user_perfume', 'user_id', 'perfume_id', unique=True),
+    )
 
     id = Column(Integer, primary_key=True, autoincrement=True)
     rate = Column(Integer, nullable=False)
@@ -16,3 +20,31 @@ class Ratings(Base):
 
     user = relationship('Users', back_populates='rating')
     perfume = relationship('Perfumes', back_populates='rating')
+
+
+class PerfumeRatingStats(Base):
+    # Агрегаты оценок парфюма, обновляются в той же транзакции, что и оценка.
+    # popularity - прямое затухание: сумма весов exp(λ·(t - эпоха)) по оценкам, порядок по ней
+    # равен порядку по затухшей популярности на любой момент, пересчёт при чтении не нужен
+    __tablename__ = 'perfume_rating_stats'
+
+    perfume_id = Column(Integer, ForeignKey('perfumes.id', ondelete='CASCADE'), primary_key=True)
+    rating_count = Column(Integer, nullable=False, default=0, index=True)
+    rating_sum = Column(Integer, nullable=False, default=0)
+    rating_mean = Column(Float, nullable=False, default=0.0, index=True)
+    popularity = Column(Float, nullable=False, default=0.0, index=True)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now(), index=True)
+
+
+class RatingChangeLog(Base):
+    # Журнал изменений оценок: id - монотонная последовательность изменений.
+    # Пишется в той же транзакции, что и оценка; rate = NULL - оценка удалена.
+    # Читатели (MatrixManager) забирают изменения после своего id - O(изменений), без скана ratings
+    __tablename__ = 'rating_change_log'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    user_id = Column(Integer, nullable=False)
+    perfume_id = Column(Integer, nullable=False)
+    rate = Column(Integer, nullable=True)
+    changed_at = Column(DateTime, default=func.now())
+
@@ -0,0 +1,308 @@
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, IO, Iterable, List, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
+from db.connection import SessionLocal
+from ratings.ratings_dao import RatingDAO
+
+logger = logging.getLogger(__name__)
+
+# файлы журнала: ratings-<время создания, нс>-<pid>-<номер>.log - по имени упорядочены по времени
+LOG_PATTERN = 'ratings-*.log'
+# оценки, которые БД отвергла (нарушение ограничения): не переигрываются, остаются для разбора
+REJECTED_LOG = 'rejected.log'
+
+
+class RatingQueueFullError(RuntimeError):
+    # неподтверждённых БД оценок больше max_pending (БД недоступна или не успевает) - новые не принимаются
+    pass
+
+
+@dataclass(frozen=True)
+class RatingChanges:
+    # событие после записи пачки в БД: оценки (user_id, perfume_id, rate), итоги upsert
+    # и итоговые строки агрегатов парфюмов (как RETURNING в AsyncRatingDAO)
+    ratings: List[Tuple[int, int, int]]
+    summary: Dict[str, int]
+    perfume_stats: List[Tuple]
+
+
+class _Segment:
+    # файл журнала под эксклюзивной блокировкой: пока процесс жив, его сегменты не переигрываются другими
+    def __init__(self, path: str, file: IO):
+        self.path = path
+        self.file = file
+
+    @classmethod
+    def create(cls, path: str) -> '_Segment':
+        file = open(path, 'a', encoding='utf-8')
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return cls(path, file)
+
+    @classmethod
+    def adopt(cls, path: str) -> Optional['_Segment']:
+        # сегмент упавшего процесса: блокировку освободила ОС; занятый - чужой живой процесс
+        try:
+            file = open(path, 'a+', encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+        return cls(path, file)
+
+    def read(self) -> List[Tuple[int, int, int]]:
+        self.file.seek(0)
+        ratings = []
+        for line in self.file:
+            try:
+                record = json.loads(line)
+                ratings.append((int(record['user_id']), int(record['perfume_id']), int(record['rate'])))
+            except (ValueError, KeyError, TypeError):
+                # оборванная при падении последняя строка
+                logger.warning(f'Пропущена повреждённая запись журнала оценок {self.path}')
+        return ratings
+
+    def remove(self):
+        os.unlink(self.path)
+        self.file.close()
+
+
+class RatingWriteQueue:
+    # Отложенная запись оценок (write-behind). Оценка подтверждается после дозаписи строки
+    # в локальный журнал (write без fsync - переживает падение процесса; fsync - раз в интервал),
+    # в БД уходит пачкой: flush_size оценок или раз в flush_interval_seconds - одна транзакция.
+    # После фиксации пачки подписчики получают RatingChanges (дельта матрицы, кеши, агрегаты).
+    # При сбросе активный сегмент журнала закрывается и удаляется только после фиксации в БД;
+    # сегменты упавших процессов переигрываются при старте.
+    # Под блокировкой записи (её берут submit* из async-маршрутов) - только дозапись строки
+    # и подмена сегмента; открытие следующего сегмента и fsync закрытого - вне её.
+    # Очередь ограничена max_pending: пока БД недоступна, новые оценки отклоняются (RatingQueueFullError)
+    def __init__(
+            self,
+            log_path: str,
+            flush_size: int = 1000,
+            flush_interval_seconds: float = 1.0,
+            session_factory=SessionLocal,
+            max_pending: int = 100_000
+    ):
+        self.log_path = log_path
+        self.flush_size = flush_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending = max_pending
+        self._session_factory = session_factory
+
+        self._pending: List[Tuple[int, int, int]] = []
+        self._active: Optional[_Segment] = None
+        # следующий сегмент, открытый заранее вне блокировки записи
+        self._spare: Optional[_Segment] = None
+        self._sealed: List[_Segment] = []
+        self._segment_number = 0
+        self._listeners: List[Callable[[RatingChanges], None]] = []
+
+        self._lock = threading.Lock()
+        # одна пачка в БД одновременно: порядок оценок одной пары сохраняется
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def subscribe(self, listener: Callable[[RatingChanges], None]):
+        self._listeners.append(listener)
+
+    def start(self):
+        os.makedirs(self.log_path, exist_ok=True)
+        with self._lock:
+            self._active = self._new_segment()
+        self._replay()
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='rating-write-behind', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        # остаток - в БД; если не удалось, журнал переиграется при следующем старте
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f'Оценки остались в журнале до следующего старта: {e}')
+            return
+
+        with self._lock:
+            if self._active is not None and not self._pending:
+                self._active.remove()
+                self._active = None
+        if self._spare is not None:
+            self._spare.remove()
+            self._spare = None
+
+    def submit(self, user_id: int, perfume_id: int, rate: int):
+        self.submit_many([(user_id, perfume_id, rate)])
+
+    def submit_many(self, ratings: Iterable[Tuple[int, int, int]]):
+        ratings = [(int(user_id), int(perfume_id), int(rate)) for user_id, perfume_id, rate in ratings]
+        lines = ''.join(
+            json.dumps({'user_id': user_id, 'perfume_id': perfume_id, 'rate': rate}) + '\n'
+            for user_id, perfume_id, rate in ratings
+        )
+        with self._lock:
+            if self._active is None:
+                raise RuntimeError('Очередь записи оценок не запущена')
+            if len(self._pending) + len(ratings) > self.max_pending:
+                raise RatingQueueFullError(f'В очереди записи оценок {len(self._pending)} из {self.max_pending}')
+            self._active.file.write(lines)
+            self._active.file.flush()
+            self._pending.extend(ratings)
+            full = len(self._pending) >= self.flush_size
+
+        if full:
+            self._wakeup.set()
+
+    def flush(self) -> int:
+        # пачка накопленных оценок - в БД одной транзакцией; возвращает число записанных
+        with self._flush_lock:
+            # сегменты меняет только сброс (под _flush_lock), поэтому следующий открывается без _lock
+            if self._pending and self._spare is None:
+                self._spare = self._new_segment()
+
+            closed = None
+            with self._lock:
+                if not self._pending and not self._sealed:
+                    return 0
+                if self._pending and self._active is not None:
+                    if self._spare is None:
+                        # оценки пришли после открытия сегмента - на следующем тике
+                        return 0
+                    # новые оценки пишутся в новый сегмент, закрытые ждут фиксации пачки
+                    closed = self._active
+                    self._sealed.append(closed)
+                    self._active, self._spare = self._spare, None
+                batch, self._pending = self._pending, []
+                sealed = list(self._sealed)
+
+            # в закрытый сегмент больше никто не пишет - fsync без блокировки записи
+            if closed is not None:
+                os.fsync(closed.file.fileno())
+
+            # Нарушение ограничения (оценка удалённого парфюма) не лечится повтором: пачка делится
+            # пополам, пока виновные оценки не останутся по одной, - они откладываются в REJECTED_LOG,
+            # остальные записываются. Прочие ошибки (БД недоступна) - незаписанный остаток возвращается
+            # в начало очереди, повтор на следующем тике; пока он не записан, новые оценки упираются в max_pending
+            written: List[RatingChanges] = []
+            rejected: List[Tuple[int, int, int]] = []
+            remaining = [batch] if batch else []
+            try:
+                while remaining:
+                    part = remaining.pop()
+                    try:
+                        summary, perfume_stats = self._write(part)
+                    except IntegrityError:
+                        if len(part) == 1:
+                            rejected.extend(part)
+                            continue
+                        middle = len(part) // 2
+                        # первая половина - первой: порядок оценок одной пары сохраняется
+                        remaining.extend([part[middle:], part[:middle]])
+                        continue
+                    written.append(RatingChanges(ratings=part, summary=summary, perfume_stats=perfume_stats))
+            except Exception:
+                unwritten = part + [rating for rest in reversed(remaining) for rating in rest]
+                with self._lock:
+                    self._pending = unwritten + self._pending
+                raise
+            finally:
+                if rejected:
+                    self._reject(rejected)
+                self._notify(written)
+
+            with self._lock:
+                for segment in sealed:
+                    segment.remove()
+                    self._sealed.remove(segment)
+        return sum(len(changes.ratings) for changes in written)
+
+    def _write(self, ratings: List[Tuple[int, int, int]]) -> Tuple[Dict[str, int], List[Tuple]]:
+        db = self._session_factory()
+        try:
+            result = RatingDAO(db).upsert_many(ratings)
+            db.commit()
+            return result
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _reject(self, ratings: List[Tuple[int, int, int]]):
+        logger.error(f'БД отвергла оценки, отложены в {REJECTED_LOG}: {ratings[:10]}')
+        with open(os.path.join(self.log_path, REJECTED_LOG), 'a', encoding='utf-8') as file:
+            file.writelines(
+                json.dumps({'user_id': user_id, 'perfume_id': perfume_id, 'rate': rate}) + '\n'
+                for user_id, perfume_id, rate in ratings
+            )
+
+    def _notify(self, written: List[RatingChanges]):
+        # подписчики - под блокировкой сброса: события приходят в порядке записи
+        for changes in written:
+            for listener in self._listeners:
+                try:
+                    listener(changes)
+                except Exception as e:
+                    logger.error(f'Ошибка обработчика изменений оценок: {e}')
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self.flush_interval_seconds)
+            self._wakeup.clear()
+            try:
+                flushed = self.flush()
+                if flushed:
+                    logger.debug(f'Записано оценок из очереди: {flushed}')
+            except Exception as e:
+                logger.error(f'Ошибка записи пачки оценок: {e}')
+                # БД недоступна - не повторяем чаще интервала
+                self._stop_event.wait(self.flush_interval_seconds)
+
+    def _new_segment(self) -> _Segment:
+        self._segment_number += 1
+        path = os.path.join(self.log_path, f'ratings-{time.time_ns()}-{os.getpid()}-{self._segment_number}.log')
+        return _Segment.create(path)
+
+    def _replay(self):
+        # сегменты упавших процессов: оценки - в очередь, файлы удаляются после фиксации
+        own = {self._active.path}
+        replayed = 0
+        for path in sorted(glob.glob(os.path.join(self.log_path, LOG_PATTERN))):
+            if path in own:
+                continue
+            segment = _Segment.adopt(path)
+            if segment is None:
+                continue
+            ratings = segment.read()
+            with self._lock:
+                self._pending.extend(ratings)
+                self._sealed.append(segment)
+            replayed += len(ratings)
+
+        if replayed:
+            logger.info(f'Из журнала переиграно оценок: {replayed}')
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f'Не удалось записать оценки из журнала: {e}')
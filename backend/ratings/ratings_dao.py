@@ -0,0 +1,450 @@
+import math
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import numpy as np
+from ratings.models import PerfumeRatingStats, RatingChangeLog, Ratings
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased
+from sqlalchemy import Float, Insert, Select, cast, delete, func, insert, inspect, select, text, tuple_
+
+# Затухание популярности: оценка теряет половину веса за POPULARITY_HALF_LIFE_DAYS.
+# Вес считается от фиксированной эпохи и только растёт со временем (прямое затухание),
+# поэтому сумма весов обновляется прибавлением, без пересчёта старых оценок
+POPULARITY_HALF_LIFE_DAYS = 30.0
+POPULARITY_EPOCH = datetime(2024, 1, 1)
+POPULARITY_DECAY = math.log(2) / (POPULARITY_HALF_LIFE_DAYS * 86400)
+
+# Строк в одном многострочном INSERT: ограничение числа параметров запроса (asyncpg, SQLite)
+RATING_BATCH_CHUNK = 5000
+
+# Канал уведомлений о новых изменениях оценок (PostgreSQL LISTEN/NOTIFY): полезная нагрузка -
+# последний id журнала изменений. Уведомление шлёт триггер на журнал, отправляется при фиксации
+CHANGE_NOTIFY_CHANNEL = 'rating_changes'
+CHANGE_NOTIFY_DDL = (
+    f"""
+    CREATE OR REPLACE FUNCTION notify_rating_changes() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{CHANGE_NOTIFY_CHANNEL}', (SELECT max(id) FROM rating_change_log)::text);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    'DROP TRIGGER IF EXISTS rating_change_log_notify ON rating_change_log',
+    """
+    CREATE TRIGGER rating_change_log_notify AFTER INSERT ON rating_change_log
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_rating_changes()
+    """,
+)
+
+# уникальность оценки пары (пользователь, парфюм) - цель ON CONFLICT
+UNIQUE_RATINGS_INDEX = next(index for index in Ratings.__table__.indexes if index.name == 'uq_ratings_user_perfume')
+
+# INSERT ... ON CONFLICT DO UPDATE для поддерживаемых диалектов
+UPSERT_DIALECTS = {
+    'postgresql': postgresql_insert,
+    'sqlite': sqlite_insert,
+}
+
+
+def popularity_weight(rated_at: Optional[datetime]) -> float:
+    if rated_at is None:
+        return 1.0
+    return math.exp(POPULARITY_DECAY * (rated_at - POPULARITY_EPOCH).total_seconds())
+
+
+def decayed_popularity(popularity: float, at: Optional[datetime] = None) -> float:
+    # сумма весов -> «число оценок с учётом давности» на момент at
+    return popularity / popularity_weight(at or datetime.now())
+
+
+class _RatingQueries:
+    # запросы в стиле SQLAlchemy 2.0 - общие для синхронного и асинхронного DAO
+    @staticmethod
+    def _by_user_and_perfume_query(user_id: int, perfume_id: int) -> Select:
+        return select(Ratings).where(Ratings.user_id == user_id, Ratings.perfume_id == perfume_id)
+
+    @staticmethod
+    def _rating_upsert_query(dialect: str, rows: List[Dict[str, Any]], update: bool = False) -> Insert:
+        # оценки одним INSERT ... ON CONFLICT (user_id, perfume_id): без update существующие
+        # пропускаются, с update - перезаписываются; RETURNING - только вставленные/изменённые
+        if dialect not in UPSERT_DIALECTS:
+            raise ValueError(f'Диалект {dialect} не поддерживает запись оценок с ON CONFLICT')
+
+        upsert = UPSERT_DIALECTS[dialect](Ratings).values(rows)
+        if not update:
+            return upsert.on_conflict_do_nothing(index_elements=[Ratings.user_id, Ratings.perfume_id])
+        return upsert.on_conflict_do_update(
+            index_elements=[Ratings.user_id, Ratings.perfume_id],
+            set_={'rate': upsert.excluded.rate, 'rate_date': upsert.excluded.rate_date}
+        )
+
+    @staticmethod
+    def _stats_upsert_query(dialect: str, deltas: List[Dict[str, Any]]) -> Insert:
+        # атомарное изменение агрегатов: строка VALUES - приращения одного парфюма (EXCLUDED),
+        # параллельные оценки парфюма не теряются; RETURNING отдаёт итоговые значения для копии в памяти.
+        # Парфюмы в deltas не повторяются (ON CONFLICT не меняет строку дважды за запрос)
+        if dialect not in UPSERT_DIALECTS:
+            raise ValueError(f'Диалект {dialect} не поддерживает обновление агрегатов оценок')
+
+        stats = PerfumeRatingStats
+        upsert = UPSERT_DIALECTS[dialect](stats).values([
+            dict(
+                delta,
+                rating_mean=delta['rating_sum'] / delta['rating_count'] if delta['rating_count'] else 0.0
+            )
+            for delta in deltas
+        ])
+        new_count = stats.rating_count + upsert.excluded.rating_count
+        new_sum = stats.rating_sum + upsert.excluded.rating_sum
+        return upsert.on_conflict_do_update(
+            index_elements=[stats.perfume_id],
+            set_={
+                'rating_count': new_count,
+                'rating_sum': new_sum,
+                'rating_mean': cast(new_sum, Float) / new_count,
+                'popularity': stats.popularity + upsert.excluded.popularity,
+                'updated_at': upsert.excluded.updated_at
+            }
+        ).returning(
+            stats.perfume_id, stats.rating_count, stats.rating_sum, stats.rating_mean, stats.popularity
+        )
+
+    @staticmethod
+    def _stats_delta(
+        perfume_id: int,
+        rate_delta: int,
+        count_delta: int,
+        rated_at: datetime
+    ) -> Dict[str, Any]:
+        # изменение существующей оценки (count_delta=0) меняет только сумму
+        return {
+            'perfume_id': perfume_id,
+            'rating_count': count_delta,
+            'rating_sum': rate_delta,
+            'popularity': popularity_weight(rated_at) if count_delta > 0 else 0.0,
+            'updated_at': rated_at
+        }
+
+    @staticmethod
+    def _rating_insert_query(dialect: str, rows: List[Dict[str, Any]]) -> Insert:
+        # INSERT ... ON CONFLICT DO NOTHING RETURNING - пары, которые вставил именно этот запрос.
+        # Параллельная вставка той же пары дожидается фиксации конкурента и пропускает пару
+        return _RatingQueries._rating_upsert_query(dialect, rows).returning(Ratings.user_id, Ratings.perfume_id)
+
+    @staticmethod
+    def _existing_rates_query(pairs: List[Tuple[int, int]]) -> Select:
+        # текущие оценки и их даты для пар, которые вставка пропустила: строки уже зафиксированы
+        # и блокируются до конца транзакции (PostgreSQL) - до перезаписи их никто не изменит
+        return select(Ratings.user_id, Ratings.perfume_id, Ratings.rate, Ratings.rate_date)\
+            .where(tuple_(Ratings.user_id, Ratings.perfume_id).in_(pairs))\
+            .with_for_update()
+
+    @staticmethod
+    def _batch_rows(ratings: Iterable[Tuple[int, int, int]], rated_at: datetime) -> List[Dict[str, Any]]:
+        # повтор пары в пачке - побеждает последняя оценка; порядок по паре - параллельные пачки
+        # блокируют строки в одном порядке и не взаимоблокируются
+        latest: Dict[Tuple[int, int], int] = {}
+        for user_id, perfume_id, rate in ratings:
+            latest[(user_id, perfume_id)] = rate
+        return [
+            {'user_id': user_id, 'perfume_id': perfume_id, 'rate': rate, 'rate_date': rated_at}
+            for (user_id, perfume_id), rate in sorted(latest.items())
+        ]
+
+    @staticmethod
+    def _batch_changes(
+        rows: List[Dict[str, Any]],
+        inserted: Set[Tuple[int, int]],
+        existing: Dict[Tuple[int, int], Tuple[int, Optional[datetime]]],
+        rated_at: datetime
+    ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]], Dict[str, int]]:
+        # по факту вставки (inserted - из RETURNING) и заблокированным оценкам остальных пар:
+        # строки для перезаписи, записи журнала изменений, приращения агрегатов и итоги пачки.
+        # Изменённая оценка получает новую дату - её вес в популярности переносится на эту дату
+        updates, changed, deltas = [], [], {}
+        summary = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        for row in rows:
+            pair, rate, perfume_id = (row['user_id'], row['perfume_id']), row['rate'], row['perfume_id']
+            if pair in inserted:
+                summary['inserted'] += 1
+                delta = deltas.setdefault(perfume_id, _RatingQueries._stats_delta(perfume_id, 0, 0, rated_at))
+                delta['rating_count'] += 1
+                delta['rating_sum'] += rate
+                delta['popularity'] += popularity_weight(rated_at)
+            else:
+                previous, previous_date = existing.get(pair, (None, None))
+                # оценку пары удалили между вставкой и блокировкой - удаление считается более поздним
+                if previous is None or previous == rate:
+                    summary['unchanged'] += 1
+                    continue
+                summary['updated'] += 1
+                updates.append(row)
+                delta = deltas.setdefault(perfume_id, _RatingQueries._stats_delta(perfume_id, 0, 0, rated_at))
+                delta['rating_sum'] += rate - previous
+                delta['popularity'] += popularity_weight(rated_at) - popularity_weight(previous_date)
+            changed.append(row)
+
+        return updates, changed, list(deltas.values()), summary
+
+    @staticmethod
+    def _change_log_query(rows: List[Dict[str, Any]]) -> Insert:
+        # строки оценок (user_id, perfume_id, rate) -> записи журнала изменений; changed_at - время
+        # записи изменения, а не дата оценки: по нему журнал чистится от старых записей
+        changed_at = datetime.now()
+        return insert(RatingChangeLog).values([
+            {'user_id': row['user_id'], 'perfume_id': row['perfume_id'], 'rate': row['rate'], 'changed_at': changed_at}
+            for row in rows
+        ])
+
+    @staticmethod
+    def _latest_change_query() -> Select:
+        # max по первичному ключу - чтение края индекса, не агрегат по таблице
+        return select(func.max(RatingChangeLog.id))
+
+    @staticmethod
+    def _changes_query(after_id: int, limit: Optional[int] = None) -> Select:
+        query = select(RatingChangeLog.id, RatingChangeLog.user_id, RatingChangeLog.perfume_id, RatingChangeLog.rate)\
+            .where(RatingChangeLog.id > after_id)\
+            .order_by(RatingChangeLog.id)
+        return query if limit is None else query.limit(limit)
+
+    @staticmethod
+    def _stats_query(updated_since: Optional[datetime] = None) -> Select:
+        query = select(
+            PerfumeRatingStats.perfume_id,
+            PerfumeRatingStats.rating_count,
+            PerfumeRatingStats.rating_sum,
+            PerfumeRatingStats.rating_mean,
+            PerfumeRatingStats.popularity,
+            PerfumeRatingStats.updated_at
+        )
+        if updated_since is not None:
+            query = query.where(PerfumeRatingStats.updated_at >= updated_since)
+        return query
+
+    @staticmethod
+    def _stats_source_query() -> Select:
+        return select(Ratings.perfume_id, Ratings.rate, Ratings.rate_date)
+
+    @staticmethod
+    def _aggregate_ratings(rows, updated_at: datetime) -> List[Dict[str, Any]]:
+        # агрегаты по всем оценкам столбцами NumPy (для первичного заполнения и перестроения)
+        if not rows:
+            return []
+        perfume_ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        rates = np.fromiter((row[1] for row in rows), dtype=np.float64, count=len(rows))
+        weights = np.fromiter((popularity_weight(row[2]) for row in rows), dtype=np.float64, count=len(rows))
+
+        unique_ids, positions = np.unique(perfume_ids, return_inverse=True)
+        counts = np.bincount(positions)
+        sums = np.bincount(positions, weights=rates)
+        popularity = np.bincount(positions, weights=weights)
+
+        return [
+            {
+                'perfume_id': int(perfume_id),
+                'rating_count': int(count),
+                'rating_sum': int(rating_sum),
+                'rating_mean': float(rating_sum / count),
+                'popularity': float(score),
+                'updated_at': updated_at
+            }
+            for perfume_id, count, rating_sum, score in zip(unique_ids, counts, sums, popularity)
+        ]
+
+
+def _chunks(items: List[Any], size: int = RATING_BATCH_CHUNK) -> Iterator[List[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class RatingDAO(_RatingQueries):
+    def __init__(self, db_session: Session):
+        self.db = db_session
+
+    def get_by_user_and_perfume(self, user_id: int, perfume_id: int) -> Optional[Ratings]:
+        return self.db.scalars(self._by_user_and_perfume_query(user_id, perfume_id)).first()
+
+    def get_rating_stats(self, updated_since: Optional[datetime] = None) -> List[Tuple]:
+        # (perfume_id, count, sum, mean, popularity, updated_at) - все или изменённые с updated_since
+        return list(self.db.execute(self._stats_query(updated_since)).all())
+
+    def has_ratings(self) -> bool:
+        return self.db.execute(select(Ratings.id).limit(1)).first() is not None
+
+    def rebuild_rating_stats(self) -> int:
+        # полный пересчёт агрегатов по таблице оценок (первый запуск, расхождение)
+        rows = self._aggregate_ratings(self.db.execute(self._stats_source_query()).all(), datetime.now())
+        self.db.execute(delete(PerfumeRatingStats))
+        if rows:
+            self.db.execute(insert(PerfumeRatingStats), rows)
+        return len(rows)
+
+    def record_rating_stats(
+        self,
+        perfume_id: int,
+        rate_delta: int,
+        count_delta: int = 1,
+        rated_at: Optional[datetime] = None
+    ) -> Tuple:
+        delta = self._stats_delta(perfume_id, rate_delta, count_delta, rated_at or datetime.now())
+        return self.db.execute(self._stats_upsert_query(self.db.get_bind().dialect.name, [delta])).one()
+
+    def upsert_many(self, ratings: Iterable[Tuple[int, int, int]]) -> Tuple[Dict[str, int], List[Tuple]]:
+        # синхронный вариант AsyncRatingDAO.upsert_many - для фоновой записи пачек оценок
+        dialect = self.db.get_bind().dialect.name
+        rated_at = datetime.now()
+        rows = self._batch_rows(ratings, rated_at)
+
+        inserted = set()
+        for chunk in _chunks(rows):
+            inserted.update(tuple(pair) for pair in self.db.execute(self._rating_insert_query(dialect, chunk)))
+
+        existing = {}
+        skipped = [pair for pair in ((row['user_id'], row['perfume_id']) for row in rows) if pair not in inserted]
+        for chunk in _chunks(skipped):
+            existing.update(
+                ((user_id, perfume_id), (rate, rate_date))
+                for user_id, perfume_id, rate, rate_date in self.db.execute(self._existing_rates_query(chunk))
+            )
+
+        updates, changed, deltas, summary = self._batch_changes(rows, inserted, existing, rated_at)
+        for chunk in _chunks(updates):
+            self.db.execute(self._rating_upsert_query(dialect, chunk, update=True))
+        for chunk in _chunks(changed):
+            self.db.execute(self._change_log_query(chunk))
+
+        stats = []
+        for chunk in _chunks(deltas):
+            stats.extend(self.db.execute(self._stats_upsert_query(dialect, chunk)).all())
+        return summary, stats
+
+    def has_unique_ratings_index(self) -> bool:
+        return any(
+            existing['name'] == UNIQUE_RATINGS_INDEX.name
+            for existing in inspect(self.db.get_bind()).get_indexes(Ratings.__tablename__)
+        )
+
+    def remove_duplicate_ratings(self) -> int:
+        # перед уникальным индексом (user_id, perfume_id) на таблице, созданной до него: дубли пар
+        # удаляются (остаётся последняя оценка), агрегаты пересчитываются. Фиксирует вызывающий
+        duplicated = select(Ratings.user_id, Ratings.perfume_id)\
+            .group_by(Ratings.user_id, Ratings.perfume_id)\
+            .having(func.count(Ratings.id) > 1)
+        pairs = [tuple(pair) for pair in self.db.execute(duplicated).all()]
+        if not pairs:
+            return 0
+
+        # NOT EXISTS по индексу пары вместо NOT IN (SELECT max(id) ... GROUP BY) по всей таблице
+        newer = aliased(Ratings)
+        has_newer = select(newer.id).where(
+            newer.user_id == Ratings.user_id,
+            newer.perfume_id == Ratings.perfume_id,
+            newer.id > Ratings.id
+        ).exists()
+        removed = self.db.execute(delete(Ratings).where(has_newer)).rowcount
+        if removed:
+            self.rebuild_rating_stats()
+            # у пар с дублями в матрице оценок могла остаться не последняя оценка
+            for chunk in _chunks(pairs):
+                survivors = self.db.execute(
+                    select(Ratings.user_id, Ratings.perfume_id, Ratings.rate, Ratings.rate_date)
+                    .where(tuple_(Ratings.user_id, Ratings.perfume_id).in_(chunk))
+                ).mappings().all()
+                self.db.execute(self._change_log_query([dict(row) for row in survivors]))
+        return removed
+
+    def create_unique_ratings_index(self):
+        # PostgreSQL - CREATE UNIQUE INDEX CONCURRENTLY на отдельном соединении в autocommit:
+        # запись в ratings на время построения не блокируется. Недостроенный (INVALID) индекс
+        # удаляется, иначе повтор пропустил бы его по IF NOT EXISTS
+        bind = self.db.get_bind()
+        if bind.dialect.name != 'postgresql':
+            UNIQUE_RATINGS_INDEX.create(self.db.connection(), checkfirst=True)
+            return
+
+        columns = ', '.join(column.name for column in UNIQUE_RATINGS_INDEX.columns)
+        with getattr(bind, 'engine', bind).connect() as connection:
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            try:
+                connection.execute(text(
+                    f'CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {UNIQUE_RATINGS_INDEX.name} '
+                    f'ON {Ratings.__tablename__} ({columns})'
+                ))
+            except Exception:
+                connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS {UNIQUE_RATINGS_INDEX.name}'))
+                raise
+
+    def get_latest_change_id(self) -> int:
+        return self.db.execute(self._latest_change_query()).scalar() or 0
+
+    def get_changes(self, after_id: int, limit: Optional[int] = None) -> List[Tuple[int, int, int, Optional[int]]]:
+        # (id, user_id, perfume_id, rate) после after_id по возрастанию id; rate = None - оценка удалена
+        return [tuple(row) for row in self.db.execute(self._changes_query(after_id, limit)).all()]
+
+    def prune_changes(self, older_than: datetime) -> int:
+        # по возрасту, а не по водяному знаку одного читателя: у каждого воркера свой, и все
+        # они моложе срока хранения - иначе воркер перестраивает матрицу полностью
+        return self.db.execute(delete(RatingChangeLog).where(RatingChangeLog.changed_at < older_than)).rowcount
+
+    def ensure_change_notify(self) -> bool:
+        # триггер NOTIFY на журнал изменений - только PostgreSQL; иначе читатели опрашивают журнал
+        if self.db.get_bind().dialect.name != 'postgresql':
+            return False
+        for statement in CHANGE_NOTIFY_DDL:
+            self.db.execute(text(statement))
+        return True
+
+
+class AsyncRatingDAO(_RatingQueries):
+    def __init__(self, db_session: AsyncSession):
+        self.db = db_session
+
+    async def get_by_user_and_perfume(self, user_id: int, perfume_id: int) -> Optional[Ratings]:
+        return (await self.db.scalars(self._by_user_and_perfume_query(user_id, perfume_id))).first()
+
+    async def upsert_many(self, ratings: Iterable[Tuple[int, int, int]]) -> Tuple[Dict[str, int], List[Tuple]]:
+        # пачка (user_id, perfume_id, rate): новые оценки вставляются, существующие перезаписываются.
+        # Вставлена ли пара - по RETURNING самой вставки (ON CONFLICT DO NOTHING), прежняя оценка
+        # остальных - под блокировкой строки, поэтому приращения агрегатов не зависят от гонок.
+        # На RATING_BATCH_CHUNK оценок - до пяти запросов: вставка, текущие оценки, перезапись,
+        # журнал изменений, upsert агрегатов
+        dialect = self.db.get_bind().dialect.name
+        rated_at = datetime.now()
+        rows = self._batch_rows(ratings, rated_at)
+
+        inserted = set()
+        for chunk in _chunks(rows):
+            inserted.update(tuple(pair) for pair in await self.db.execute(self._rating_insert_query(dialect, chunk)))
+
+        existing = {}
+        skipped = [pair for pair in ((row['user_id'], row['perfume_id']) for row in rows) if pair not in inserted]
+        for chunk in _chunks(skipped):
+            existing.update(
+                ((user_id, perfume_id), (rate, rate_date))
+                for user_id, perfume_id, rate, rate_date in await self.db.execute(self._existing_rates_query(chunk))
+            )
+
+        updates, changed, deltas, summary = self._batch_changes(rows, inserted, existing, rated_at)
+        for chunk in _chunks(updates):
+            await self.db.execute(self._rating_upsert_query(dialect, chunk, update=True))
+        for chunk in _chunks(changed):
+            await self.db.execute(self._change_log_query(chunk))
+
+        stats = []
+        for chunk in _chunks(deltas):
+            stats.extend((await self.db.execute(self._stats_upsert_query(dialect, chunk))).all())
+        return summary, stats
+
+    async def record_rating_stats(
+        self,
+        perfume_id: int,
+        rate_delta: int,
+        count_delta: int = 1,
+        rated_at: Optional[datetime] = None
+    ) -> Tuple:
+        # count_delta=0 - изменение существующей оценки: меняется только сумма
+        delta = self._stats_delta(perfume_id, rate_delta, count_delta, rated_at or datetime.now())
+        return (await self.db.execute(self._stats_upsert_query(self.db.get_bind().dialect.name, [delta]))).one()
@@ -1,36 +1,104 @@
+import asyncio
+from typing import Iterable, List
 from auth.user_service import get_current_user
 from users.models import Users
-from ratings.schemas import RatingCreate, RatingExistsException, RatingResponse
-from db.connection import get_db
-from ratings.models import Ratings
-from sqlalchemy.orm import Session
-from fastapi import APIRouter, Depends, HTTPException, status
+from ratings.schemas import (
+    MAX_RATE, MIN_RATE, RatingBatchCreate, RatingBatchResponse, RatingCreate, RatingResponse
+)
+from db.connection import get_async_db
+from ratings.ratings_dao import AsyncRatingDAO
+from ratings.rating_queue import RatingQueueFullError
+from services.recomendation_service.engine import RecommendationEngine, get_recommendation_engine
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 
 ratings_router = APIRouter(prefix='/ratings', tags=['ratings'])
 
+
+def _queue_full() -> HTTPException:
+    # очередь отложенной записи переполнена: БД не принимает пачки - клиент повторит позже
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail='Оценки временно не принимаются, повторите позже',
+        headers={'Retry-After': '5'}
+    )
+
+
+async def _unknown_perfumes(engine: RecommendationEngine, perfume_ids: Iterable[int]) -> List[int]:
+    # id, которых нет в каталоге в памяти. Каталог обновляется фоновым тиком и мог отстать -
+    # при промахе он сверяется со счётчиком изменений в БД (один запрос) и проверка повторяется
+    catalog = engine.catalog.current
+    unknown = sorted({perfume_id for perfume_id in perfume_ids if perfume_id not in catalog})
+    if unknown and await asyncio.to_thread(engine.catalog.refresh_if_changed):
+        catalog = engine.catalog.current
+        unknown = [perfume_id for perfume_id in unknown if perfume_id not in catalog]
+    return unknown
+
+
 @ratings_router.post('/rate/{perfume_id}', response_model=RatingResponse)
 async def rate_perfume(
     perfume_id: int, 
-    rate: int, 
-    db: Session = Depends(get_db), 
-    current_user: Users = Depends(get_current_user) 
+    rate: int = Query(..., ge=MIN_RATE, le=MAX_RATE),
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Users = Depends(get_current_user),
+    engine: RecommendationEngine = Depends(get_recommendation_engine)
 ):
+    # неизвестный парфюм - 404 до записи: в очереди отложенной записи такая оценка не прошла бы внешний ключ
+    if await _unknown_perfumes(engine, [perfume_id]):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='Парфюм не найден')
+
+    # Повторная оценка парфюма заменяет прежнюю - одинаково при записи в запросе и отложенной
+    # (очередь не может проверить наличие оценки без запроса к БД)
+    if engine.rating_queue is not None:
+        # отложенная запись: оценка в журнале, в БД - пачкой
+        try:
+            engine.rating_queue.submit(current_user.id, perfume_id, rate)
+        except RatingQueueFullError:
+            raise _queue_full()
+        return RatingResponse(user_id=current_user.id, perfume_id=perfume_id, rate=rate, comment=None)
 
-    rating_exists = db.query(Ratings).filter(
-        Ratings.user_id == current_user.id,
-        Ratings.perfume_id == perfume_id 
-    ).first()
-    
-    if rating_exists:
-        raise RatingExistsException()
-
-    new_rating = Ratings(
-        rate=rate,
-        user_id=current_user.id,
-        perfume_id=perfume_id 
+    # upsert оценки, журнал изменений и агрегаты парфюма - в одной транзакции
+    summary, perfume_stats = await AsyncRatingDAO(db).upsert_many([(current_user.id, perfume_id, rate)])
+    await db.commit()
+
+    # рекомендации пользователя после новой или изменённой оценки пересчитываются
+    if summary['inserted'] or summary['updated']:
+        engine.invalidate_user(current_user.id)
+    for row in perfume_stats:
+        engine.perfume_stats.apply(row)
+    return RatingResponse(user_id=current_user.id, perfume_id=perfume_id, rate=rate, comment=None)
+
+@ratings_router.post('/batch', response_model=RatingBatchResponse)
+async def rate_perfumes_batch(
+    batch: RatingBatchCreate,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Users = Depends(get_current_user),
+    engine: RecommendationEngine = Depends(get_recommendation_engine)
+):
+    # Пачка оценок текущего пользователя (онбординг, импорт): новые вставляются, существующие
+    # перезаписываются многострочным INSERT ... ON CONFLICT, агрегаты - одним upsert на пачку.
+    # Неизвестный парфюм - 422 до записи, а не ошибка внешнего ключа на всю пачку
+    unknown = await _unknown_perfumes(engine, (item.perfume_id for item in batch.ratings))
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f'Парфюмы не найдены: {", ".join(map(str, unknown))}'
+        )
+
+    if engine.rating_queue is not None:
+        try:
+            engine.rating_queue.submit_many((current_user.id, item.perfume_id, item.rate) for item in batch.ratings)
+        except RatingQueueFullError:
+            raise _queue_full()
+        return RatingBatchResponse(inserted=0, updated=0, unchanged=0, queued=len(batch.ratings))
+
+    summary, perfume_stats = await AsyncRatingDAO(db).upsert_many(
+        (current_user.id, item.perfume_id, item.rate) for item in batch.ratings
     )
-    
-    db.add(new_rating)
-    db.commit()
-    db.refresh(new_rating)
-    return new_rating
\ No newline at end of file
+    await db.commit()
+
+    if summary['inserted'] or summary['updated']:
+        engine.invalidate_user(current_user.id)
+    for row in perfume_stats:
+        engine.perfume_stats.apply(row)
+    return RatingBatchResponse(**summary)
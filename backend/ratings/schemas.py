@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional
 from pydantic import BaseModel, Field
 
 
@@ -24,5 +24,28 @@ class RatingResponse(Rating):
 class RatingDelete(Rating):
     ...
 
+# оценок в одном запросе POST /ratings/batch
+MAX_BATCH_RATINGS = 10000
+# шкала оценок: вне её значение исказило бы сумму, среднее и популярность парфюма
+MIN_RATE = 1
+MAX_RATE = 5
+
+
+class RatingBatchItem(BaseModel):
+    perfume_id : int = Field(...)
+    rate : int = Field(..., ge=MIN_RATE, le=MAX_RATE)
+
+
+class RatingBatchCreate(BaseModel):
+    ratings : List[RatingBatchItem] = Field(..., min_length=1, max_length=MAX_BATCH_RATINGS)
+
+
+class RatingBatchResponse(BaseModel):
+    inserted : int = Field(...)
+    updated : int = Field(...)
+    unchanged : int = Field(...)   # оценка в пачке совпала с уже сохранённой
+    queued : int = Field(default=0)   # принято в журнал отложенной записи, в БД - позже
+
+
 class RatingExistsException(BaseException):
     message: str = 'Парфюм уже оценен :('
\ No newline at end of file
@@ -0,0 +1,71 @@
+from typing import List
+from auth.user_service import get_current_admin, get_current_user, is_admin
+from recommendations.schemas import (
+    MAX_TOP_N, BatchRecommendationRequest, BatchRecommendationResponse, RecommendationResponse
+)
+from services.recomendation_service.engine import RecommendationEngine, get_recommendation_engine
+from users.models import Users
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+
+
+recommendations_router = APIRouter(prefix='/recommendations', tags=['recommendations'])
+
+@recommendations_router.get('/', response_model=List[RecommendationResponse])
+async def get_recommendations(
+    strategy : str = 'item_based_cf',
+    top_n : int = Query(10, ge=1, le=MAX_TOP_N),
+    current_user : Users = Depends(get_current_user),
+    engine : RecommendationEngine = Depends(get_recommendation_engine)
+):
+    # вычисление идёт в пуле рекомендаций, цикл событий остаётся свободным
+    recommendations = await engine.recommend_async(strategy, current_user.id, top_n=top_n)
+    return [item.to_dict() for item in recommendations]
+
+@recommendations_router.get('/similar/{perfume_id}', response_model=List[RecommendationResponse])
+async def get_similar_perfumes(
+    perfume_id : int,
+    top_n : int = Query(10, ge=1, le=MAX_TOP_N),
+    engine : RecommendationEngine = Depends(get_recommendation_engine)
+):
+    similar = await engine.similar_perfumes_async(perfume_id, top_n=top_n)
+    return [item.to_dict() for item in similar]
+
+
+@recommendations_router.post('/batch', response_model=BatchRecommendationResponse)
+async def get_batch_recommendations(
+    batch : BatchRecommendationRequest,
+    current_user : Users = Depends(get_current_user),
+    engine : RecommendationEngine = Depends(get_recommendation_engine)
+):
+    # рекомендации других пользователей - только администратору
+    if not is_admin(current_user) and any(user_id != current_user.id for user_id in batch.user_ids):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail='Можно запрашивать рекомендации только для себя'
+        )
+
+    results = await engine.recommend_many_async(batch.strategy, batch.user_ids, top_n=batch.top_n)
+    return {
+        'strategy': batch.strategy,
+        'results': {
+            user_id: [item.to_dict() for item in items]
+            for user_id, items in results.items()
+        }
+    }
+
+
+@recommendations_router.get('/cache/stats')
+async def get_cache_stats(
+    current_user : Users = Depends(get_current_admin),
+    engine : RecommendationEngine = Depends(get_recommendation_engine)
+):
+    return engine.result_cache.stats()
+
+
+@recommendations_router.get('/hybrid/stats')
+async def get_hybrid_stats(
+    current_user : Users = Depends(get_current_admin),
+    engine : RecommendationEngine = Depends(get_recommendation_engine)
+):
+    # перцентили времени и число таймаутов стратегий гибрида
+    return engine.hybrid_stats()
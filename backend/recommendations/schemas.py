@@ -0,0 +1,27 @@
+from typing import Any, Dict, List, Optional
+from pydantic import BaseModel, Field
+
+
+class Recommendation(BaseModel):
+    perfume_id : int = Field(...)
+    score : float = Field(...)
+    confidence : float = Field(...)
+    explanation : Optional[Dict[str, Any]] = None
+
+class RecommendationResponse(Recommendation):
+    ...
+
+
+# пользователей в одном запросе POST /recommendations/batch
+MAX_BATCH_USERS = 1000
+# рекомендаций на пользователя в одном ответе
+MAX_TOP_N = 100
+
+class BatchRecommendationRequest(BaseModel):
+    user_ids : List[int] = Field(..., min_length=1, max_length=MAX_BATCH_USERS)
+    strategy : str = Field(default='item_based_cf')
+    top_n : int = Field(default=10, ge=1, le=MAX_TOP_N)
+
+class BatchRecommendationResponse(BaseModel):
+    strategy : str = Field(...)
+    results : Dict[int, List[RecommendationResponse]] = Field(...)
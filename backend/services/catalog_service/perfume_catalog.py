@@ -0,0 +1,208 @@
+import logging
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from db.connection import SessionLocal
+from perfumes.perfumes_dao import PerfumeDAO
+from services.recomendation_service.feature_matrix import PerfumeFeatureMatrix, build_perfume_feature_matrix
+from services.recomendation_service.id_mapping import IdMapping
+
+logger = logging.getLogger(__name__)
+
+
+def _encode(values: List[Any]) -> Tuple[np.ndarray, List[Any]]:
+    # строковые значения -> int32 коды и словарь значений
+    vocabulary: Dict[Any, int] = {}
+    codes = np.fromiter(
+        (vocabulary.setdefault(value, len(vocabulary)) for value in values),
+        dtype=np.int32, count=len(values)
+    )
+    return codes, list(vocabulary)
+
+
+@dataclass(frozen=True)
+class PerfumeCatalog:
+    # Неизменяемый каталог парфюмов в массивах: строка i - парфюм perfume_mapping.ids[i].
+    # Бренд, концентрация и ноты хранятся кодами (int32) + словарями значений,
+    # ноты парфюма - срез note_codes[note_indptr[i]:note_indptr[i + 1]]
+    perfume_mapping: IdMapping
+    names: List[str]
+    prices: np.ndarray
+    brand_codes: np.ndarray
+    brands: List[str]
+    concentration_codes: np.ndarray
+    concentrations: List[str]
+    note_indptr: np.ndarray
+    note_codes: np.ndarray
+    note_type_codes: np.ndarray
+    notes: List[str]
+    note_types: List[str]
+    signature: Optional[Tuple] = None
+    # производные структуры (словари признаков, матрица признаков) живут вместе с каталогом
+    _cache: Dict[str, Any] = field(default_factory=dict, repr=False, compare=False)
+    _cache_lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict[str, Any]], signature: Optional[Tuple] = None) -> 'PerfumeCatalog':
+        # rows - словари PerfumeDAO.get_feature_rows(), отсортированные по id
+        rows = list(rows)
+        brand_codes, brands = _encode([row['brand'] for row in rows])
+        concentration_codes, concentrations = _encode([row['intensity'] for row in rows])
+
+        note_counts = [sum(len(names) for names in row['notes'].values()) for row in rows]
+        note_indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        note_indptr[1:] = np.cumsum(note_counts)
+
+        note_pairs = [
+            (note_type, note_name)
+            for row in rows
+            for note_type, names in row['notes'].items()
+            for note_name in names
+        ]
+        note_type_codes, note_types = _encode([note_type for note_type, _ in note_pairs])
+        note_codes, notes = _encode([note_name for _, note_name in note_pairs])
+
+        return cls(
+            perfume_mapping=IdMapping(np.array([row['id'] for row in rows], dtype=np.int64)),
+            names=[row.get('name') for row in rows],
+            prices=np.array([row['price'] or 0.0 for row in rows], dtype=np.float32),
+            brand_codes=brand_codes,
+            brands=brands,
+            concentration_codes=concentration_codes,
+            concentrations=concentrations,
+            note_indptr=note_indptr,
+            note_codes=note_codes,
+            note_type_codes=note_type_codes,
+            notes=notes,
+            note_types=note_types,
+            signature=signature
+        )
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.perfume_mapping.ids
+
+    def __len__(self) -> int:
+        return len(self.perfume_mapping)
+
+    def __contains__(self, perfume_id) -> bool:
+        return perfume_id in self.perfume_mapping
+
+    def row_of(self, perfume_id: int) -> Optional[int]:
+        return self.perfume_mapping.get(perfume_id)
+
+    def features_at(self, row: int) -> Dict[str, Any]:
+        notes: Dict[str, List[str]] = {}
+        start, end = self.note_indptr[row], self.note_indptr[row + 1]
+        for note_type, note in zip(self.note_type_codes[start:end], self.note_codes[start:end]):
+            notes.setdefault(self.note_types[note_type], []).append(self.notes[note])
+
+        return {
+            'id': int(self.perfume_mapping.ids[row]),
+            'name': self.names[row],
+            'price': float(self.prices[row]),
+            'brand': self.brands[self.brand_codes[row]],
+            'intensity': self.concentrations[self.concentration_codes[row]],
+            'notes': notes
+        }
+
+    def get(self, perfume_id: int) -> Optional[Dict[str, Any]]:
+        row = self.row_of(perfume_id)
+        return None if row is None else self.all()[row]
+
+    def all(self) -> List[Dict[str, Any]]:
+        # словари признаков собираются один раз на версию каталога
+        return self.get_or_compute('rows', lambda: [self.features_at(row) for row in range(len(self))])
+
+    def feature_matrix(self) -> PerfumeFeatureMatrix:
+        return self.get_or_compute('feature_matrix', lambda: build_perfume_feature_matrix(self.all()))
+
+    def get_or_compute(self, key: str, factory: Callable[[], Any]) -> Any:
+        if key in self._cache:
+            return self._cache[key]
+
+        with self._cache_lock:
+            if key not in self._cache:
+                self._cache[key] = factory()
+            return self._cache[key]
+
+    def updated(self, rows: Iterable[Dict[str, Any]], signature: Optional[Tuple] = None) -> 'PerfumeCatalog':
+        # новый каталог, в котором строки rows заменены или добавлены; остальные - без запросов к БД
+        changed = {row['id']: row for row in rows}
+        merged = [changed.pop(row['id'], row) for row in self.all()]
+        merged.extend(changed[perfume_id] for perfume_id in sorted(changed))
+        return PerfumeCatalog.from_rows(merged, signature)
+
+
+class PerfumeCatalogService:
+    # Процессный каталог парфюмов. Текущая версия подменяется одним присваиванием,
+    # поэтому запрос, уже получивший каталог, дорабатывает на нём
+    def __init__(self, session_factory=SessionLocal):
+        self._session_factory = session_factory
+        self._catalog: Optional[PerfumeCatalog] = None
+        self._lock = threading.Lock()
+
+    @property
+    def current(self) -> PerfumeCatalog:
+        catalog = self._catalog
+        if catalog is None:
+            with self._lock:
+                if self._catalog is None:
+                    self._catalog = self._load()
+                catalog = self._catalog
+        return catalog
+
+    def invalidate(self, perfume_ids: Optional[Iterable[int]] = None):
+        # перечитать только изменённые парфюмы или, без perfume_ids, весь каталог
+        with self._lock:
+            if perfume_ids is None or self._catalog is None:
+                self._catalog = self._load()
+                return
+
+            db = self._session_factory()
+            try:
+                dao = PerfumeDAO(db)
+                perfume_ids = list(perfume_ids)
+                rows = dao.get_feature_rows(perfume_ids)
+                found = {row['id'] for row in rows}
+
+                if any(perfume_id not in found and perfume_id in self._catalog for perfume_id in perfume_ids):
+                    # парфюм удалён - строки каталога сдвигаются, перечитываем целиком
+                    self._catalog = self._load(db)
+                else:
+                    self._catalog = self._catalog.updated(rows, dao.get_catalog_signature())
+            finally:
+                db.close()
+
+    def refresh_if_changed(self) -> bool:
+        # вызывается периодически: сравниваем счётчик изменений каталога, сами парфюмы не читаем.
+        # Счётчик не говорит, что именно изменилось, - при изменении каталог перечитывается целиком
+        catalog = self._catalog
+        if catalog is None:
+            return False
+
+        db = self._session_factory()
+        try:
+            if PerfumeDAO(db).get_catalog_signature() == catalog.signature:
+                return False
+
+            with self._lock:
+                self._catalog = self._load(db)
+            return True
+        finally:
+            db.close()
+
+    def _load(self, db=None) -> PerfumeCatalog:
+        own_session = db is None
+        db = db or self._session_factory()
+        try:
+            dao = PerfumeDAO(db)
+            signature = dao.get_catalog_signature()
+            catalog = PerfumeCatalog.from_rows(dao.get_feature_rows(), signature)
+        finally:
+            if own_session:
+                db.close()
+
+        logger.info(f'Каталог парфюмов загружен: {len(catalog)} парфюмов, {len(catalog.notes)} нот')
+        return catalog
@@ -0,0 +1,237 @@
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from services.catalog_service.perfume_catalog import PerfumeCatalog
+
+DEFAULT_FACET_LIMIT = 20
+# Разделитель слоя и ноты в фильтре: «top:жасмин»; без слоя - нота в любом слое
+NOTE_TYPE_SEPARATOR = ':'
+
+
+@dataclass(frozen=True)
+class FacetQuery:
+    # Ноты: all_notes - все (AND), any_notes - хотя бы одна (OR), exclude_notes - ни одной (NOT).
+    # Бренды и концентрации - любое из перечисленных значений; цена - границы включительно
+    all_notes: Tuple[str, ...] = ()
+    any_notes: Tuple[str, ...] = ()
+    exclude_notes: Tuple[str, ...] = ()
+    brands: Tuple[str, ...] = ()
+    concentrations: Tuple[str, ...] = ()
+    price_min: Optional[float] = None
+    price_max: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class FacetResult:
+    total: int
+    perfume_ids: List[int]
+    # группа -> [(значение, число парфюмов)] по убыванию числа
+    facets: Dict[str, List[Tuple[str, int]]] = field(default_factory=dict)
+
+
+class PerfumeFacetIndex:
+    # Фасетный фильтр каталога в памяти: по битовому множеству (uint64-слова, бит i - строка i)
+    # на каждую пару (слой, нота), ноту в любом слое, бренд и концентрацию, плюс массив цен.
+    # Запрос - несколько векторных AND/OR/ANDNOT над n/64 словами, без JOIN по нотам в БД.
+    # Один индекс на версию каталога
+    def __init__(self, catalog: PerfumeCatalog):
+        self.catalog = catalog
+        n_rows = len(catalog)
+        self.n_words = (n_rows + 63) // 64
+
+        self.all_bits = np.zeros(self.n_words, dtype='<u8')
+        if n_rows:
+            self.all_bits[:] = np.uint64(0xFFFFFFFFFFFFFFFF)
+            if n_rows % 64:
+                self.all_bits[-1] = np.uint64((1 << (n_rows % 64)) - 1)
+
+        # справочники без учёта регистра: значение фильтра -> код каталога
+        self.brand_codes = {brand.lower(): code for code, brand in enumerate(catalog.brands)}
+        self.concentration_codes = {title.lower(): code for code, title in enumerate(catalog.concentrations)}
+        self.note_codes = {note.lower(): code for code, note in enumerate(catalog.notes)}
+        self.note_type_codes = {note_type.lower(): code for code, note_type in enumerate(catalog.note_types)}
+
+        self.brand_bits = self._bitsets(catalog.brand_codes, np.arange(n_rows), len(catalog.brands))
+        self.concentration_bits = self._bitsets(
+            catalog.concentration_codes, np.arange(n_rows), len(catalog.concentrations)
+        )
+
+        # строка каталога для каждой записи ноты; ключ пары (слой, нота) = слой * число нот + нота
+        self.note_rows = np.repeat(np.arange(n_rows), np.diff(catalog.note_indptr))
+        pair_keys = catalog.note_type_codes.astype(np.int64) * len(catalog.notes) + catalog.note_codes
+        self.note_pairs, self.note_pair_keys = np.unique(pair_keys, return_inverse=True)
+        self.note_pair_keys = self.note_pair_keys.reshape(-1)
+        self.note_pair_bits = self._bitsets(self.note_pair_keys, self.note_rows, len(self.note_pairs))
+        self.note_bits = self._bitsets(catalog.note_codes, self.note_rows, len(catalog.notes))
+
+        self.note_indptr = catalog.note_indptr
+
+        # количества по всему каталогу - база для подсчёта фасетов по дополнению
+        self.brand_totals = np.bincount(catalog.brand_codes, minlength=len(catalog.brands))
+        self.concentration_totals = np.bincount(catalog.concentration_codes, minlength=len(catalog.concentrations))
+        self.note_pair_totals = np.bincount(self.note_pair_keys, minlength=len(self.note_pairs))
+
+    @classmethod
+    def of(cls, catalog: PerfumeCatalog) -> 'PerfumeFacetIndex':
+        return catalog.get_or_compute('facet_index', lambda: cls(catalog))
+
+    def _bitsets(self, keys: np.ndarray, rows: np.ndarray, n_keys: int) -> np.ndarray:
+        # битовые множества строк по ключам: bits[k] - строки с ключом k
+        bits = np.zeros((n_keys, self.n_words), dtype='<u8')
+        rows = np.asarray(rows, dtype=np.uint64)
+        np.bitwise_or.at(
+            bits,
+            (np.asarray(keys, dtype=np.int64), (rows >> np.uint64(6)).astype(np.int64)),
+            np.left_shift(np.uint64(1), rows & np.uint64(63))
+        )
+        return bits
+
+    def _unpack(self, bits: np.ndarray) -> np.ndarray:
+        return np.unpackbits(bits.view(np.uint8), bitorder='little')[:len(self.catalog)].astype(bool)
+
+    def _note(self, value: str) -> Optional[np.ndarray]:
+        # «слой:нота» или «нота»; неизвестная нота - None
+        value = value.strip().lower()
+        note_type, separator, note = value.partition(NOTE_TYPE_SEPARATOR)
+        if separator and note_type.strip() in self.note_type_codes:
+            note_code = self.note_codes.get(note.strip())
+            if note_code is None:
+                return None
+            pair_key = self.note_type_codes[note_type.strip()] * len(self.catalog.notes) + note_code
+            position = np.searchsorted(self.note_pairs, pair_key)
+            if position == len(self.note_pairs) or self.note_pairs[position] != pair_key:
+                return None
+            return self.note_pair_bits[position]
+
+        note_code = self.note_codes.get(value)
+        return None if note_code is None else self.note_bits[note_code]
+
+    def _any_of(self, bitsets: np.ndarray, codes: Dict[str, int], values: Tuple[str, ...]) -> np.ndarray:
+        # OR по значениям группы; неизвестные значения ничего не добавляют
+        result = np.zeros(self.n_words, dtype='<u8')
+        for value in values:
+            code = codes.get(value.strip().lower())
+            if code is not None:
+                result |= bitsets[code]
+        return result
+
+    def _pack(self, selected: np.ndarray) -> np.ndarray:
+        padded = np.zeros(self.n_words * 64, dtype=bool)
+        padded[:len(selected)] = selected
+        return np.packbits(padded, bitorder='little').view('<u8')
+
+    def _price_range(self, price_min: Optional[float], price_max: Optional[float]) -> np.ndarray:
+        # одно векторное сравнение по массиву цен каталога
+        prices = self.catalog.prices
+        selected = np.ones(len(prices), dtype=bool)
+        if price_min is not None:
+            selected &= prices >= price_min
+        if price_max is not None:
+            selected &= prices <= price_max
+        return self._pack(selected)
+
+    def _note_entries(self, rows: np.ndarray) -> np.ndarray:
+        # ключи пар (слой, нота) у строк rows - срезы CSR, O(нот этих строк)
+        starts, ends = self.note_indptr[rows], self.note_indptr[rows + 1]
+        counts = ends - starts
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.note_pair_keys[np.repeat(starts, counts) + offsets]
+
+    def _counts(self, selected: np.ndarray, keys_of: Callable[[np.ndarray], np.ndarray], full: np.ndarray) -> np.ndarray:
+        # число строк по ключам; если выбрано больше половины каталога - по дополнению:
+        # всего по каталогу минус невыбранные, работа не больше min(выбрано, не выбрано)
+        rows = np.flatnonzero(selected)
+        if len(rows) * 2 <= len(selected):
+            return np.bincount(keys_of(rows), minlength=len(full))
+        return full - np.bincount(keys_of(np.flatnonzero(~selected)), minlength=len(full))
+
+    def _masks(self, query: FacetQuery) -> Dict[str, np.ndarray]:
+        # битовое множество каждой группы условий; пересечение всех - результат запроса
+        masks: Dict[str, np.ndarray] = {}
+
+        if query.all_notes or query.any_notes or query.exclude_notes:
+            notes = self.all_bits.copy()
+            for value in query.all_notes:
+                bits = self._note(value)
+                if bits is None:
+                    notes[:] = 0
+                    break
+                notes &= bits
+            if query.any_notes:
+                any_notes = np.zeros(self.n_words, dtype='<u8')
+                for value in query.any_notes:
+                    bits = self._note(value)
+                    if bits is not None:
+                        any_notes |= bits
+                notes &= any_notes
+            for value in query.exclude_notes:
+                bits = self._note(value)
+                if bits is not None:
+                    notes &= ~bits
+            masks['note'] = notes
+
+        if query.brands:
+            masks['brand'] = self._any_of(self.brand_bits, self.brand_codes, query.brands)
+        if query.concentrations:
+            masks['concentration'] = self._any_of(
+                self.concentration_bits, self.concentration_codes, query.concentrations
+            )
+        if query.price_min is not None or query.price_max is not None:
+            masks['price'] = self._price_range(query.price_min, query.price_max)
+        return masks
+
+    def _intersect(self, masks: Dict[str, np.ndarray], skip: Optional[str] = None) -> np.ndarray:
+        result = self.all_bits.copy()
+        for name, bits in masks.items():
+            if name != skip:
+                result &= bits
+        return result
+
+    def _top_counts(self, counts: np.ndarray, labels, facet_limit: int) -> List[Tuple[str, int]]:
+        order = np.lexsort((np.arange(len(counts)), -counts))[:facet_limit]
+        return [(labels(int(code)), int(counts[code])) for code in order if counts[code] > 0]
+
+    def filter(
+        self,
+        query: FacetQuery,
+        limit: int = 50,
+        offset: int = 0,
+        facet_limit: int = DEFAULT_FACET_LIMIT,
+        with_facets: bool = True
+    ) -> FacetResult:
+        # ID парфюмов (по возрастанию) и количества по фасетам. Количества бренда и концентрации
+        # считаются без условия своей группы - видно, сколько даст выбор ещё одного значения
+        masks = self._masks(query)
+        result = self._intersect(masks)
+        selected = self._unpack(result)
+        rows = np.flatnonzero(selected)
+        perfume_ids = self.catalog.ids[rows[offset:offset + limit]].tolist()
+        if not with_facets:
+            return FacetResult(total=len(rows), perfume_ids=perfume_ids)
+
+        catalog = self.catalog
+        facets = {}
+        for name, codes, labels, totals in (
+            ('brand', catalog.brand_codes, catalog.brands, self.brand_totals),
+            ('concentration', catalog.concentration_codes, catalog.concentrations, self.concentration_totals),
+        ):
+            group_selected = self._unpack(self._intersect(masks, skip=name)) if name in masks else selected
+            counts = self._counts(group_selected, codes.__getitem__, totals)
+            facets[name] = self._top_counts(counts, labels.__getitem__, facet_limit)
+
+        # ноты - по записям нот найденных парфюмов, ключ - пара (слой, нота)
+        counts = self._counts(selected, self._note_entries, self.note_pair_totals)
+        n_notes = len(catalog.notes)
+        facets['note'] = self._top_counts(
+            counts,
+            lambda position: (
+                f'{catalog.note_types[self.note_pairs[position] // n_notes]}'
+                f'{NOTE_TYPE_SEPARATOR}{catalog.notes[self.note_pairs[position] % n_notes]}'
+            ),
+            facet_limit
+        )
+        return FacetResult(total=len(rows), perfume_ids=perfume_ids, facets=facets)
+
+
+def filter_perfumes(catalog: PerfumeCatalog, query: FacetQuery, **kwargs) -> FacetResult:
+    return PerfumeFacetIndex.of(catalog).filter(query, **kwargs)
@@ -0,0 +1,134 @@
+from functools import cached_property
+from typing import Iterable, List, Optional, Set
+import numpy as np
+from services.catalog_service.perfume_catalog import PerfumeCatalog
+
+# Признаки, по которым выборку можно расслоить
+SAMPLER_STRATA = ('brand', 'concentration')
+# Попыток отбора на один парфюм до перехода на явное дополнение (пользователь оценил почти всё)
+REJECTION_ATTEMPTS = 16
+
+
+def _sample_rows(
+        rows: Optional[np.ndarray],
+        n_rows: int,
+        rated: Set[int],
+        n: int,
+        rng: np.random.Generator,
+        chosen: Set[int]
+) -> List[int]:
+    # Отбор с отклонением: случайная позиция, пропуск оценённых и уже выбранных - O(n) при
+    # небольшой доле оценённых. Если попытки кончились, выбираем из явного дополнения (O(n_rows))
+    picked = []
+    attempts = 0
+    while len(picked) < n and attempts < n * REJECTION_ATTEMPTS:
+        attempts += 1
+        position = int(rng.integers(n_rows))
+        row = position if rows is None else int(rows[position])
+        if row in rated or row in chosen:
+            continue
+        chosen.add(row)
+        picked.append(row)
+
+    if len(picked) < n:
+        candidates = np.arange(n_rows) if rows is None else rows
+        blocked = np.fromiter(rated | chosen, dtype=np.int64, count=len(rated | chosen))
+        remaining = candidates[~np.isin(candidates, blocked)]
+        extra = rng.choice(remaining, size=min(n - len(picked), len(remaining)), replace=False).tolist()
+        chosen.update(extra)
+        picked.extend(extra)
+
+    return picked
+
+
+class PerfumeSampler:
+    # Случайные неоценённые парфюмы для онбординга без сортировки каталога в БД.
+    # Каталог уже в памяти (строки 0..n-1), оценки пользователя - множество строк.
+    # Один экземпляр на версию каталога: слои (бренд, концентрация) строятся один раз
+    def __init__(self, catalog: PerfumeCatalog):
+        self.catalog = catalog
+
+    @classmethod
+    def of(cls, catalog: PerfumeCatalog) -> 'PerfumeSampler':
+        return catalog.get_or_compute('sampler', lambda: cls(catalog))
+
+    @cached_property
+    def _strata(self) -> dict:
+        # слой -> (indptr, строки): строки слоя k - rows[indptr[k]:indptr[k + 1]]
+        strata = {}
+        for name, codes in (('brand', self.catalog.brand_codes), ('concentration', self.catalog.concentration_codes)):
+            order = np.argsort(codes, kind='stable')
+            indptr = np.zeros(codes.max(initial=-1) + 2, dtype=np.int64)
+            indptr[1:] = np.cumsum(np.bincount(codes, minlength=len(indptr) - 1))
+            strata[name] = (indptr, order)
+        return strata
+
+    def rated_rows(self, perfume_ids: Iterable[int]) -> Set[int]:
+        # оценённые парфюмы, которых нет в каталоге (удалены, ещё не подгружены), не мешают выборке
+        rows = self.catalog.perfume_mapping.indices_of(list(perfume_ids))
+        return set(rows[rows >= 0].tolist())
+
+    def sample(
+            self,
+            rated_perfume_ids: Iterable[int],
+            n: int = 5,
+            stratify: Optional[str] = None,
+            rng: Optional[np.random.Generator] = None
+    ) -> List[int]:
+        # до n ID неоценённых парфюмов в случайном порядке; stratify - по одному из разных брендов/концентраций
+        if stratify is not None and stratify not in SAMPLER_STRATA:
+            raise ValueError(f'Неизвестный признак для расслоения: {stratify}')
+
+        rng = rng or np.random.default_rng()
+        rated = self.rated_rows(rated_perfume_ids)
+        n = min(n, len(self.catalog) - len(rated))
+        if n <= 0:
+            return []
+
+        chosen: Set[int] = set()
+        if stratify is None:
+            rows = _sample_rows(None, len(self.catalog), rated, n, rng, chosen)
+        else:
+            rows = self._sample_stratified(stratify, rated, n, rng, chosen)
+        return self.catalog.ids[rows].tolist()
+
+    def _sample_stratified(
+            self,
+            stratify: str,
+            rated: Set[int],
+            n: int,
+            rng: np.random.Generator,
+            chosen: Set[int]
+    ) -> List[int]:
+        # Случайный слой, из него - один случайный неоценённый парфюм; слои не повторяются,
+        # пока не пройдены все, затем - следующий круг
+        indptr, order = self._strata[stratify]
+        n_strata = len(indptr) - 1
+
+        picked = []
+        exhausted: Set[int] = set()
+        # пройденные в текущем круге слои и исчерпанные слои
+        blocked: Set[int] = set()
+        while len(picked) < n and len(exhausted) < n_strata:
+            if len(blocked) >= n_strata:
+                blocked = set(exhausted)
+
+            stratum, = _sample_rows(None, n_strata, blocked, 1, rng, set())
+            blocked.add(stratum)
+            rows = order[indptr[stratum]:indptr[stratum + 1]]
+            row = _sample_rows(rows, len(rows), rated, 1, rng, chosen) if len(rows) else []
+            if row:
+                picked.extend(row)
+            else:
+                exhausted.add(stratum)
+
+        return picked
+
+
+def sample_unrated_perfumes(
+        catalog: PerfumeCatalog,
+        rated_perfume_ids: Iterable[int],
+        n: int = 5,
+        stratify: Optional[str] = None
+) -> List[int]:
+    return PerfumeSampler.of(catalog).sample(rated_perfume_ids, n, stratify)
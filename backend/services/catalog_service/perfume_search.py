@@ -0,0 +1,185 @@
+import bisect
+import math
+import re
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from services.catalog_service.perfume_catalog import PerfumeCatalog
+
+# Доля триграмм запроса, которая должна найтись в названии/бренде (как word_similarity в pg_trgm)
+DEFAULT_MIN_SIMILARITY = 0.3
+DEFAULT_SEARCH_LIMIT = 20
+# Предел кандидатов нечёткого поиска: для неизбирательного запроса порог общих триграмм
+# повышается, пока кандидатов не станет меньше, - время запроса не растёт с каталогом
+MAX_SEARCH_CANDIDATES = 20_000
+
+_SEPARATORS = re.compile(r'[^\w]+')
+
+
+def normalize(text: Optional[str]) -> str:
+    # нижний регистр, ё -> е, пунктуация -> пробел
+    return ' '.join(_SEPARATORS.sub(' ', (text or '').lower().replace('ё', 'е')).split())
+
+
+def trigrams(text: str) -> List[str]:
+    # триграммы слов, дополненных пробелами (как в pg_trgm): «  сл», « сло», ..., «во »
+    result = set()
+    for word in text.split():
+        padded = f'  {word} '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return sorted(result)
+
+
+class PerfumeSearchIndex:
+    # Поиск по названию и бренду в памяти, один индекс на версию каталога.
+    # Нечёткий поиск - инвертированный индекс триграмм: строки с нужной долей общих триграмм
+    # обязаны содержать хотя бы одну из самых редких триграмм запроса, поэтому кандидаты
+    # берутся только из их списков, а не из всего каталога. Строки, содержащие запрос подстрокой
+    # (как прежний ILIKE '%запрос%'), идут первыми: их кандидаты - пересечение списков
+    # триграмм внутри слов запроса, затем проверка вхождения.
+    # Автодополнение - бинарный поиск префикса в отсортированном списке слов и названий
+    def __init__(self, catalog: PerfumeCatalog):
+        self.catalog = catalog
+
+        documents = [
+            normalize(f'{name} {catalog.brands[brand_code]}')
+            for name, brand_code in zip(catalog.names, catalog.brand_codes.tolist())
+        ]
+
+        vocabulary: Dict[str, int] = {}
+        trigram_ids, rows = [], []
+        doc_sizes = np.zeros(len(documents), dtype=np.int32)
+        for row, document in enumerate(documents):
+            doc_trigrams = trigrams(document)
+            doc_sizes[row] = len(doc_trigrams)
+            trigram_ids.extend(vocabulary.setdefault(trigram, len(vocabulary)) for trigram in doc_trigrams)
+            rows.extend([row] * len(doc_trigrams))
+
+        # списки строк по триграммам в CSR: строки триграммы t - postings[indptr[t]:indptr[t + 1]] (по возрастанию)
+        trigram_ids = np.asarray(trigram_ids, dtype=np.int64)
+        order = np.lexsort((np.asarray(rows, dtype=np.int64), trigram_ids))
+        self.documents = documents
+        self.vocabulary = vocabulary
+        self.postings = np.asarray(rows, dtype=np.int32)[order]
+        self.indptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        self.indptr[1:] = np.cumsum(np.bincount(trigram_ids, minlength=len(vocabulary)))
+        self.doc_sizes = doc_sizes
+
+        # ключи автодополнения: слова названия и бренда, название целиком, «бренд название»
+        prefix_entries = set()
+        for row, (name, brand_code) in enumerate(zip(catalog.names, catalog.brand_codes.tolist())):
+            name, brand = normalize(name), normalize(catalog.brands[brand_code])
+            prefix_entries.update((key, row) for key in (name, brand, f'{brand} {name}', *name.split(), *brand.split()) if key)
+        prefix_entries = sorted(prefix_entries)
+        self.prefix_keys = [key for key, _ in prefix_entries]
+        self.prefix_rows = np.array([row for _, row in prefix_entries], dtype=np.int32)
+
+    @classmethod
+    def of(cls, catalog: PerfumeCatalog) -> 'PerfumeSearchIndex':
+        return catalog.get_or_compute('search_index', lambda: cls(catalog))
+
+    def _posting(self, trigram_id: int) -> np.ndarray:
+        return self.postings[self.indptr[trigram_id]:self.indptr[trigram_id + 1]]
+
+    def search(
+        self,
+        query: str,
+        limit: int = DEFAULT_SEARCH_LIMIT,
+        min_similarity: float = DEFAULT_MIN_SIMILARITY
+    ) -> List[Tuple[int, float]]:
+        # (perfume_id, сходство) по убыванию: сначала содержащие запрос подстрокой (сходство 1.0),
+        # затем нечёткие совпадения по доле найденных триграмм запроса
+        query = normalize(query)
+        if not query:
+            return []
+
+        exact_rows = self._substring_rows(query, limit)
+        results = [(int(self.catalog.ids[row]), 1.0) for row in exact_rows]
+        if len(results) < limit:
+            found = set(exact_rows)
+            results.extend(
+                (perfume_id, similarity)
+                for row, perfume_id, similarity in self._fuzzy(query, limit + len(found), min_similarity)
+                if row not in found
+            )
+        return results[:limit]
+
+    def _substring_rows(self, query: str, limit: int) -> List[int]:
+        # строки, в которых «название бренд» содержит запрос; короче документ - выше
+        inner = sorted({word[i:i + 3] for word in query.split() for i in range(len(word) - 2)})
+        if inner:
+            if any(trigram not in self.vocabulary for trigram in inner):
+                return []
+            postings = sorted((self._posting(self.vocabulary[trigram]) for trigram in inner), key=len)
+            candidates = postings[0]
+            for posting in postings[1:]:
+                candidates = np.intersect1d(candidates, posting, assume_unique=True)
+            candidates = candidates[np.lexsort((candidates, self.doc_sizes[candidates]))]
+        else:
+            # слова запроса короче триграммы - проверяется весь каталог в порядке строк
+            candidates = np.arange(len(self.documents))
+
+        rows: List[int] = []
+        for row in candidates.tolist():
+            if query in self.documents[row]:
+                rows.append(row)
+                if len(rows) >= limit:
+                    break
+        return rows
+
+    def _fuzzy(self, query: str, limit: int, min_similarity: float) -> List[Tuple[int, int, float]]:
+        # (строка, perfume_id, доля найденных триграмм запроса) по убыванию; при равенстве - ближе по длине
+        query_trigrams = trigrams(query)
+        if not query_trigrams:
+            return []
+
+        known = [self.vocabulary[trigram] for trigram in query_trigrams if trigram in self.vocabulary]
+        needed = max(1, math.ceil(min_similarity * len(query_trigrams)))
+        if len(known) < needed:
+            return []
+
+        # достаточно просмотреть len(known) - needed + 1 самых редких триграмм
+        known.sort(key=lambda trigram_id: self.indptr[trigram_id + 1] - self.indptr[trigram_id])
+        posting_sizes = np.cumsum([self.indptr[t + 1] - self.indptr[t] for t in known])
+        while needed < len(known) and posting_sizes[len(known) - needed] > MAX_SEARCH_CANDIDATES:
+            needed += 1
+        candidates = np.unique(np.concatenate([self._posting(t) for t in known[:len(known) - needed + 1]]))
+
+        shared = np.zeros(len(candidates), dtype=np.int32)
+        for trigram_id in known:
+            posting = self._posting(trigram_id)
+            positions = np.minimum(np.searchsorted(posting, candidates), len(posting) - 1)
+            shared += posting[positions] == candidates
+
+        similarity = shared / len(query_trigrams)
+        keep = shared >= needed
+        candidates, shared, similarity = candidates[keep], shared[keep], similarity[keep]
+        # сходство Жаккара для порядка при равной доле: меньше лишних триграмм - точнее совпадение
+        jaccard = shared / (len(query_trigrams) + self.doc_sizes[candidates] - shared)
+
+        top = np.lexsort((candidates, -jaccard, -similarity))[:limit]
+        return [(int(candidates[i]), int(self.catalog.ids[candidates[i]]), float(similarity[i])) for i in top]
+
+    def autocomplete(self, prefix: str, limit: int = DEFAULT_SEARCH_LIMIT) -> List[int]:
+        # ID парфюмов, у которых слово, название, бренд или «бренд название» начинается с prefix;
+        # просматривается только диапазон ключей с этим префиксом, не дальше limit парфюмов
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        start = bisect.bisect_left(self.prefix_keys, prefix)
+        end = bisect.bisect_left(self.prefix_keys, prefix + '\U0010ffff', lo=start)
+
+        perfume_ids: List[int] = []
+        seen = set()
+        # ключи читаются кусками: короткий префикс может покрывать большую часть каталога
+        while start < end and len(perfume_ids) < limit:
+            chunk = self.prefix_rows[start:min(end, start + 4 * limit)].tolist()
+            start += len(chunk)
+            for row in chunk:
+                if row in seen:
+                    continue
+                seen.add(row)
+                perfume_ids.append(int(self.catalog.ids[row]))
+                if len(perfume_ids) >= limit:
+                    break
+        return perfume_ids
@@ -0,0 +1,169 @@
+import bisect
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from db.connection import SessionLocal
+from ratings.ratings_dao import RatingDAO, decayed_popularity
+
+logger = logging.getLogger(__name__)
+
+# Порядки, в которых можно читать top-N
+STATS_RANKINGS = ('popularity', 'count', 'rating')
+# Перекрытие окна дочитывания: транзакция, зафиксированная позже соседней, всё равно попадёт в окно
+REFRESH_OVERLAP = timedelta(seconds=60)
+
+
+def _ranking_keys(perfume_id: int, row: Tuple[int, int, float, float]) -> Dict[str, Tuple]:
+    # ключи сортированных списков (по возрастанию ключа = по убыванию показателя)
+    count, _, mean, popularity = row
+    return {
+        'popularity': (-popularity, -count, perfume_id),
+        'count': (-count, -popularity, perfume_id),
+        'rating': (-mean, -count, perfume_id),
+    }
+
+
+class PerfumeStats:
+    # Агрегаты оценок парфюмов в памяти и отсортированные списки по каждому показателю.
+    # Запись оценки меняет одну строку - ключ переставляется bisect'ом; top-N читается
+    # с начала списка за O(top_n), без агрегации по таблице оценок
+    def __init__(self, rows: Iterable[Tuple] = ()):
+        self._rows: Dict[int, Tuple[int, int, float, float]] = {}
+        self._rankings: Dict[str, List[Tuple]] = {name: [] for name in STATS_RANKINGS}
+        self._lock = threading.Lock()
+        for row in rows:
+            self.set_row(*row[:5])
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, perfume_id: int) -> bool:
+        return perfume_id in self._rows
+
+    def set_row(self, perfume_id: int, rating_count: int, rating_sum: int, rating_mean: float, popularity: float):
+        # итоговые значения строки (из RETURNING или из БД) - повторное применение безопасно
+        row = (int(rating_count), int(rating_sum), float(rating_mean), float(popularity))
+        with self._lock:
+            previous = self._rows.get(perfume_id)
+            if previous == row:
+                return
+            if previous is not None:
+                for name, key in _ranking_keys(perfume_id, previous).items():
+                    ranking = self._rankings[name]
+                    del ranking[bisect.bisect_left(ranking, key)]
+
+            self._rows[perfume_id] = row
+            for name, key in _ranking_keys(perfume_id, row).items():
+                bisect.insort(self._rankings[name], key)
+
+    def top(
+        self,
+        by: str = 'popularity',
+        limit: Optional[int] = 10,
+        min_ratings: int = 1,
+        exclude: Iterable[int] = ()
+    ) -> List[int]:
+        # ID парфюмов по убыванию показателя by; пропущенные (exclude, мало оценок) не считаются в limit
+        if by not in self._rankings:
+            raise ValueError(f'Неизвестный порядок популярности: {by}')
+
+        exclude = set(exclude)
+        perfume_ids = []
+        with self._lock:
+            for key in self._rankings[by]:
+                if limit is not None and len(perfume_ids) >= limit:
+                    break
+                perfume_id = key[-1]
+                if perfume_id in exclude or self._rows[perfume_id][0] < min_ratings:
+                    continue
+                perfume_ids.append(perfume_id)
+        return perfume_ids
+
+    def get(self, perfume_id: int, at: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+        row = self._rows.get(perfume_id)
+        if row is None:
+            return None
+        count, rating_sum, mean, popularity = row
+        return {
+            'rating_count': count,
+            'rating_sum': rating_sum,
+            'rating_mean': mean,
+            'popularity': decayed_popularity(popularity, at)
+        }
+
+
+class PerfumeStatsService:
+    # Процессная копия агрегатов оценок. Свои записи применяются сразу (apply),
+    # записи других воркеров дочитываются по updated_at при refresh()
+    def __init__(self, session_factory=SessionLocal):
+        self._session_factory = session_factory
+        self._stats: Optional[PerfumeStats] = None
+        self._watermark: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    @property
+    def current(self) -> PerfumeStats:
+        stats = self._stats
+        if stats is None:
+            with self._lock:
+                if self._stats is None:
+                    self._stats = self._load()
+                stats = self._stats
+        return stats
+
+    def apply(self, row: Tuple):
+        # строка RETURNING после фиксации оценки: (perfume_id, count, sum, mean, popularity)
+        if self._stats is not None:
+            self._stats.set_row(*row[:5])
+
+    def refresh(self) -> int:
+        if self._stats is None:
+            return 0
+
+        db = self._session_factory()
+        try:
+            since = self._watermark - REFRESH_OVERLAP if self._watermark else None
+            rows = RatingDAO(db).get_rating_stats(updated_since=since)
+        finally:
+            db.close()
+
+        for row in rows:
+            self._stats.set_row(*row[:5])
+        self._advance_watermark(rows)
+        return len(rows)
+
+    def rebuild(self):
+        # пересчёт агрегатов по всей таблице оценок и перечитывание копии
+        db = self._session_factory()
+        try:
+            RatingDAO(db).rebuild_rating_stats()
+            db.commit()
+        finally:
+            db.close()
+
+        with self._lock:
+            self._watermark = None
+            self._stats = self._load()
+
+    def _load(self) -> PerfumeStats:
+        db = self._session_factory()
+        try:
+            dao = RatingDAO(db)
+            rows = dao.get_rating_stats()
+            if not rows and dao.has_ratings():
+                # таблица агрегатов появилась после оценок - заполняем один раз
+                logger.info(f'Агрегаты оценок пересчитаны: {dao.rebuild_rating_stats()} парфюмов')
+                db.commit()
+                rows = dao.get_rating_stats()
+        finally:
+            db.close()
+
+        self._advance_watermark(rows)
+        logger.info(f'Агрегаты оценок загружены: {len(rows)} парфюмов')
+        return PerfumeStats(rows)
+
+    def _advance_watermark(self, rows: List[Tuple]):
+        updated = [row[5] for row in rows if row[5] is not None]
+        if updated and (self._watermark is None or max(updated) > self._watermark):
+            self._watermark = max(updated)
@@ -0,0 +1,339 @@
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from functools import cached_property
+from pathlib import Path
+from typing import Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix
+from services.recomendation_service.id_mapping import IdMapping
+
+logger = logging.getLogger(__name__)
+
+ALS_DIR = 'als'
+ALS_FORMAT_VERSION = 1
+DEFAULT_ALS_FACTORS = 32
+DEFAULT_ALS_REGULARIZATION = 0.1
+DEFAULT_ALS_ITERATIONS = 10
+# строк в блоке решений и столбцов в блоке внешних произведений (память блока ~ размер * k² * 4 байта)
+DEFAULT_BLOCK_ROWS = 8192
+DEFAULT_BLOCK_COLUMNS = 32768
+
+_MODEL_ARRAYS = ('user_factors', 'item_factors', 'user_ids', 'item_ids', 'user_counts', 'user_fingerprints')
+
+
+def _fingerprints(rows: csr_matrix) -> Tuple[np.ndarray, np.ndarray]:
+    # число оценок и отпечаток строки: меняются при изменении любой оценки пользователя
+    counts = np.diff(rows.indptr).astype(np.int32)
+    fingerprints = rows @ np.arange(1, rows.shape[1] + 1, dtype=np.float64)
+    return counts, np.asarray(fingerprints, dtype=np.float64)
+
+
+def _outer_products(factors: np.ndarray) -> np.ndarray:
+    # vᵢvᵢᵀ для каждого столбца, развёрнутые в строку (n × k²)
+    return np.einsum('ik,il->ikl', factors, factors).reshape(len(factors), -1)
+
+
+def _solve_block(
+        rows: csr_matrix,
+        factors: np.ndarray,
+        regularization: float,
+        start: int,
+        end: int,
+        outer: Optional[np.ndarray] = None,
+        block_columns: int = DEFAULT_BLOCK_COLUMNS
+) -> np.ndarray:
+    # Регуляризованные наименьшие квадраты (ALS-WR) сразу для блока строк:
+    # (Vᵢᵀ Vᵢ + λ·nᵢ·I) xᵢ = Vᵢᵀ rᵢ. Матрицы Vᵢᵀ Vᵢ всех строк блока - одно разреженное
+    # произведение B · [vvᵀ] (B - маска оценок блока), системы решаются одним пакетным solve
+    n_factors = factors.shape[1]
+    block = rows[start:end]
+    counts = np.diff(block.indptr)
+    rated = counts > 0
+    result = np.zeros((end - start, n_factors), dtype=np.float32)
+    if not rated.any():
+        return result
+
+    mask = csr_matrix((np.ones_like(block.data), block.indices, block.indptr), shape=block.shape)
+    if outer is not None:
+        gram = mask @ outer
+    else:
+        gram = np.zeros((end - start, n_factors * n_factors), dtype=np.float32)
+        for column in range(0, block.shape[1], block_columns):
+            chunk = slice(column, column + block_columns)
+            gram += mask[:, chunk] @ _outer_products(factors[chunk])
+
+    # системы положительно определены (регуляризация), float32 достаточно
+    gram = gram[rated].reshape(-1, n_factors, n_factors)
+    diagonal = np.arange(n_factors)
+    gram[:, diagonal, diagonal] += (regularization * counts[rated]).astype(np.float32)[:, None]
+    rhs = np.asarray(block[rated] @ factors, dtype=np.float32)
+    result[rated] = np.linalg.solve(gram, rhs[..., None])[..., 0]
+    return result
+
+
+def solve_factors(
+        rows: csr_matrix,
+        factors: np.ndarray,
+        regularization: float = DEFAULT_ALS_REGULARIZATION,
+        n_threads: Optional[int] = None,
+        block_rows: int = DEFAULT_BLOCK_ROWS
+) -> np.ndarray:
+    # Один полушаг ALS: факторы строк rows при фиксированных факторах столбцов.
+    # Блоки строк решаются параллельно в потоках - SciPy/NumPy/LAPACK отпускают GIL
+    n_rows = rows.shape[0]
+    blocks = [(start, min(start + block_rows, n_rows)) for start in range(0, n_rows, block_rows)]
+    n_threads = n_threads or os.cpu_count() or 1
+    # внешние произведения столбцов считаются один раз, если помещаются в память блока
+    outer = _outer_products(factors) if len(factors) <= DEFAULT_BLOCK_COLUMNS else None
+
+    def solve(block):
+        return _solve_block(rows, factors, regularization, *block, outer=outer)
+
+    if n_threads == 1 or len(blocks) <= 1:
+        solved = [solve(block) for block in blocks]
+    else:
+        with ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix='als') as pool:
+            solved = list(pool.map(solve, blocks))
+
+    if not solved:
+        return np.zeros((0, factors.shape[1]), dtype=np.float32)
+    return np.concatenate(solved)
+
+
+@dataclass(frozen=True)
+class AlsModel:
+    # Латентные факторы: оценка = global_mean + uᵤ · vᵢ. Факторы парфюмов - float32 матрица
+    # (n_items × k), скоринг пользователя - одно произведение O(k · n_items).
+    # user_counts / user_fingerprints - оценки пользователя на момент обучения:
+    # если они изменились (или пользователя не было), его вектор считается fold-in
+    user_factors: np.ndarray
+    item_factors: np.ndarray
+    user_ids: np.ndarray
+    item_ids: np.ndarray
+    user_counts: np.ndarray
+    user_fingerprints: np.ndarray
+    global_mean: float
+    regularization: float
+    snapshot: Optional[str] = None
+
+    @property
+    def n_factors(self) -> int:
+        return self.item_factors.shape[1]
+
+    @property
+    def n_items(self) -> int:
+        return len(self.item_ids)
+
+    @cached_property
+    def user_mapping(self) -> IdMapping:
+        return IdMapping(self.user_ids, check_order=False)
+
+    @cached_property
+    def item_mapping(self) -> IdMapping:
+        return IdMapping(self.item_ids, check_order=False)
+
+    def rating_rows(self, perfume_ids: np.ndarray, ratings: np.ndarray) -> csr_matrix:
+        # оценки одного пользователя -> строка (1 × n_items) в столбцах модели
+        item_idx = self.item_mapping.indices_of(perfume_ids)
+        known = item_idx >= 0
+        order = np.argsort(item_idx[known], kind='stable')
+        return csr_matrix(
+            (np.asarray(ratings, dtype=np.float32)[known][order], item_idx[known][order], [0, int(known.sum())]),
+            shape=(1, self.n_items)
+        )
+
+    def fold_in(self, rows: csr_matrix) -> np.ndarray:
+        # факторы пользователей по их оценкам при фиксированных факторах парфюмов
+        residual = csr_matrix((rows.data - self.global_mean, rows.indices, rows.indptr), shape=rows.shape)
+        return solve_factors(residual, self.item_factors, self.regularization, n_threads=1)
+
+    def user_vectors(self, user_ids: np.ndarray, rows: csr_matrix) -> Tuple[np.ndarray, np.ndarray]:
+        # векторы пользователей: из обучения, если их оценки не менялись, иначе fold-in.
+        # Возвращает (векторы, маска пересчитанных)
+        model_idx = self.user_mapping.indices_of(user_ids)
+        counts, fingerprints = _fingerprints(rows)
+
+        trained = model_idx >= 0
+        trained[trained] &= (
+            (self.user_counts[model_idx[trained]] == counts[trained]) &
+            (self.user_fingerprints[model_idx[trained]] == fingerprints[trained])
+        )
+
+        vectors = np.empty((len(user_ids), self.n_factors), dtype=np.float32)
+        vectors[trained] = self.user_factors[model_idx[trained]]
+        if not trained.all():
+            vectors[~trained] = self.fold_in(rows[np.flatnonzero(~trained)])
+        return vectors, ~trained
+
+    def scores(self, vectors: np.ndarray) -> np.ndarray:
+        # (n_users × k) · (k × n_items)
+        return vectors @ self.item_factors.T + np.float32(self.global_mean)
+
+    def top_n(self, vectors: np.ndarray, top_n: int, exclude: Optional[csr_matrix] = None) -> Tuple[np.ndarray, np.ndarray]:
+        # top_n парфюмов для каждого вектора без полной сортировки; exclude - оценённые (исключаются)
+        scores = self.scores(vectors)
+        if exclude is not None:
+            rows = np.repeat(np.arange(exclude.shape[0]), np.diff(exclude.indptr))
+            scores[rows, exclude.indices] = -np.inf
+
+        top_n = min(top_n, self.n_items)
+        if top_n == 0:
+            return np.empty((len(vectors), 0), dtype=np.int64), np.empty((len(vectors), 0), dtype=np.float32)
+
+        top = np.argpartition(-scores, top_n - 1, axis=1)[:, :top_n]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+    def save(self, snapshot_path: Path) -> Path:
+        target = Path(snapshot_path) / ALS_DIR
+        tmp_dir = Path(snapshot_path) / f'.tmp_{ALS_DIR}_{uuid.uuid4().hex[:8]}'
+        tmp_dir.mkdir()
+
+        try:
+            for array_name in _MODEL_ARRAYS:
+                np.save(tmp_dir / f'{array_name}.npy', getattr(self, array_name))
+
+            with open(tmp_dir / 'manifest.json', 'w', encoding='utf-8') as f:
+                json.dump({
+                    'format_version': ALS_FORMAT_VERSION,
+                    'n_factors': self.n_factors,
+                    'global_mean': self.global_mean,
+                    'regularization': self.regularization,
+                    'snapshot': self.snapshot
+                }, f, ensure_ascii=False, indent=2)
+
+            os.rename(tmp_dir, target)
+
+        except OSError:
+            # модель для этого снапшота уже сохранил другой процесс
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not target.exists():
+                raise
+
+        return target
+
+    @classmethod
+    def load(cls, snapshot_path: Path) -> Optional['AlsModel']:
+        source = Path(snapshot_path) / ALS_DIR
+        manifest_path = source / 'manifest.json'
+        if not manifest_path.exists():
+            return None
+
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != ALS_FORMAT_VERSION:
+            return None
+
+        return cls(
+            **{array_name: np.load(source / f'{array_name}.npy', mmap_mode='r') for array_name in _MODEL_ARRAYS},
+            global_mean=manifest['global_mean'],
+            regularization=manifest['regularization'],
+            snapshot=manifest.get('snapshot')
+        )
+
+
+def train_als_model(
+        rating_csr_matrix: csr_matrix,
+        user_ids: np.ndarray,
+        item_ids: np.ndarray,
+        n_factors: int = DEFAULT_ALS_FACTORS,
+        regularization: float = DEFAULT_ALS_REGULARIZATION,
+        iterations: int = DEFAULT_ALS_ITERATIONS,
+        n_threads: Optional[int] = None,
+        seed: int = 0,
+        snapshot: Optional[str] = None
+) -> AlsModel:
+    # Чередующиеся наименьшие квадраты по известным оценкам (минус общее среднее):
+    # пользователи решаются по строкам CSR, парфюмы - по строкам транспонированной матрицы
+    started = time.monotonic()
+    rating_csr_matrix = rating_csr_matrix.tocsr()
+    global_mean = float(rating_csr_matrix.data.mean()) if rating_csr_matrix.nnz else 0.0
+
+    by_user = csr_matrix(
+        (np.asarray(rating_csr_matrix.data, dtype=np.float32) - global_mean,
+         rating_csr_matrix.indices, rating_csr_matrix.indptr),
+        shape=rating_csr_matrix.shape
+    )
+    by_user.sort_indices()
+    by_item = by_user.T.tocsr()
+
+    rng = np.random.default_rng(seed)
+    item_factors = (rng.standard_normal((by_user.shape[1], n_factors)) * 0.1).astype(np.float32)
+    user_factors = np.zeros((by_user.shape[0], n_factors), dtype=np.float32)
+
+    for _ in range(iterations):
+        user_factors = solve_factors(by_user, item_factors, regularization, n_threads)
+        item_factors = solve_factors(by_item, user_factors, regularization, n_threads)
+    # последний шаг по пользователям: сохранённые векторы совпадают с fold-in по тем же оценкам
+    user_factors = solve_factors(by_user, item_factors, regularization, n_threads)
+
+    # ошибка на обучающих оценках - по блокам строк, без плотной матрицы предсказаний
+    squared_error = 0.0
+    for start in range(0, by_user.shape[0], DEFAULT_BLOCK_ROWS):
+        end = min(start + DEFAULT_BLOCK_ROWS, by_user.shape[0])
+        p0, p1 = by_user.indptr[start], by_user.indptr[end]
+        users = np.repeat(np.arange(start, end), np.diff(by_user.indptr[start:end + 1]))
+        predicted = np.einsum('ij,ij->i', user_factors[users], item_factors[by_user.indices[p0:p1]])
+        squared_error += float(((by_user.data[p0:p1] - predicted) ** 2).sum())
+    rmse = np.sqrt(squared_error / max(by_user.nnz, 1))
+
+    counts, fingerprints = _fingerprints(rating_csr_matrix)
+    model = AlsModel(
+        user_factors=user_factors,
+        item_factors=item_factors,
+        user_ids=np.asarray(user_ids, dtype=np.int64),
+        item_ids=np.asarray(item_ids, dtype=np.int64),
+        user_counts=counts,
+        user_fingerprints=fingerprints,
+        global_mean=global_mean,
+        regularization=regularization,
+        snapshot=snapshot
+    )
+    logger.info(
+        f'ALS обучена за {time.monotonic() - started:.2f} с: {by_user.shape[0]} пользователей, '
+        f'{by_user.shape[1]} парфюмов, k={n_factors}, итераций {iterations}, RMSE {rmse:.4f}'
+    )
+    return model
+
+
+def load_or_train_als_model(snapshot, previous=None) -> AlsModel:
+    # snapshot - MatrixSnapshot (модель хранится в его каталоге) или MatrixManager (только в памяти).
+    # previous - прошлый снапшот при инкрементальном обновлении: его модель переиспользуется,
+    # если парфюмы не менялись; новые оценки учитываются через fold-in
+    snapshot_path = getattr(snapshot, 'path', None)
+    snapshot_name = getattr(snapshot, 'name', None)
+
+    if snapshot_path is not None:
+        model = AlsModel.load(snapshot_path)
+        if model is not None:
+            return model
+
+    model = None
+    previous_path = getattr(previous, 'path', None)
+    if previous_path is not None and previous_path != snapshot_path:
+        model = AlsModel.load(previous_path)
+        if model is not None and not np.array_equal(model.item_ids, snapshot.perfume_mapping.ids):
+            model = None
+
+    if model is None:
+        model = train_als_model(
+            snapshot.create_matrix(format_csr=True),
+            snapshot.user_mapping.ids,
+            snapshot.perfume_mapping.ids,
+            snapshot=snapshot_name
+        )
+    if snapshot_path is not None:
+        model.save(snapshot_path)
+    return model
+
+
+def get_als_model(source, previous=None) -> AlsModel:
+    # одна модель на снапшот: кешируется в нём же
+    return source.get_or_compute('als_model', lambda: load_or_train_als_model(source, previous))
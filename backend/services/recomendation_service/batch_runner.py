@@ -0,0 +1,120 @@
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional
+from services.recomendation_service.recomendation_strategies.base_recomendation import RecommendationItem
+
+logger = logging.getLogger(__name__)
+
+# состояние процесса-воркера: снапшот открывается через mmap по имени,
+# матрицы между процессами не передаются (общие страницы page cache)
+_worker_state = {}
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def _init_worker(storage_path: str, snapshot_name: Optional[str] = None):
+    from db.connection import db_engine
+    from services.catalog_service.perfume_catalog import PerfumeCatalogService
+    from services.catalog_service.perfume_stats import PerfumeStatsService
+
+    # соединения пула, унаследованные от родителя через fork, использовать нельзя
+    db_engine.dispose(close=False)
+
+    _worker_state['storage_path'] = storage_path
+    _worker_state['snapshot'] = None
+    _worker_state['catalog'] = PerfumeCatalogService()
+    _worker_state['perfume_stats'] = PerfumeStatsService()
+    if snapshot_name:
+        _worker_snapshot(snapshot_name)
+
+
+def _worker_snapshot(snapshot_name: str):
+    from services.recomendation_service.snapshot_store import SnapshotStore
+
+    snapshot = _worker_state.get('snapshot')
+    if snapshot is None or snapshot.name != snapshot_name:
+        # родитель перешёл на новый снапшот - открываем его, старый освобождается вместе с mmap
+        snapshot = SnapshotStore(_worker_state['storage_path']).open(snapshot_name)
+        _worker_state['snapshot'] = snapshot
+        _worker_state['catalog'].refresh_if_changed()
+        _worker_state['perfume_stats'].refresh()
+    return snapshot
+
+
+def call_strategy(snapshot, catalog, strategy_name: str, method: str, args=(), kwargs=None,
+                  deadline: Optional[float] = None, session_factory=None, perfume_stats=None):
+    # Один вызов стратегии на снапшоте со своей сессией БД - в потоке пула или в процессе-воркере
+    from db.connection import SessionLocal
+    from perfumes.perfumes_dao import PerfumeDAO
+    from users.users_dao import UserDAO
+    from services.recomendation_service.data_provider import DataProvider
+    from services.recomendation_service.engine import STRATEGIES
+
+    # задача, простоявшая в очереди дольше срока запроса, не выполняется
+    if deadline is not None and time.time() > deadline:
+        raise DeadlineExceeded(f'Срок запроса истёк до начала вычисления ({strategy_name})')
+
+    db = (session_factory or SessionLocal)()
+    try:
+        strategy = STRATEGIES[strategy_name]()
+        strategy.setup(DataProvider(snapshot, UserDAO(db), PerfumeDAO(db), catalog, perfume_stats))
+        return getattr(strategy, method)(*args, **(kwargs or {}))
+    finally:
+        db.close()
+
+
+def run_strategy_call(snapshot_name: str, strategy_name: str, method: str, args=(), kwargs=None,
+                      deadline: Optional[float] = None):
+    # точка входа задач в процессе-воркере: по сети процесса передаются только имена и ID
+    snapshot = _worker_snapshot(snapshot_name)
+    return call_strategy(
+        snapshot, _worker_state['catalog'].current, strategy_name, method, args, kwargs, deadline,
+        perfume_stats=_worker_state['perfume_stats'].current
+    )
+
+
+def split_blocks(user_ids: List[int], block_size: int) -> List[List[int]]:
+    return [user_ids[i:i + block_size] for i in range(0, len(user_ids), block_size)]
+
+
+def recommend_many_parallel(
+        storage_path: str,
+        snapshot_name: str,
+        strategy_name: str,
+        user_ids: Iterable[int],
+        top_n: int = 10,
+        exclude_rated: bool = True,
+        block_size: int = 1024,
+        n_workers: Optional[int] = None
+) -> Dict[int, List[RecommendationItem]]:
+    # Пакет пользователей делится на блоки, блоки распределяются по процессам
+    user_ids = list(user_ids)
+    n_workers = n_workers or os.cpu_count() or 1
+    blocks = split_blocks(user_ids, block_size)
+
+    logger.info(
+        f'Пакетные рекомендации ({strategy_name}): {len(user_ids)} пользователей, '
+        f'{len(blocks)} блоков, {n_workers} процессов'
+    )
+
+    results = {}
+    with ProcessPoolExecutor(
+        max_workers=n_workers,
+        initializer=_init_worker,
+        initargs=(storage_path, snapshot_name)
+    ) as pool:
+        for block_result in pool.map(
+            run_strategy_call,
+            [snapshot_name] * len(blocks),
+            [strategy_name] * len(blocks),
+            ['recommend_many'] * len(blocks),
+            [(block,) for block in blocks],
+            [{'top_n': top_n, 'exclude_rated': exclude_rated}] * len(blocks)
+        ):
+            results.update(block_result)
+
+    return results
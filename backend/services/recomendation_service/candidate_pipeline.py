@@ -0,0 +1,144 @@
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+import numpy as np
+from services.recomendation_service.feature_matrix import FEATURE_BLOCKS
+
+logger = logging.getLogger(__name__)
+
+# Кандидатов из каждого источника; работа на запрос ограничена их суммой, а не размером каталога
+DEFAULT_CANDIDATE_COUNTS = {
+    'recent_neighbors': 200,   # соседи недавно оценённых парфюмов
+    'popular': 50,             # самые оцениваемые парфюмы снапшота
+    'content': 100,            # совпадения с профилем признаков пользователя
+}
+# Сколько последних оценок считаются недавними интересами
+DEFAULT_RECENT_RATINGS = 10
+
+
+class CandidatePipeline:
+    # Двухэтапные рекомендации: сначала дешёвый отбор кандидатов из нескольких источников,
+    # затем дорогая стратегия (score_candidates) оценивает только кандидатов
+    def __init__(
+            self,
+            data_provider,
+            candidate_counts: Optional[Dict[str, int]] = None,
+            recent_ratings: int = DEFAULT_RECENT_RATINGS,
+            feature_weights: Optional[Dict[str, float]] = None
+    ):
+        self.data_provider = data_provider
+        self.candidate_counts = dict(DEFAULT_CANDIDATE_COUNTS if candidate_counts is None else candidate_counts)
+        self.recent_ratings = recent_ratings
+        self.feature_weights = feature_weights or {block: 1.0 for block in FEATURE_BLOCKS}
+
+        unknown = set(self.candidate_counts) - set(DEFAULT_CANDIDATE_COUNTS)
+        if unknown:
+            raise ValueError(f'Неизвестные источники кандидатов: {", ".join(sorted(unknown))}')
+
+    @property
+    def budget(self) -> int:
+        return sum(max(count, 0) for count in self.candidate_counts.values())
+
+    def retrieve(self, user_ratings: List[Dict[str, Any]], exclude_rated: bool = True) -> Dict[int, List[str]]:
+        # perfume_id -> источники, которые его предложили (в порядке источников)
+        exclude = np.array([r['perfume_id'] for r in user_ratings], dtype=np.int64) if exclude_rated \
+            else np.empty(0, dtype=np.int64)
+
+        candidates: Dict[int, List[str]] = {}
+        for source, count in self.candidate_counts.items():
+            if count <= 0:
+                continue
+            try:
+                perfume_ids = getattr(self, f'_from_{source}')(user_ratings, count, exclude)
+            except Exception as e:
+                # один источник не должен ронять запрос - остальные кандидаты остаются
+                logger.warning(f'Источник кандидатов {source} недоступен: {e}')
+                continue
+
+            for perfume_id in perfume_ids[:count].tolist():
+                candidates.setdefault(perfume_id, []).append(source)
+
+        return candidates
+
+    def rank(
+            self,
+            scorer,
+            user_id: int,
+            user_ratings: List[Dict[str, Any]],
+            top_n: int = 10,
+            exclude_rated: bool = True
+    ) -> List[Tuple[int, float, List[str]]]:
+        # (perfume_id, оценка, источники) для top_n кандидатов по оценке scorer
+        candidates = self.retrieve(user_ratings, exclude_rated)
+        if not candidates:
+            return []
+
+        perfume_ids = np.fromiter(candidates.keys(), dtype=np.int64, count=len(candidates))
+        scores = np.asarray(scorer.score_candidates(user_id, user_ratings, perfume_ids), dtype=np.float32)
+
+        scored = np.flatnonzero(np.isfinite(scores))
+        if len(scored) > top_n:
+            scored = scored[np.argpartition(-scores[scored], top_n - 1)[:top_n]]
+        scored = scored[np.argsort(-scores[scored], kind='stable')]
+
+        return [
+            (int(perfume_ids[pos]), float(scores[pos]), candidates[int(perfume_ids[pos])])
+            for pos in scored
+        ]
+
+    def _from_recent_neighbors(self, user_ratings, limit: int, exclude: np.ndarray) -> np.ndarray:
+        # Соседи из индекса top-K последних понравившихся парфюмов, вес - схожесть * оценка.
+        # Работа - recent_ratings * K, независимо от размера каталога
+        matrix_manager = self.data_provider._matrix_manager
+        recent = user_ratings[:self.recent_ratings]
+        if not recent:
+            return np.empty(0, dtype=np.int64)
+
+        ratings = np.array([r['rating'] for r in recent], dtype=np.float32)
+        mean_rating = np.mean([r['rating'] for r in user_ratings])
+        liked = ratings >= mean_rating
+        item_idx = matrix_manager.perfume_mapping.indices_of([r['perfume_id'] for r in recent])
+        liked &= item_idx >= 0
+        if not liked.any():
+            return np.empty(0, dtype=np.int64)
+
+        neighbor_index = self.data_provider.get_item_neighbors()
+        neighbors, weights = [], []
+        for idx, rating in zip(item_idx[liked], ratings[liked]):
+            indices, similarities = neighbor_index.neighbors(int(idx))
+            neighbors.append(np.asarray(indices, dtype=np.int64))
+            weights.append(np.asarray(similarities, dtype=np.float32) * rating / 5.0)
+
+        neighbors = np.concatenate(neighbors)
+        weights = np.concatenate(weights)
+        items, positions = np.unique(neighbors, return_inverse=True)
+        scores = np.bincount(positions, weights=weights, minlength=len(items))
+
+        perfume_ids = matrix_manager.perfume_mapping.ids[items]
+        keep = (scores > 0) & ~np.isin(perfume_ids, exclude)
+        perfume_ids, scores = perfume_ids[keep], scores[keep]
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+            perfume_ids, scores = perfume_ids[top], scores[top]
+        return perfume_ids[np.argsort(-scores, kind='stable')]
+
+    def _from_popular(self, user_ratings, limit: int, exclude: np.ndarray) -> np.ndarray:
+        popular = self.data_provider.get_popular_perfumes(limit + len(exclude))
+        return popular[~np.isin(popular, exclude)][:limit]
+
+    def _from_content(self, user_ratings, limit: int, exclude: np.ndarray) -> np.ndarray:
+        # парфюмы с самыми весомыми признаками профиля пользователя (бренд, ноты, ...)
+        if not user_ratings:
+            return np.empty(0, dtype=np.int64)
+
+        feature_matrix = self.data_provider.get_perfume_feature_matrix()
+        rating_row = feature_matrix.rating_row(
+            [r['perfume_id'] for r in user_ratings],
+            [r['rating'] for r in user_ratings]
+        )
+        if rating_row.nnz == 0:
+            return np.empty(0, dtype=np.int64)
+
+        profile = feature_matrix.build_profiles(rating_row)
+        rows = feature_matrix.match_candidates(profile, self.feature_weights, limit + len(exclude))
+        perfume_ids = feature_matrix.perfume_mapping.ids[rows]
+        return perfume_ids[~np.isin(perfume_ids, exclude)][:limit]
@@ -1,41 +1,103 @@
-from typing import Union
-from auth.user_service import get_current_user
+import copy
+from typing import Any, Callable, Dict, List, Optional, Union
+import numpy as np
 from perfumes.perfumes_dao import PerfumeDAO
 from users.users_dao import UserDAO
-from ratings.models import Ratings
-from ratings.schemas import RatingResponse
+from services.catalog_service.perfume_catalog import PerfumeCatalog
+from services.catalog_service.perfume_stats import PerfumeStats
+from services.recomendation_service.als_model import AlsModel, get_als_model
+from services.recomendation_service.feature_matrix import PerfumeFeatureMatrix
+from services.recomendation_service.item_neighbors import DEFAULT_ITEM_NEIGHBORS_K, ItemNeighborIndex, get_item_neighbor_index
 from services.recomendation_service.matrix_manager import MatrixManager
-from db.connection import get_db
-from users.models import Users
-from fasapi import Session, Depends
-from scipy.sparse import csr_matrix, csc_matrix
+from services.recomendation_service.snapshot_store import MatrixSnapshot
+from services.recomendation_service.user_index import UserNeighborIndex, get_user_index
 
 
 class DataProvider:
-    def __init__(self, matrix_manager : MatrixManager,
-                user_dao : UserDAO, 
-                perfume_dao : PerfumeDAO):
+    # matrix_manager - MatrixManager или неизменяемый MatrixSnapshot с тем же интерфейсом чтения;
+    # catalog - текущая версия каталога парфюмов (признаки читаются из памяти, без запросов);
+    # perfume_stats - агрегаты оценок, поддерживаемые при записи (популярность без агрегации)
+    def __init__(self, matrix_manager : Union[MatrixManager, MatrixSnapshot],
+                user_dao : UserDAO,
+                perfume_dao : PerfumeDAO,
+                catalog : Optional[PerfumeCatalog] = None,
+                perfume_stats : Optional[PerfumeStats] = None):
         self._matrix_manager = matrix_manager
         self._user_dao = user_dao
-        self._perfume_dao = perfume_dao 
-    
+        self._perfume_dao = perfume_dao
+        self._catalog = catalog
+        self._perfume_stats = perfume_stats
+        # оценки, уже прочитанные для запроса (user_id -> список), - без повторных запросов к БД
+        self._user_ratings: Dict[int, List[Dict[str, Any]]] = {}
+
+    @property
+    def catalog(self) -> PerfumeCatalog:
+        if self._catalog is None:
+            # без общего каталога (скрипты, тесты) - загружаем свой
+            self._catalog = PerfumeCatalog.from_rows(self._perfume_dao.get_feature_rows())
+        return self._catalog
+
     def get_rating_matrix(self, format_csr=False):
         return self._matrix_manager.create_matrix(format_csr)
-    
-    def get_user_similarity_matrix(self):
-        return self._matrix_manager.get_user_similarity_matrix()
-    
+
+    def get_user_neighbors(self) -> UserNeighborIndex:
+        # индекс LSH для поиска схожих пользователей без попарной матрицы схожести
+        return get_user_index(self._matrix_manager)
+
     def get_item_similarity_matrix(self):
-        return self._matrix_manager.get_item_similarity_matrix()
-    
+        # разреженная матрица схожести: только top-K соседей каждого парфюма
+        return self.get_item_neighbors().to_csr()
+
+    def get_item_neighbors(self, k: int = DEFAULT_ITEM_NEIGHBORS_K) -> ItemNeighborIndex:
+        return get_item_neighbor_index(self._matrix_manager, k)
+
+    def get_als_model(self) -> AlsModel:
+        # латентные факторы, обученные на снапшоте (или переиспользованные с прошлого)
+        return get_als_model(self._matrix_manager)
+
+    def get_popular_perfumes(self, limit: Optional[int] = None) -> np.ndarray:
+        # ID парфюмов по убыванию популярности (с затуханием) - первые limit за O(limit)
+        if self._perfume_stats is not None and len(self._perfume_stats):
+            return np.array(self._perfume_stats.top('popularity', limit), dtype=np.int64)
+
+        # без агрегатов (скрипты, тесты) - по числу оценок в снапшоте, один раз на снапшот
+        def compute():
+            rating_counts = np.diff(self._matrix_manager.create_matrix(format_csr=False).indptr)
+            order = np.argsort(-rating_counts, kind='stable')
+            return self._matrix_manager.perfume_mapping.ids[order[rating_counts[order] > 0]]
+
+        return self.get_or_compute('popular_perfumes', compute)[:limit]
+
+    def get_perfume_rating_stats(self, perfume_id: int) -> Optional[Dict[str, Any]]:
+        if self._perfume_stats is None:
+            return None
+        return self._perfume_stats.get(perfume_id)
+
+    def get_perfume_feature_matrix(self) -> PerfumeFeatureMatrix:
+        # матрица признаков привязана к версии каталога, а не к снапшоту оценок
+        return self.catalog.feature_matrix()
+
+    def get_or_compute(self, key: str, factory: Callable[[], Any]) -> Any:
+        # производные структуры кешируются на уровне матрицы/снапшота, а не стратегии
+        return self._matrix_manager.get_or_compute(key, factory)
+
+    def with_user_context(self, user_id: int, user_ratings: List[Dict[str, Any]]) -> 'DataProvider':
+        # копия провайдера с оценками пользователя в памяти: стратегии, получившие её,
+        # не обращаются к сессии БД и могут работать в разных потоках
+        provider = copy.copy(self)
+        provider._user_ratings = {**self._user_ratings, user_id: user_ratings}
+        return provider
+
     def get_user_ratings(self, user_id):
+        if user_id in self._user_ratings:
+            return self._user_ratings[user_id]
         return self._user_dao.get_ratings(user_id)
-    
+
     def get_user_by_id(self, user_id):
         return self._user_dao.get_by_id(user_id)
-    
+
     def get_perfume_features(self, perfume_id):
-        return self._perfume_dao.get_features(perfume_id)
-    
+        return self.catalog.get(perfume_id)
+
     def get_all_perfumes(self):
-        return self._perfume_dao.get_all()
\ No newline at end of file
+        return self.catalog.all()
\ No newline at end of file
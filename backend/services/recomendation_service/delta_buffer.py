@@ -0,0 +1,93 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix
+
+
+class DeltaBuffer:
+    # Буфер последних оценок поверх базовой CSR-матрицы.
+    # Запись - O(1) в словарь (row, col) → rate, структура базовой матрицы не меняется.
+    # Слияние с базой выполняется целиком, когда буфер достиг порога размера или возраста
+    def __init__(self, max_size: int = 10_000, max_age_seconds: float = 300.0):
+        self.max_size = max_size
+        self.max_age_seconds = max_age_seconds
+        self._entries: Dict[Tuple[int, int], float] = {}
+        self._first_write_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add(self, row: int, col: int, rate: float):
+        with self._lock:
+            if not self._entries:
+                self._first_write_at = time.monotonic()
+            self._entries[(row, col)] = float(rate)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self._first_write_at = None
+
+    def should_merge(self) -> bool:
+        if not self._entries:
+            return False
+        if len(self._entries) >= self.max_size:
+            return True
+        return time.monotonic() - self._first_write_at >= self.max_age_seconds
+
+    def snapshot(self) -> Dict[Tuple[int, int], float]:
+        with self._lock:
+            return dict(self._entries)
+
+    def discard(self, merged: Dict[Tuple[int, int], float]):
+        # удаляем только те записи, которые не перезаписывались во время слияния
+        with self._lock:
+            for key, rate in merged.items():
+                if self._entries.get(key) == rate:
+                    del self._entries[key]
+            if not self._entries:
+                self._first_write_at = None
+
+    @staticmethod
+    def to_arrays(entries: Dict[Tuple[int, int], float]):
+        n = len(entries)
+        rows = np.empty(n, dtype=np.int32)
+        cols = np.empty(n, dtype=np.int32)
+        rates = np.empty(n, dtype=np.float32)
+        for i, ((row, col), rate) in enumerate(entries.items()):
+            rows[i] = row
+            cols[i] = col
+            rates[i] = rate
+        return rows, cols, rates
+
+    @staticmethod
+    def apply(base: csr_matrix, entries: Dict[Tuple[int, int], float], shape: Tuple[int, int]) -> csr_matrix:
+        # база + дельта как новая CSR-матрица (база не изменяется)
+        base = grow_csr(base, shape)
+        if not entries:
+            return base
+
+        rows, cols, rates = DeltaBuffer.to_arrays(entries)
+
+        # дельта перезаписывает значения базы, а не складывается с ними
+        old_values = np.asarray(base[rows, cols], dtype=np.float32).ravel()
+        patch = csr_matrix((rates - old_values, (rows, cols)), shape=shape, dtype=np.float32)
+
+        merged = (base + patch).tocsr()
+        merged.eliminate_zeros()
+        return merged
+
+
+def grow_csr(matrix: csr_matrix, shape: Tuple[int, int]) -> csr_matrix:
+    # расширение CSR-матрицы новыми пустыми строками/столбцами без копирования данных
+    if matrix.shape == shape:
+        return matrix
+
+    extra_rows = shape[0] - matrix.shape[0]
+    indptr = matrix.indptr
+    if extra_rows > 0:
+        indptr = np.concatenate([indptr, np.full(extra_rows, indptr[-1], dtype=indptr.dtype)])
+
+    return csr_matrix((matrix.data, matrix.indices, indptr), shape=shape, copy=False)
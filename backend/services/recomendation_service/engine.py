@@ -0,0 +1,521 @@
+import asyncio
+import fcntl
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Type
+from fastapi import HTTPException, Request, status
+from sqlalchemy.orm import Session
+from db.connection import SessionLocal
+from perfumes.perfumes_dao import PerfumeDAO
+from ratings.rating_queue import RatingChanges, RatingWriteQueue
+from ratings.ratings_dao import RatingDAO
+from users.users_dao import UserDAO
+from services.catalog_service.perfume_catalog import PerfumeCatalogService
+from services.catalog_service.perfume_facets import PerfumeFacetIndex
+from services.catalog_service.perfume_search import PerfumeSearchIndex
+from services.catalog_service.perfume_stats import PerfumeStatsService
+from services.recomendation_service.batch_runner import call_strategy, recommend_many_parallel, run_strategy_call, split_blocks
+from services.recomendation_service.als_model import get_als_model
+from services.recomendation_service.data_provider import DataProvider
+from services.recomendation_service.executor import RecommendationExecutor
+from services.recomendation_service.hybrid_orchestrator import HYBRID_LATENCY, shutdown_hybrid_pool, start_hybrid_pool
+from services.recomendation_service.item_neighbors import get_item_neighbor_index
+from services.recomendation_service.matrix_manager import MatrixManager
+from services.recomendation_service.rating_change_feed import RatingChangeFeed
+from services.recomendation_service.result_cache import RecommendationResultCache, create_result_cache, make_cache_key
+from services.recomendation_service.snapshot_store import MatrixSnapshot, SnapshotError, SnapshotStore
+from services.recomendation_service.user_index import get_user_index
+from services.recomendation_service.recomendation_strategies.als_recomender import AlsStrategy
+from services.recomendation_service.recomendation_strategies.base_recomendation import BaseRecommenderStrategy, RecommendationItem
+from services.recomendation_service.recomendation_strategies.content_based_recomender import ContentBasedStrategy
+from services.recomendation_service.recomendation_strategies.hybrid_recomender import HybridStrategy
+from services.recomendation_service.recomendation_strategies.item_based_recomender import ItemBasedStrategy
+from services.recomendation_service.recomendation_strategies.two_stage_recomender import TwoStageStrategy
+from services.recomendation_service.recomendation_strategies.user_based_recomender import UserBasedStrategy
+
+logger = logging.getLogger(__name__)
+
+
+# параметры движка рекомендаций
+ENGINE_CONFIG = {
+    "storage_path": os.getenv("MATRIX_STORAGE_PATH", "./data/matrices"),
+    "refresh_interval_seconds": int(os.getenv("MATRIX_REFRESH_INTERVAL", "3600")), # Полное перестроение по расписанию
+    "change_threshold": int(os.getenv("MATRIX_CHANGE_THRESHOLD", "1000")),   # Новых оценок до внепланового обновления
+    "poll_interval_seconds": int(os.getenv("MATRIX_POLL_INTERVAL", "30")),   # Как часто проверять изменения
+    "batch_workers": int(os.getenv("RECOMMEND_BATCH_WORKERS", "1")),        # Процессов для пакетных рекомендаций
+    "batch_block_size": int(os.getenv("RECOMMEND_BATCH_BLOCK_SIZE", "1024")), # Пользователей в блоке
+    "cache_backend": os.getenv("RECOMMEND_CACHE_BACKEND", "local"),          # local - один воркер, shared - несколько
+    "cache_max_entries": int(os.getenv("RECOMMEND_CACHE_MAX_ENTRIES", "10000")), # Размер кеша результатов
+    "cache_ttl_seconds": float(os.getenv("RECOMMEND_CACHE_TTL", "600")),     # Время жизни результата
+    "executor_mode": os.getenv("RECOMMEND_EXECUTOR", "thread"),              # thread или process
+    "executor_workers": int(os.getenv("RECOMMEND_WORKERS", "0")) or None,    # Размер пула (по умолчанию - число CPU)
+    "executor_max_pending": int(os.getenv("RECOMMEND_MAX_PENDING", "0")) or None, # Очередь пула (по умолчанию - 4 на воркер)
+    "request_timeout_seconds": float(os.getenv("RECOMMEND_TIMEOUT", "5")),   # Срок одного запроса рекомендаций
+    "batch_timeout_seconds": float(os.getenv("RECOMMEND_BATCH_TIMEOUT", "60")), # Срок пакетного запроса
+    "rating_write_behind": os.getenv("RATING_WRITE_BEHIND", "false").lower() == "true", # Отложенная запись оценок
+    "rating_log_path": os.getenv("RATING_LOG_PATH", "./data/rating_log"),    # Журнал неподтверждённых в БД оценок
+    "rating_flush_size": int(os.getenv("RATING_FLUSH_SIZE", "1000")),        # Оценок в пачке записи
+    "rating_flush_interval_seconds": float(os.getenv("RATING_FLUSH_INTERVAL", "1")), # Как часто писать пачку
+    "rating_queue_max_pending": int(os.getenv("RATING_QUEUE_MAX_PENDING", "100000")), # Оценок в очереди, дальше - 503
+    "rating_change_listen": os.getenv("RATING_CHANGE_LISTEN", "true").lower() == "true", # LISTEN/NOTIFY журнала оценок
+    "rating_change_retention_hours": float(os.getenv("RATING_CHANGE_RETENTION_HOURS", "48")), # Хранение журнала изменений оценок
+    "rating_change_prune_interval_seconds": int(os.getenv("RATING_CHANGE_PRUNE_INTERVAL", "3600")), # Как часто чистить журнал
+    "hybrid_workers": int(os.getenv("HYBRID_WORKERS", "0")) or None,        # Потоков стратегий гибрида (по умолчанию - число CPU)
+}
+
+STRATEGIES: Dict[str, Type[BaseRecommenderStrategy]] = {
+    'item_based_cf': ItemBasedStrategy,
+    'user_based': UserBasedStrategy,
+    'content_based': ContentBasedStrategy,
+    'als': AlsStrategy,
+    'two_stage': TwoStageStrategy,
+    'hybrid': HybridStrategy,
+}
+
+
+class RecommendationEngine:
+    # Процессный движок рекомендаций: держит текущий неизменяемый снапшот матрицы
+    # и обновляет его в фоновом потоке. Новый снапшот подменяется одной операцией
+    # присваивания, поэтому запрос, уже получивший снапшот, дорабатывает на нём
+    def __init__(
+            self,
+            storage_path: str = ENGINE_CONFIG["storage_path"],
+            refresh_interval_seconds: int = ENGINE_CONFIG["refresh_interval_seconds"],
+            change_threshold: int = ENGINE_CONFIG["change_threshold"],
+            poll_interval_seconds: int = ENGINE_CONFIG["poll_interval_seconds"],
+            session_factory=SessionLocal,
+            result_cache: Optional[RecommendationResultCache] = None,
+            executor: Optional[RecommendationExecutor] = None,
+            request_timeout_seconds: float = ENGINE_CONFIG["request_timeout_seconds"],
+            rating_queue: Optional[RatingWriteQueue] = None
+    ):
+        self.storage_path = storage_path
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.change_threshold = change_threshold
+        self.poll_interval_seconds = poll_interval_seconds
+        self._session_factory = session_factory
+
+        self._store = SnapshotStore(storage_path)
+        self.catalog = PerfumeCatalogService(session_factory)
+        self.perfume_stats = PerfumeStatsService(session_factory)
+        self.result_cache = result_cache or create_result_cache(
+            ENGINE_CONFIG["cache_backend"],
+            ENGINE_CONFIG["cache_max_entries"],
+            ENGINE_CONFIG["cache_ttl_seconds"]
+        )
+        self.executor = executor or RecommendationExecutor(
+            ENGINE_CONFIG["executor_mode"],
+            ENGINE_CONFIG["executor_workers"],
+            ENGINE_CONFIG["executor_max_pending"],
+            storage_path=storage_path
+        )
+        self.request_timeout_seconds = request_timeout_seconds
+        # отложенная запись оценок (RATING_WRITE_BEHIND); None - оценки пишутся в запросе
+        self.rating_queue = rating_queue
+        if self.rating_queue is None and ENGINE_CONFIG["rating_write_behind"]:
+            self.rating_queue = RatingWriteQueue(
+                ENGINE_CONFIG["rating_log_path"],
+                ENGINE_CONFIG["rating_flush_size"],
+                ENGINE_CONFIG["rating_flush_interval_seconds"],
+                session_factory,
+                ENGINE_CONFIG["rating_queue_max_pending"]
+            )
+        if self.rating_queue is not None:
+            self.rating_queue.subscribe(self._on_rating_changes)
+        # последний id журнала изменений оценок: счётчик ожидающих изменений без запросов к ratings
+        self.change_feed = RatingChangeFeed(
+            session_factory, ENGINE_CONFIG["rating_change_listen"], on_change=self._on_change_feed
+        )
+        self._snapshot: Optional[MatrixSnapshot] = None
+        self._last_rebuild_at: Optional[float] = None
+        self._last_prune_at: Optional[float] = None
+
+        # MatrixManager принадлежит фоновому потоку; очередь записи оценок только
+        # дополняет его дельту (apply_rating - под блокировкой менеджера)
+        self._matrix_manager: Optional[MatrixManager] = None
+        self._stop_event = threading.Event()
+        self._refresh_requested = threading.Event()
+        # будит фоновый поток: запрошено перестроение или набралось изменений оценок
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def current(self) -> Optional[MatrixSnapshot]:
+        return self._snapshot
+
+    @property
+    def version(self) -> Optional[str]:
+        return self._snapshot.name if self._snapshot else None
+
+    def start(self):
+        # тёплый старт: сразу отдаём последний сохранённый снапшот, перестроение - в фоне
+        try:
+            self._swap(self._store.open())
+        except SnapshotError as e:
+            logger.info(f'Снапшот для тёплого старта не найден: {e}')
+
+        # каталог парфюмов загружается один раз, дальше обновляется по изменениям
+        try:
+            self.catalog.current
+        except Exception as e:
+            logger.error(f'Не удалось загрузить каталог парфюмов: {e}')
+
+        # агрегаты оценок (популярность, средние) - тоже в памяти, дальше обновляются при записи
+        try:
+            self.perfume_stats.current
+        except Exception as e:
+            logger.error(f'Не удалось загрузить агрегаты оценок: {e}')
+
+        # журнал изменений оценок: LISTEN/NOTIFY (PostgreSQL) или опрос на каждом тике
+        try:
+            self.change_feed.start()
+        except Exception as e:
+            logger.error(f'Не удалось подписаться на журнал изменений оценок: {e}')
+
+        # журнал отложенных оценок переигрывается до первого запроса
+        if self.rating_queue is not None:
+            self.rating_queue.start()
+
+        self.executor.start()
+        # стратегии гибрида в режиме thread выполняются в этом процессе
+        if not self.executor.uses_processes:
+            start_hybrid_pool(ENGINE_CONFIG["hybrid_workers"])
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='recommendation-engine', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stop_event.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.rating_queue is not None:
+            self.rating_queue.stop(timeout)
+        self.change_feed.stop()
+        self.executor.shutdown()
+        shutdown_hybrid_pool()
+        self.result_cache.close()
+
+    def request_refresh(self):
+        self._refresh_requested.set()
+        self._wakeup.set()
+
+    def data_provider(self, db: Session) -> DataProvider:
+        return DataProvider(
+            self._require_snapshot(), UserDAO(db), PerfumeDAO(db), self.catalog.current, self.perfume_stats.current
+        )
+
+    def create_strategy(self, strategy_name: str, db: Session) -> BaseRecommenderStrategy:
+        # стратегии дешёвые и создаются на запрос; тяжёлые структуры кешируются в снапшоте
+        strategy = self._strategy_class(strategy_name)()
+        strategy.setup(self.data_provider(db))
+        return strategy
+
+    def recommend(
+            self,
+            strategy_name: str,
+            user_id: int,
+            db: Session,
+            top_n: int = 10,
+            exclude_rated: bool = True,
+            **filters
+    ) -> List[RecommendationItem]:
+        # повторный просмотр отдаётся из кеша, пока не сменился снапшот и пользователь ничего не оценил
+        key = make_cache_key(user_id, strategy_name, top_n, self.version, dict(filters, exclude_rated=exclude_rated))
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached
+
+        generation = self.result_cache.generation(user_id)
+        strategy = self.create_strategy(strategy_name, db)
+        recommendations = strategy.recommend(user_id, top_n=top_n, exclude_rated=exclude_rated, **filters)
+        self.result_cache.set(key, recommendations, generation)
+        return recommendations
+
+    async def recommend_async(
+            self,
+            strategy_name: str,
+            user_id: int,
+            top_n: int = 10,
+            exclude_rated: bool = True,
+            timeout: Optional[float] = None
+    ) -> List[RecommendationItem]:
+        # для async-маршрутов: попадание в кеш отдаётся сразу, вычисление - в пуле
+        key = make_cache_key(user_id, strategy_name, top_n, self.version, {'exclude_rated': exclude_rated})
+        cached = self.result_cache.get(key)
+        if cached is not None:
+            return cached
+
+        generation = self.result_cache.generation(user_id)
+        recommendations = await self._execute(
+            strategy_name, 'recommend', (user_id,), {'top_n': top_n, 'exclude_rated': exclude_rated}, timeout
+        )
+        self.result_cache.set(key, recommendations, generation)
+        return recommendations
+
+    async def similar_perfumes_async(self, perfume_id: int, top_n: int = 10,
+                                     timeout: Optional[float] = None) -> List[RecommendationItem]:
+        return await self._execute('item_based_cf', 'similar_perfumes', (perfume_id,), {'top_n': top_n}, timeout)
+
+    async def recommend_many_async(
+            self,
+            strategy_name: str,
+            user_ids: Iterable[int],
+            top_n: int = 10,
+            exclude_rated: bool = True,
+            block_size: int = ENGINE_CONFIG["batch_block_size"],
+            timeout: float = ENGINE_CONFIG["batch_timeout_seconds"]
+    ) -> Dict[int, List[RecommendationItem]]:
+        # блоки не мельче block_size и не больше, чем воркеров в пуле, считаются параллельно
+        user_ids = list(user_ids)
+        block_size = max(block_size, -(-len(user_ids) // self.executor.max_workers))
+        blocks = split_blocks(user_ids, block_size)
+        self.executor.admit(len(blocks))
+
+        results = {}
+        for block_result in await asyncio.gather(*(
+            self._execute(
+                strategy_name, 'recommend_many', (block,),
+                {'top_n': top_n, 'exclude_rated': exclude_rated, 'block_size': block_size}, timeout
+            )
+            for block in blocks
+        )):
+            results.update(block_result)
+        return results
+
+    async def _execute(self, strategy_name: str, method: str, args: tuple, kwargs: dict,
+                       timeout: Optional[float] = None):
+        # ошибки запроса (нет снапшота, неизвестная стратегия) - до постановки в очередь
+        snapshot = self._require_snapshot()
+        self._strategy_class(strategy_name)
+        timeout = timeout or self.request_timeout_seconds
+
+        if self.executor.uses_processes:
+            # в процесс передаётся только имя снапшота, воркер открывает его через mmap
+            return await self.executor.run(
+                run_strategy_call, snapshot.name, strategy_name, method, args, kwargs, timeout=timeout
+            )
+        return await self.executor.run(
+            call_strategy, snapshot, self.catalog.current, strategy_name, method, args, kwargs,
+            timeout=timeout, session_factory=self._session_factory, perfume_stats=self.perfume_stats.current
+        )
+
+    def hybrid_stats(self) -> Dict[str, Any]:
+        # время стратегий гибрида; в режиме process замеры копятся в процессах-воркерах
+        if self.executor.uses_processes:
+            return {'mode': 'process', 'strategies': {}}
+        return {'mode': self.executor.mode, 'strategies': HYBRID_LATENCY.stats()}
+
+    def invalidate_user(self, user_id: int):
+        self.result_cache.invalidate_user(user_id)
+
+    def _on_rating_changes(self, changes: RatingChanges):
+        # пачка отложенных оценок зафиксирована: агрегаты, кеши пользователей и дельта матрицы
+        # обновляются сразу, без ожидания опроса таблицы оценок
+        for row in changes.perfume_stats:
+            self.perfume_stats.apply(row)
+        for user_id in {user_id for user_id, _, _ in changes.ratings}:
+            self.invalidate_user(user_id)
+
+        matrix_manager = self._matrix_manager
+        if matrix_manager is not None and matrix_manager.rating_csr_matrix is not None:
+            for user_id, perfume_id, rate in changes.ratings:
+                matrix_manager.apply_rating(user_id, perfume_id, rate)
+
+    def recommend_many(
+            self,
+            strategy_name: str,
+            user_ids: Iterable[int],
+            db: Session,
+            top_n: int = 10,
+            exclude_rated: bool = True,
+            n_workers: int = ENGINE_CONFIG["batch_workers"],
+            block_size: int = ENGINE_CONFIG["batch_block_size"]
+    ) -> Dict[int, List[RecommendationItem]]:
+        user_ids = list(user_ids)
+        snapshot = self._snapshot
+
+        # небольшие пакеты дешевле посчитать в текущем процессе, чем поднимать пул
+        if snapshot is not None and n_workers > 1 and len(user_ids) > block_size:
+            return recommend_many_parallel(
+                self.storage_path,
+                snapshot.name,
+                strategy_name,
+                user_ids,
+                top_n=top_n,
+                exclude_rated=exclude_rated,
+                block_size=block_size,
+                n_workers=n_workers
+            )
+
+        strategy = self.create_strategy(strategy_name, db)
+        return strategy.recommend_many(user_ids, top_n=top_n, exclude_rated=exclude_rated, block_size=block_size)
+
+    def _require_snapshot(self) -> MatrixSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Рекомендации ещё готовятся, попробуйте позже'
+            )
+        return snapshot
+
+    def _strategy_class(self, strategy_name: str) -> Type[BaseRecommenderStrategy]:
+        strategy_cls = STRATEGIES.get(strategy_name)
+        if strategy_cls is None:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f'Неизвестная стратегия: {strategy_name}'
+            )
+        return strategy_cls
+
+    def _swap(self, snapshot: MatrixSnapshot):
+        previous = self._snapshot
+        self._snapshot = snapshot
+        if previous is None or previous.name != snapshot.name:
+            logger.info(f'Активный снапшот матрицы: {snapshot.name}')
+            # результаты прошлого снапшота по ключу уже недостижимы - освобождаем память разом
+            self.result_cache.clear()
+
+        # расписание полного перестроения считаем от времени построения снапшота,
+        # в том числе если его построил другой воркер
+        last_updated = snapshot.metadata.get('last_updated')
+        if last_updated:
+            age = (datetime.now() - datetime.fromisoformat(last_updated)).total_seconds()
+            self._last_rebuild_at = time.monotonic() - max(age, 0.0)
+
+    def _run(self):
+        if self._snapshot is None:
+            self.request_refresh()
+
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self.poll_interval_seconds)
+            self._wakeup.clear()
+            forced = self._refresh_requested.is_set()
+            self._refresh_requested.clear()
+            if self._stop_event.is_set():
+                break
+
+            try:
+                self._tick(forced)
+            except Exception as e:
+                logger.error(f'Ошибка фонового обновления матрицы: {e}')
+
+    def _tick(self, forced: bool = False):
+        # каталог парфюмов: сверка отпечатка, при изменениях - дочитывание новых или перезагрузка
+        self.catalog.refresh_if_changed()
+        # индексы поиска и фильтра новой версии каталога строятся здесь, а не первым запросом
+        PerfumeSearchIndex.of(self.catalog.current)
+        PerfumeFacetIndex.of(self.catalog.current)
+        # агрегаты оценок, записанных другими воркерами
+        self.perfume_stats.refresh()
+        self._prune_change_log()
+
+        # другой воркер мог уже опубликовать более свежий снапшот
+        latest_name = self._store.latest_name()
+        if latest_name and latest_name != self.version:
+            self._swap(self._store.open(latest_name))
+
+        full_rebuild = (
+            forced or
+            self._snapshot is None or
+            # снапшот без водяного знака журнала изменений - собран до его появления
+            'last_change_id' not in self._snapshot.metadata or
+            self._last_rebuild_at is None or
+            time.monotonic() - self._last_rebuild_at >= self.refresh_interval_seconds
+        )
+        if not full_rebuild and self._pending_changes() < self.change_threshold:
+            return
+
+        self._rebuild(full_rebuild)
+
+    def _prune_change_log(self):
+        # Журнал изменений читают все воркеры, каждый от своего водяного знака, поэтому чистка - по
+        # возрасту: запись нужна читателю до его следующей полной выгрузки (не реже refresh_interval_seconds
+        # и суток свежести матрицы). Раз в интервал, в фоновом потоке; удаление по возрасту идемпотентно
+        now = time.monotonic()
+        if self._last_prune_at is not None and \
+                now - self._last_prune_at < ENGINE_CONFIG["rating_change_prune_interval_seconds"]:
+            return
+        self._last_prune_at = now
+
+        retention = max(ENGINE_CONFIG["rating_change_retention_hours"] * 3600, 2 * self.refresh_interval_seconds)
+        db = self._session_factory()
+        try:
+            removed = RatingDAO(db).prune_changes(datetime.now() - timedelta(seconds=retention))
+            db.commit()
+            if removed:
+                logger.info(f'Из журнала изменений оценок удалено записей: {removed}')
+        except Exception as e:
+            db.rollback()
+            logger.error(f'Ошибка чистки журнала изменений оценок: {e}')
+        finally:
+            db.close()
+
+    def _pending_changes(self) -> int:
+        # новые, изменённые и удалённые оценки после снапшота - разность id журнала изменений;
+        # при подписке LISTEN/NOTIFY без запросов, иначе один max(id) по первичному ключу
+        last_change_id = self._snapshot.metadata.get('last_change_id', 0) if self._snapshot else 0
+        self.change_feed.poll()
+        return self.change_feed.pending(last_change_id)
+
+    def _on_change_feed(self, latest_change_id: int):
+        # набралось изменений на внеплановое обновление - будим фоновый поток, не дожидаясь опроса
+        snapshot = self._snapshot
+        if snapshot is not None and \
+                latest_change_id - snapshot.metadata.get('last_change_id', 0) >= self.change_threshold:
+            self._wakeup.set()
+
+    def _rebuild(self, full_rebuild: bool):
+        # перестраивает только один воркер на хосте, остальные подхватят LATEST
+        lock_path = os.path.join(self.storage_path, '.rebuild.lock')
+        with open(lock_path, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.debug('Матрица уже перестраивается другим процессом')
+                return
+
+            try:
+                db = self._session_factory()
+                try:
+                    if self._matrix_manager is None:
+                        self._matrix_manager = MatrixManager(
+                            db=db, storage_path=self.storage_path, change_feed=self.change_feed
+                        )
+                        self._matrix_manager.load_from_disk()
+                    self._matrix_manager.db = db
+
+                    started = time.monotonic()
+                    if full_rebuild or self._matrix_manager.rating_csr_matrix is None:
+                        self._matrix_manager.load_matrix_from_db()
+                        snapshot_name = self._matrix_manager.metadata['snapshot']
+                    else:
+                        self._matrix_manager.create_matrix(incremental_update=True)
+                        snapshot_name = self._matrix_manager.load_to_disk()
+                    db.commit()
+                finally:
+                    db.close()
+
+                snapshot = self._store.open(snapshot_name)
+                # производные индексы готовим до подмены, чтобы запросы их не ждали
+                get_item_neighbor_index(snapshot)
+                get_user_index(snapshot, previous=self._snapshot)
+                # при полном перестроении модель обучается заново, при инкременте - переиспользуется
+                get_als_model(snapshot, previous=None if full_rebuild else self._snapshot)
+                self._swap(snapshot)
+                logger.info(
+                    f'Снапшот матрицы обновлён за {time.monotonic() - started:.2f} с '
+                    f'({"полное перестроение" if full_rebuild else "инкремент"}, {datetime.now():%H:%M:%S})'
+                )
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_recommendation_engine(request: Request) -> RecommendationEngine:
+    return request.app.state.recommendation_engine
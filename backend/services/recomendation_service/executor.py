@@ -0,0 +1,96 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+from fastapi import HTTPException, status
+from services.recomendation_service.batch_runner import DeadlineExceeded, _init_worker
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationExecutor:
+    # Пул фиксированного размера для CPU-тяжёлых вычислений стратегий, чтобы они не занимали
+    # цикл событий uvicorn. mode='thread' - потоки (NumPy/SciPy отпускают GIL на матричных операциях),
+    # mode='process' - процессы, каждый открывает тот же снапшот через mmap по имени.
+    # Очередь ограничена max_pending: лишние запросы сразу получают 503, а не копятся
+    def __init__(
+            self,
+            mode: str = 'thread',
+            max_workers: Optional[int] = None,
+            max_pending: Optional[int] = None,
+            storage_path: Optional[str] = None,
+            start_method: str = 'spawn'
+    ):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f'Неизвестный режим пула рекомендаций: {mode}')
+
+        self.mode = mode
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 4
+        self.storage_path = storage_path
+        self.start_method = start_method
+
+        self._pool: Optional[Executor] = None
+        # счётчик меняется только из цикла событий, блокировка не нужна
+        self._pending = 0
+
+    @property
+    def uses_processes(self) -> bool:
+        return self.mode == 'process'
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def start(self):
+        if self._pool is not None:
+            return
+
+        if self.uses_processes:
+            # spawn: дочерние процессы не наследуют потоки и соединения родителя
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context(self.start_method),
+                initializer=_init_worker,
+                initargs=(self.storage_path,)
+            )
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='recommend')
+
+        logger.info(f'Пул рекомендаций запущен: {self.mode}, воркеров {self.max_workers}, очередь {self.max_pending}')
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def admit(self, n_tasks: int = 1):
+        if self._pending + n_tasks > self.max_pending:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail='Сервис рекомендаций перегружен, попробуйте позже'
+            )
+
+    async def run(self, fn: Callable[..., Any], *args, timeout: float, **kwargs) -> Any:
+        # fn получает deadline (time.time()) и не начинает работу, если он уже прошёл;
+        # по таймауту ожидание прерывается, ещё не начатая задача снимается из очереди
+        self.start()
+        self.admit()
+
+        self._pending += 1
+        future = self._pool.submit(fn, *args, deadline=time.time() + timeout, **kwargs)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+        except (asyncio.TimeoutError, DeadlineExceeded):
+            future.cancel()
+            raise HTTPException(
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail='Рекомендации не успели вычислиться, попробуйте позже'
+            )
+
+        finally:
+            self._pending -= 1
@@ -0,0 +1,220 @@
+import logging
+from dataclasses import dataclass
+from functools import cached_property
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from services.recomendation_service.id_mapping import IdMapping
+
+logger = logging.getLogger(__name__)
+
+# Блоки признаков в порядке столбцов матрицы
+FEATURE_BLOCKS = ('brand', 'intensity', 'price_category', 'notes')
+# Ценовые категории - квартили цен каталога
+PRICE_CATEGORIES = ('budget', 'middle', 'premium', 'luxury')
+
+
+@dataclass(frozen=True)
+class PerfumeFeatureMatrix:
+    # Разреженная матрица парфюм x признак. Столбцы одного блока идут подряд.
+    # indicator - 0/1; normalized - 1 / (число признаков блока у парфюма),
+    # чтобы парфюм с двадцатью нотами не перевешивал парфюм с тремя
+    indicator: csr_matrix
+    normalized: csr_matrix
+    # (парфюмы x блоки): есть ли у парфюма хотя бы один признак блока
+    block_presence: np.ndarray
+    perfume_mapping: IdMapping
+    feature_names: List[Tuple[str, Any]]
+    blocks: Dict[str, Tuple[int, int]]
+
+    @property
+    def n_perfumes(self) -> int:
+        return self.indicator.shape[0]
+
+    @property
+    def n_features(self) -> int:
+        return self.indicator.shape[1]
+
+    def block_weights(self, feature_weights: Dict[str, float]) -> np.ndarray:
+        return np.array([feature_weights.get(block, 0.0) for block in FEATURE_BLOCKS], dtype=np.float32)
+
+    def column_weights(self, feature_weights: Dict[str, float]) -> np.ndarray:
+        weights = np.zeros(self.n_features, dtype=np.float32)
+        for block, (start, end) in self.blocks.items():
+            weights[start:end] = feature_weights.get(block, 0.0)
+        return weights
+
+    def rows_of(self, perfume_ids) -> np.ndarray:
+        # строки каталога для ID парфюмов, -1 для отсутствующих
+        return self.perfume_mapping.indices_of(perfume_ids)
+
+    def selection_matrix(self, perfume_ids) -> csr_matrix:
+        # (len(perfume_ids) x парфюмы каталога): переводит столбцы матрицы оценок в строки каталога
+        rows = self.rows_of(perfume_ids)
+        known = np.flatnonzero(rows >= 0)
+        return csr_matrix(
+            (np.ones(len(known), dtype=np.float32), (known, rows[known])),
+            shape=(len(rows), self.n_perfumes)
+        )
+
+    def rating_row(self, perfume_ids, ratings) -> csr_matrix:
+        # оценки одного пользователя как строка (1 x парфюмы каталога)
+        rows = self.rows_of(perfume_ids)
+        rates = np.asarray(ratings, dtype=np.float32)
+        known = rows >= 0
+
+        rating_row = csr_matrix(
+            (rates[known], (np.zeros(int(known.sum()), dtype=np.int32), rows[known])),
+            shape=(1, self.n_perfumes)
+        )
+        rating_row.sum_duplicates()
+        return rating_row
+
+    def build_profiles(self, rating_rows: csr_matrix) -> csr_matrix:
+        # rating_rows - (пользователи x парфюмы каталога) с оценками 1-5.
+        # Профиль - средневзвешенный (оценка / 5) вектор признаков оценённых парфюмов
+        weights = csr_matrix(rating_rows, dtype=np.float32, copy=True)
+        weights.data /= 5.0
+
+        weights = csr_matrix(weights.multiply(self.has_features[np.newaxis, :]))
+
+        total_weight = np.asarray(weights.sum(axis=1), dtype=np.float32).ravel()
+        inv_total = np.divide(1.0, total_weight, out=np.zeros_like(total_weight), where=total_weight > 0)
+        return (diags(inv_total) @ weights @ self.indicator).tocsr()
+
+    def score(self, profiles: csr_matrix, feature_weights: Dict[str, float],
+              rows: Optional[np.ndarray] = None) -> np.ndarray:
+        # (пользователи x парфюмы): сумма по блокам вес_блока * доля признаков блока,
+        # совпавших с профилем, делённая на сумму весов блоков, которые есть у парфюма.
+        # rows - оценить только эти строки каталога (кандидаты), а не весь каталог
+        normalized = self.normalized if rows is None else self.normalized[rows]
+        block_presence = self.block_presence if rows is None else self.block_presence[rows]
+
+        weighted = (profiles @ diags(self.column_weights(feature_weights))).T.toarray()
+        scores = np.asarray(normalized @ weighted, dtype=np.float32).T
+
+        row_weight = block_presence @ self.block_weights(feature_weights)
+        inv_row_weight = np.divide(1.0, row_weight, out=np.zeros_like(row_weight), where=row_weight > 0)
+        return scores * inv_row_weight[np.newaxis, :]
+
+    @cached_property
+    def has_features(self) -> np.ndarray:
+        return np.asarray(self.indicator.getnnz(axis=1) > 0, dtype=np.float32)
+
+    @cached_property
+    def perfumes_by_feature(self) -> csr_matrix:
+        # (признаки x парфюмы): строки каталога с данным признаком
+        return self.indicator.T.tocsr()
+
+    def match_candidates(self, profile: csr_matrix, feature_weights: Dict[str, float], limit: int,
+                         max_features: int = 8, max_per_feature: Optional[int] = None) -> np.ndarray:
+        # Строки каталога, совпавшие с самыми весомыми признаками профиля (1 x признаки).
+        # Работа ограничена max_features * max_per_feature, а не размером каталога
+        max_per_feature = max_per_feature or limit * 4
+        weights = profile.data * self.column_weights(feature_weights)[profile.indices]
+        features = profile.indices[np.argsort(-weights, kind='stable')[:max_features]]
+
+        postings = self.perfumes_by_feature
+        rows = np.unique(np.concatenate([
+            postings.indices[postings.indptr[f]:postings.indptr[f + 1]][:max_per_feature] for f in features
+        ] or [np.empty(0, dtype=np.int32)]))
+        if len(rows) <= limit:
+            return rows
+
+        scores = self.score(profile, feature_weights, rows=rows)[0]
+        return rows[np.argpartition(-scores, limit - 1)[:limit]]
+
+    def explain(self, row: int, profile: np.ndarray, feature_weights: Dict[str, float],
+                limit: int = 3) -> List[Dict[str, Any]]:
+        # признаки парфюма, больше всего совпавшие с профилем пользователя
+        start, end = self.normalized.indptr[row], self.normalized.indptr[row + 1]
+        columns = self.normalized.indices[start:end]
+        contributions = (
+            self.normalized.data[start:end] *
+            profile[columns] *
+            self.column_weights(feature_weights)[columns]
+        )
+
+        result = []
+        for pos in np.argsort(-contributions, kind='stable')[:limit]:
+            if contributions[pos] <= 0:
+                break
+            block, value = self.feature_names[int(columns[pos])]
+            result.append({'feature': block, 'value': value, 'contribution': float(contributions[pos])})
+        return result
+
+
+def price_categories(prices: np.ndarray) -> List[str]:
+    if len(prices) == 0:
+        return []
+    edges = np.quantile(prices, [0.25, 0.5, 0.75])
+    return [PRICE_CATEGORIES[i] for i in np.searchsorted(edges, prices, side='right')]
+
+
+def build_perfume_feature_matrix(perfumes: Iterable[Dict[str, Any]]) -> PerfumeFeatureMatrix:
+    # perfumes - словари {'id', 'brand', 'intensity', 'price' | 'price_category', 'notes': {тип: [ноты]}}
+    perfumes = list(perfumes)
+
+    if perfumes and all('price_category' not in perfume for perfume in perfumes):
+        prices = np.array([perfume.get('price') or 0.0 for perfume in perfumes], dtype=np.float64)
+        perfumes = [
+            dict(perfume, price_category=category)
+            for perfume, category in zip(perfumes, price_categories(prices))
+        ]
+
+    # словари значений строятся один раз при сборке матрицы
+    vocabularies: Dict[str, Dict[Any, int]] = {block: {} for block in FEATURE_BLOCKS}
+    per_perfume: List[Dict[str, set]] = []
+    for perfume in perfumes:
+        values = {
+            'brand': {perfume['brand']} if perfume.get('brand') else set(),
+            'intensity': {perfume['intensity']} if perfume.get('intensity') else set(),
+            'price_category': {perfume['price_category']} if perfume.get('price_category') else set(),
+            # ноты разных типов (верхние/сердце/база) - один блок, как и раньше
+            'notes': {note for notes in (perfume.get('notes') or {}).values() for note in notes}
+        }
+        for block, block_values in values.items():
+            vocabulary = vocabularies[block]
+            for value in block_values:
+                vocabulary.setdefault(value, len(vocabulary))
+        per_perfume.append(values)
+
+    blocks = {}
+    feature_names: List[Tuple[str, Any]] = []
+    offset = 0
+    for block in FEATURE_BLOCKS:
+        vocabulary = vocabularies[block]
+        blocks[block] = (offset, offset + len(vocabulary))
+        feature_names.extend((block, value) for value in vocabulary)
+        offset += len(vocabulary)
+
+    rows, cols, norm_values = [], [], []
+    block_presence = np.zeros((len(perfumes), len(FEATURE_BLOCKS)), dtype=np.float32)
+    for row, values in enumerate(per_perfume):
+        for block_pos, block in enumerate(FEATURE_BLOCKS):
+            block_values = values[block]
+            if not block_values:
+                continue
+            block_presence[row, block_pos] = 1.0
+            start = blocks[block][0]
+            for value in block_values:
+                rows.append(row)
+                cols.append(start + vocabularies[block][value])
+                norm_values.append(1.0 / len(block_values))
+
+    shape = (len(perfumes), offset)
+    rows = np.asarray(rows, dtype=np.int32)
+    cols = np.asarray(cols, dtype=np.int32)
+    normalized = csr_matrix((np.asarray(norm_values, dtype=np.float32), (rows, cols)), shape=shape)
+    indicator = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+
+    feature_matrix = PerfumeFeatureMatrix(
+        indicator=indicator,
+        normalized=normalized,
+        block_presence=block_presence,
+        perfume_mapping=IdMapping(np.array([perfume['id'] for perfume in perfumes], dtype=np.int64)),
+        feature_names=feature_names,
+        blocks=blocks
+    )
+    logger.info(f'Матрица признаков парфюмов построена: {shape[0]} парфюмов, {shape[1]} признаков')
+    return feature_matrix
@@ -0,0 +1,256 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, List, Optional, Tuple
+import numpy as np
+from services.recomendation_service.recomendation_strategies.base_recomendation import (
+    BaseRecommenderStrategy, RecommendationItem
+)
+
+logger = logging.getLogger(__name__)
+
+# Вес стратегии в смеси; оценки каждой стратегии перед смешиванием нормируются к [0, 1]
+DEFAULT_HYBRID_WEIGHTS = {
+    'item_based_cf': 1.0,
+    'user_based': 1.0,
+    'content_based': 0.5,
+}
+# Общий срок гибридного запроса: стратегии, не успевшие к нему, в смесь не попадают
+DEFAULT_HYBRID_BUDGET_SECONDS = 0.8
+# Кандидатов от каждой стратегии на top_n итоговых
+DEFAULT_CANDIDATE_FACTOR = 3
+# Последних замеров на стратегию для перцентилей
+LATENCY_WINDOW = 1024
+# Потоков пула стратегий гибрида (HYBRID_WORKERS); по умолчанию - число CPU
+DEFAULT_HYBRID_WORKERS = int(os.getenv('HYBRID_WORKERS', '0')) or None
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def start_hybrid_pool(max_workers: Optional[int] = DEFAULT_HYBRID_WORKERS) -> ThreadPoolExecutor:
+    # Пул процесса для стратегий гибрида, отдельный от пула запросов, - задача запроса
+    # не ждёт свободного места в собственном пуле. NumPy/SciPy отпускают GIL, потоки работают параллельно.
+    # Создаётся при старте движка (lifespan); в процессах-воркерах пула рекомендаций - при первом запросе
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            max_workers = max_workers or os.cpu_count() or 1
+            _pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='hybrid')
+            logger.info(f'Пул стратегий гибрида запущен: потоков {max_workers}')
+        return _pool
+
+
+def shutdown_hybrid_pool():
+    # задачи в очереди снимаются, выполняющиеся дорабатывают без ожидания
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    return _pool or start_hybrid_pool()
+
+
+@dataclass(frozen=True)
+class StrategyRun:
+    # Итог одной стратегии в гибридном запросе:
+    # ok, timeout (не успела к сроку), error, skipped (не подходит пользователю)
+    name: str
+    status: str
+    elapsed_ms: float
+    n_items: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'status': self.status,
+            'elapsed_ms': round(self.elapsed_ms, 2),
+            'items': self.n_items
+        }
+
+
+class StrategyLatencyStats:
+    # Скользящие замеры времени стратегий гибрида (процессные): перцентили и доли таймаутов
+    # показывают, какая стратегия съедает бюджет запроса
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self._elapsed: Dict[str, Deque[float]] = {}
+        self._statuses: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, runs: List[StrategyRun]):
+        with self._lock:
+            for run in runs:
+                statuses = self._statuses.setdefault(run.name, {})
+                statuses[run.status] = statuses.get(run.status, 0) + 1
+                if run.status != 'skipped':
+                    self._elapsed.setdefault(run.name, deque(maxlen=self.window)).append(run.elapsed_ms)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            result = {}
+            for name, statuses in self._statuses.items():
+                elapsed = np.array(self._elapsed.get(name, ()), dtype=np.float64)
+                result[name] = dict(statuses)
+                if len(elapsed):
+                    p50, p95, p99 = np.percentile(elapsed, [50, 95, 99])
+                    result[name].update({
+                        'p50_ms': round(float(p50), 2),
+                        'p95_ms': round(float(p95), 2),
+                        'p99_ms': round(float(p99), 2),
+                        'max_ms': round(float(elapsed.max()), 2)
+                    })
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._elapsed.clear()
+            self._statuses.clear()
+
+
+HYBRID_LATENCY = StrategyLatencyStats()
+
+
+def _timed_recommend(strategy: BaseRecommenderStrategy, user_id: int, top_n: int,
+                     exclude_rated: bool, deadline: float) -> Tuple[Optional[List[RecommendationItem]], float]:
+    # срок запроса истёк, пока задача ждала потока, - не начинаем: результат уже никому не нужен,
+    # а поток нужен следующим запросам. None - стратегия не запускалась
+    started = time.perf_counter()
+    if started >= deadline:
+        return None, 0.0
+    items = strategy.recommend(user_id, top_n=top_n, exclude_rated=exclude_rated)
+    return items, (time.perf_counter() - started) * 1000
+
+
+class HybridOrchestrator:
+    # Запускает подходящие стратегии параллельно под общим сроком и смешивает то,
+    # что пришло вовремя. Стратегии должны быть настроены на провайдер с контекстом
+    # пользователя (DataProvider.with_user_context) - тогда им не нужна общая сессия БД
+    def __init__(
+            self,
+            strategies: Dict[str, BaseRecommenderStrategy],
+            weights: Optional[Dict[str, float]] = None,
+            budget_seconds: float = DEFAULT_HYBRID_BUDGET_SECONDS,
+            candidate_factor: int = DEFAULT_CANDIDATE_FACTOR,
+            latency_stats: Optional[StrategyLatencyStats] = HYBRID_LATENCY
+    ):
+        self.strategies = strategies
+        self.weights = weights or {name: DEFAULT_HYBRID_WEIGHTS.get(name, 1.0) for name in strategies}
+        self.budget_seconds = budget_seconds
+        self.candidate_factor = candidate_factor
+        self.latency_stats = latency_stats
+
+    def run(
+            self,
+            user_id: int,
+            top_n: int = 10,
+            exclude_rated: bool = True,
+            budget_seconds: Optional[float] = None
+    ) -> Tuple[List[Tuple[int, float, float, Dict[str, float]]], List[StrategyRun]]:
+        # (perfume_id, смешанная оценка, уверенность, вклад стратегий) и итоги стратегий
+        budget_seconds = self.budget_seconds if budget_seconds is None else budget_seconds
+        started = time.perf_counter()
+        deadline = started + budget_seconds
+
+        runs: Dict[str, StrategyRun] = {}
+        futures = {}
+        pool = _get_pool()
+        for name, strategy in self.strategies.items():
+            if self.weights.get(name, 0.0) <= 0 or not strategy.can_recommend(user_id):
+                runs[name] = StrategyRun(name, 'skipped', 0.0)
+                continue
+            if time.perf_counter() >= deadline:
+                # бюджет уже израсходован - стратегия в пул не отправляется
+                runs[name] = StrategyRun(name, 'timeout', (time.perf_counter() - started) * 1000)
+                continue
+            futures[pool.submit(
+                _timed_recommend, strategy, user_id, top_n * self.candidate_factor, exclude_rated, deadline
+            )] = name
+
+        results: Dict[str, List[RecommendationItem]] = {}
+        pending = set(futures)
+        # ошибка стратегии не прерывает ожидание остальных
+        while pending:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_EXCEPTION)
+            for future in done:
+                name = futures[future]
+                try:
+                    items, elapsed_ms = future.result()
+                except Exception as e:
+                    logger.warning(f'Стратегия {name} гибрида завершилась с ошибкой: {e}')
+                    runs[name] = StrategyRun(name, 'error', (time.perf_counter() - started) * 1000)
+                    continue
+                if items is None:
+                    runs[name] = StrategyRun(name, 'timeout', (time.perf_counter() - started) * 1000)
+                    continue
+                # запасные варианты стратегий не смешиваем - у гибрида свой
+                items = [item for item in items if not (item.explanation or {}).get('fallback')]
+                results[name] = items
+                runs[name] = StrategyRun(name, 'ok', elapsed_ms, len(items))
+
+        for future in pending:
+            # ещё не начатая стратегия снимается; начатая дорабатывает в пуле, результат отбрасывается
+            future.cancel()
+            name = futures[future]
+            runs[name] = StrategyRun(name, 'timeout', budget_seconds * 1000)
+            logger.warning(f'Стратегия {name} гибрида не уложилась в {budget_seconds:.2f} с')
+
+        ordered_runs = [runs[name] for name in self.strategies]
+        if self.latency_stats is not None:
+            self.latency_stats.record(ordered_runs)
+        logger.debug(
+            f'Гибрид для пользователя {user_id}: ' +
+            ', '.join(f'{run.name}={run.status}/{run.elapsed_ms:.1f}мс' for run in ordered_runs)
+        )
+
+        return self._blend(results, top_n), ordered_runs
+
+    def _blend(
+            self,
+            results: Dict[str, List[RecommendationItem]],
+            top_n: int
+    ) -> List[Tuple[int, float, float, Dict[str, float]]]:
+        # Шкалы стратегий разные (прогноз оценки 0..5, косинус 0..1): оценки каждой делятся
+        # на её максимум, затем - взвешенное среднее по стратегиям, успевшим к сроку.
+        # Парфюм, которого нет в списке стратегии, получает от неё 0
+        results = {name: items for name, items in results.items() if items}
+        if not results:
+            return []
+
+        total_weight = sum(self.weights[name] for name in results)
+        scores: Dict[int, float] = {}
+        confidences: Dict[int, float] = {}
+        contributions: Dict[int, Dict[str, float]] = {}
+        for name, items in results.items():
+            weight = self.weights[name] / total_weight
+            max_score = max(item.score for item in items)
+            if max_score <= 0:
+                continue
+            for item in items:
+                contribution = weight * item.score / max_score
+                scores[item.perfume_id] = scores.get(item.perfume_id, 0.0) + contribution
+                confidences[item.perfume_id] = confidences.get(item.perfume_id, 0.0) + weight * item.confidence
+                contributions.setdefault(item.perfume_id, {})[name] = round(contribution, 4)
+
+        perfume_ids = np.fromiter(scores.keys(), dtype=np.int64, count=len(scores))
+        blended = np.fromiter(scores.values(), dtype=np.float64, count=len(scores))
+        top = BaseRecommenderStrategy._select_top_n(blended, top_n)
+
+        return [
+            (
+                int(perfume_ids[pos]),
+                float(blended[pos]),
+                min(1.0, confidences[int(perfume_ids[pos])]),
+                contributions[int(perfume_ids[pos])]
+            )
+            for pos in top
+        ]
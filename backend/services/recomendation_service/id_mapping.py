@@ -0,0 +1,127 @@
+from typing import Dict, Iterator, List, Optional
+import numpy as np
+
+
+class IdMapping:
+    # Отображение внешних ID (user_id / perfume_id) в индексы строк/столбцов матрицы.
+    # Базовая часть - массив ID в порядке индексов, поиск бинарный (np.searchsorted),
+    # поэтому не нужно строить python-словари на миллионы ключей.
+    # Новые ID дописываются в конец (индексы len(base), len(base)+1, ...)
+    # и хранятся в небольшом словаре до следующего compacted()
+    def __init__(self, ids: Optional[np.ndarray] = None, sorter: Optional[np.ndarray] = None,
+                 check_order: bool = True):
+        if ids is None:
+            ids = np.empty(0, dtype=np.int64)
+        self._ids = np.asarray(ids, dtype=np.int64)
+
+        # если ID не отсортированы (после дописывания новых), ищем через перестановку
+        # (check_order=False - порядок уже известен, например при открытии снапшота)
+        if sorter is None and check_order and len(self._ids) > 1 and np.any(self._ids[1:] <= self._ids[:-1]):
+            sorter = np.argsort(self._ids, kind='stable')
+        self._sorter = sorter
+
+        self._extra_ids: List[int] = []
+        self._extra_index: Dict[int, int] = {}
+
+    @property
+    def ids(self) -> np.ndarray:
+        if not self._extra_ids:
+            return self._ids
+        return np.concatenate([self._ids, np.asarray(self._extra_ids, dtype=np.int64)])
+
+    @property
+    def sorter(self) -> Optional[np.ndarray]:
+        return self._sorter
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._extra_ids)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.ids.tolist())
+
+    def __contains__(self, item_id) -> bool:
+        return self.get(item_id) is not None
+
+    def __getitem__(self, item_id) -> int:
+        idx = self.get(item_id)
+        if idx is None:
+            raise KeyError(item_id)
+        return idx
+
+    def get(self, item_id, default=None):
+        if len(self._ids):
+            pos = int(np.searchsorted(self._ids, item_id, sorter=self._sorter))
+            if pos < len(self._ids):
+                idx = pos if self._sorter is None else int(self._sorter[pos])
+                if self._ids[idx] == item_id:
+                    return idx
+        return self._extra_index.get(item_id, default)
+
+    def add(self, item_id: int) -> int:
+        # возвращает индекс ID, при необходимости дописывая его в конец
+        idx = self.get(item_id)
+        if idx is None:
+            idx = len(self)
+            self._extra_ids.append(int(item_id))
+            self._extra_index[int(item_id)] = idx
+        return idx
+
+    def compacted(self) -> 'IdMapping':
+        # новый маппинг с теми же индексами, где дописанные ID перенесены в базовый массив
+        if not self._extra_ids:
+            return self
+        return IdMapping(self.ids)
+
+    def items(self):
+        return zip(self.ids.tolist(), range(len(self)))
+
+    def indices_of(self, item_ids) -> np.ndarray:
+        # векторизованный поиск индексов, -1 для неизвестных ID
+        item_ids = np.asarray(item_ids, dtype=np.int64)
+        result = np.full(item_ids.shape, -1, dtype=np.int64)
+
+        if len(self._ids):
+            pos = np.searchsorted(self._ids, item_ids, sorter=self._sorter)
+            pos_clipped = np.minimum(pos, len(self._ids) - 1)
+            idx = pos_clipped if self._sorter is None else self._sorter[pos_clipped]
+            result = np.where(self._ids[idx] == item_ids, idx, -1)
+
+        if self._extra_index:
+            for i in np.flatnonzero(result < 0):
+                result.flat[i] = self._extra_index.get(int(item_ids.flat[i]), -1)
+
+        return result
+
+    def reverse(self) -> 'ReverseIdMapping':
+        return ReverseIdMapping(self)
+
+
+class ReverseIdMapping:
+    # Обратное отображение индекс → ID поверх того же маппинга (без копирования)
+    def __init__(self, mapping: IdMapping):
+        self._mapping = mapping
+
+    def __len__(self) -> int:
+        return len(self._mapping)
+
+    def __contains__(self, idx) -> bool:
+        return 0 <= idx < len(self._mapping)
+
+    def __getitem__(self, idx) -> int:
+        if idx not in self:
+            raise KeyError(idx)
+        base_ids = self._mapping._ids
+        if idx < len(base_ids):
+            return int(base_ids[idx])
+        return self._mapping._extra_ids[idx - len(base_ids)]
+
+    def get(self, idx, default=None):
+        if idx not in self:
+            return default
+        return self[idx]
+
+    def items(self):
+        return zip(range(len(self._mapping)), self._mapping.ids.tolist())
+
+    def ids_of(self, indices) -> np.ndarray:
+        return self._mapping.ids[np.asarray(indices, dtype=np.int64)]
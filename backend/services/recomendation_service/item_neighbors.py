@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import shutil
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix, csc_matrix, diags
+
+logger = logging.getLogger(__name__)
+
+ITEM_NEIGHBORS_DIR = 'item_neighbors'
+ITEM_NEIGHBORS_FORMAT_VERSION = 1
+DEFAULT_ITEM_NEIGHBORS_K = 50
+
+
+@dataclass(frozen=True)
+class ItemNeighborIndex:
+    # Для каждого парфюма - не более k самых похожих (int32 индексы, float32 схожесть),
+    # в строке отсортированы по убыванию схожести. Память - O(n_items * k), а не O(n_items²)
+    indptr: np.ndarray
+    indices: np.ndarray
+    data: np.ndarray
+    k: int
+    snapshot: Optional[str] = None
+
+    @property
+    def n_items(self) -> int:
+        return len(self.indptr) - 1
+
+    def neighbors(self, item_idx: int) -> Tuple[np.ndarray, np.ndarray]:
+        start, end = self.indptr[item_idx], self.indptr[item_idx + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def to_csr(self) -> csr_matrix:
+        # разреженная матрица схожести (строка - парфюм, не более k ненулевых)
+        return csr_matrix(
+            (self.data, self.indices, self.indptr),
+            shape=(self.n_items, self.n_items),
+            copy=False
+        )
+
+    def save(self, snapshot_path: Path) -> Path:
+        target = Path(snapshot_path) / ITEM_NEIGHBORS_DIR
+        tmp_dir = Path(snapshot_path) / f'.tmp_{ITEM_NEIGHBORS_DIR}_{uuid.uuid4().hex[:8]}'
+        tmp_dir.mkdir()
+
+        try:
+            for array_name in ('indptr', 'indices', 'data'):
+                np.save(tmp_dir / f'{array_name}.npy', getattr(self, array_name))
+
+            with open(tmp_dir / 'manifest.json', 'w', encoding='utf-8') as f:
+                json.dump({
+                    'format_version': ITEM_NEIGHBORS_FORMAT_VERSION,
+                    'k': self.k,
+                    'n_items': self.n_items,
+                    'snapshot': self.snapshot
+                }, f, ensure_ascii=False, indent=2)
+
+            os.rename(tmp_dir, target)
+
+        except OSError:
+            # индекс для этого снапшота уже сохранил другой процесс
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not target.exists():
+                raise
+
+        return target
+
+    @classmethod
+    def load(cls, snapshot_path: Path) -> Optional['ItemNeighborIndex']:
+        source = Path(snapshot_path) / ITEM_NEIGHBORS_DIR
+        manifest_path = source / 'manifest.json'
+        if not manifest_path.exists():
+            return None
+
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != ITEM_NEIGHBORS_FORMAT_VERSION:
+            return None
+
+        return cls(
+            indptr=np.load(source / 'indptr.npy', mmap_mode='r'),
+            indices=np.load(source / 'indices.npy', mmap_mode='r'),
+            data=np.load(source / 'data.npy', mmap_mode='r'),
+            k=manifest['k'],
+            snapshot=manifest.get('snapshot')
+        )
+
+
+def _centered_item_vectors(rating_csc_matrix: csc_matrix) -> csr_matrix:
+    # строки - парфюмы; из известных оценок вычитаем среднее парфюма,
+    # неизвестные остаются нулями (матрица не уплотняется), затем L2-нормировка
+    items = csr_matrix(rating_csc_matrix.T, dtype=np.float32, copy=True)
+
+    counts = np.diff(items.indptr)
+    sums = np.asarray(items.sum(axis=1), dtype=np.float32).ravel()
+    means = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    items.data -= np.repeat(means, counts)
+
+    norms = np.sqrt(np.asarray(items.multiply(items).sum(axis=1), dtype=np.float32).ravel())
+    inv_norms = np.divide(1.0, norms, out=np.zeros_like(norms), where=norms > 0)
+    return (diags(inv_norms) @ items).tocsr()
+
+
+def build_item_neighbor_index(
+        rating_csc_matrix: csc_matrix,
+        k: int = 50,
+        min_similarity: float = 0.0,
+        block_size: int = 1024,
+        snapshot: Optional[str] = None
+) -> ItemNeighborIndex:
+    # Косинусная схожесть считается блоками строк: пиковая память - block_size * n_items,
+    # от каждого блока остаются только top-k соседей
+    items = _centered_item_vectors(rating_csc_matrix)
+    items_t = items.T.tocsr()
+    n_items = items.shape[0]
+    k = max(1, min(k, n_items - 1)) if n_items > 1 else 0
+
+    indptr = np.zeros(n_items + 1, dtype=np.int64)
+    indices_blocks = []
+    data_blocks = []
+
+    for start in range(0, n_items, block_size):
+        end = min(start + block_size, n_items)
+        block = (items[start:end] @ items_t).toarray()
+
+        # сам парфюм соседом не считается
+        rows = np.arange(end - start)
+        block[rows, rows + start] = -np.inf
+
+        if k == 0:
+            top = np.empty((end - start, 0), dtype=np.int64)
+        else:
+            top = np.argpartition(-block, k - 1, axis=1)[:, :k]
+
+        top_sims = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_sims, axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        top_sims = np.take_along_axis(top_sims, order, axis=1)
+
+        keep = top_sims > min_similarity
+        indptr[start + 1:end + 1] = np.cumsum(keep.sum(axis=1)) + indptr[start]
+        indices_blocks.append(top[keep].astype(np.int32))
+        data_blocks.append(top_sims[keep].astype(np.float32))
+
+    index = ItemNeighborIndex(
+        indptr=indptr,
+        indices=np.concatenate(indices_blocks) if indices_blocks else np.empty(0, dtype=np.int32),
+        data=np.concatenate(data_blocks) if data_blocks else np.empty(0, dtype=np.float32),
+        k=k,
+        snapshot=snapshot
+    )
+    logger.info(f'Индекс соседей парфюмов построен: {n_items} парфюмов, k={k}, связей={len(index.data)}')
+    return index
+
+
+def load_or_build_item_neighbor_index(snapshot, k: int = 50) -> ItemNeighborIndex:
+    # snapshot - MatrixSnapshot (индекс хранится в его каталоге) или MatrixManager (только в памяти)
+    snapshot_path = getattr(snapshot, 'path', None)
+    snapshot_name = getattr(snapshot, 'name', None)
+
+    if snapshot_path is not None:
+        index = ItemNeighborIndex.load(snapshot_path)
+        if index is not None and index.k >= k:
+            return index
+
+    index = build_item_neighbor_index(snapshot.create_matrix(format_csr=False), k=k, snapshot=snapshot_name)
+    if snapshot_path is not None:
+        index.save(snapshot_path)
+    return index
+
+
+def get_item_neighbor_index(source, k: int = DEFAULT_ITEM_NEIGHBORS_K) -> ItemNeighborIndex:
+    # один индекс на снапшот: кешируется в нём же
+    return source.get_or_compute(
+        f'item_neighbors_k{k}',
+        lambda: load_or_build_item_neighbor_index(source, k)
+    )
@@ -1,42 +1,68 @@
-import datetime
-import hashlib
+from datetime import datetime, timedelta
 import logging
+import threading
+import time
 from pathlib import Path
-import pickle
-from typing import Dict, Union
-from ratings.models import Ratings
-from fastapiu import Session, Depends, Optional
+from typing import Any, Callable, Dict, Optional, Union
+from ratings.ratings_dao import RatingDAO
+from fastapi import Depends
+from sqlalchemy.orm import Session
 from db.connection import get_db
 from scipy.sparse import csr_matrix, csc_matrix
 import numpy as np
-from scipy.sparse import save_npz
-from sqlalchemy import func
+from services.recomendation_service.delta_buffer import DeltaBuffer, grow_csr
+from services.recomendation_service.id_mapping import IdMapping
+from services.recomendation_service.rating_change_feed import ChangeCursor, RatingChangeFeed
+from services.recomendation_service.rating_loader import load_rating_columns
+from services.recomendation_service.snapshot_store import SnapshotError, SnapshotStore
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 class MatrixManager:
     def __init__(self, db: Session = Depends(get_db), 
-                 storage_path: str = "./data/matrices"):
+                 storage_path: str = "./data/matrices",
+                 delta_max_size: int = 10_000,
+                 delta_max_age_seconds: float = 300.0,
+                 max_snapshot_versions: int = 5,
+                 change_feed: Optional[RatingChangeFeed] = None,
+                 view_refresh_interval_seconds: float = 1.0):
         
         self.db = db
+        # последний id журнала изменений оценок; без журнала - запрос max(id) по первичному ключу
+        self.change_feed = change_feed
         self.storage_path = Path(storage_path)
-        self.storage_path.mkdir(parents=True, exist_ok=True)
-        self.rating_csr_matrix = Optional[csr_matrix] = None
-        self.rating_csc_matrix = Optional[csr_matrix] = None
+        self.snapshot_store = SnapshotStore(storage_path, max_versions=max_snapshot_versions)
+        self.rating_csr_matrix: Optional[csr_matrix] = None
+        self.rating_csc_matrix: Optional[csc_matrix] = None
 
-        # Маппинги ID ↔ индекс
-        self.user_mapping: Dict[int, int] = {}  # user_id → row_index
-        self.perfume_mapping: Dict[int, int] = {}  # perfume_id → col_index
-        self.reverse_user_mapping: Dict[int, int] = {}  # row_index → user_id
-        self.reverse_perfume_mapping: Dict[int, int] = {}  # col_index → perfume_id
+        # Маппинги ID ↔ индекс (массивы ID, поиск через np.searchsorted)
+        self.user_mapping = IdMapping()  # user_id → row_index
+        self.perfume_mapping = IdMapping()  # perfume_id → col_index
+        self.reverse_user_mapping = self.user_mapping.reverse()  # row_index → user_id
+        self.reverse_perfume_mapping = self.perfume_mapping.reverse()  # col_index → perfume_id
+
+        # Буфер новых оценок поверх базовой матрицы и представление база+дельта.
+        # Запись только помечает представление устаревшим; пересборка (O(nnz)) - при чтении,
+        # не чаще раза в view_refresh_interval_seconds, а не на каждую оценку
+        self.delta = DeltaBuffer(max_size=delta_max_size, max_age_seconds=delta_max_age_seconds)
+        self.view_refresh_interval_seconds = view_refresh_interval_seconds
+        self._view_csr: Optional[csr_matrix] = None
+        self._view_csc: Optional[csc_matrix] = None
+        self._view_stale = False
+        self._view_built_at = 0.0
+        self._lock = threading.RLock()
+        self._merge_thread: Optional[threading.Thread] = None
 
         self.metadata = {
             'created_at': None,
             'last_updated': None,
-            'data_hash': None,
+            'last_rating_id': 0,
+            'last_change_id': 0,   # изменения журнала до этого id уже в матрице
             'version': '1.0'
         }
+        # позиция чтения журнала изменений; пересоздаётся, если last_change_id сменила полная выгрузка или снапшот
+        self.change_cursor = ChangeCursor()
 
         self.stats = {
             'n_users': 0,
@@ -61,113 +87,217 @@ class MatrixManager:
     ) -> Union[csr_matrix, csc_matrix]: # используем такой формат для хранения только ненулевых строк/колонок
         rebuild = (
             force_rebuild or
-            self.rating_csc_matrix is None or
-            not self._is_matrix_data_fresh() or
-            self._has_changes
+            self.rating_csr_matrix is None or
+            not self._is_matrix_data_fresh()
         )
 
-        # если не нужно переестраивать или обновлять инкрементом
-        if not rebuild and incremental_update:
+        # если не нужно переестраивать или обновлять инкрементом; без новых изменений - ни одного запроса
+        if not rebuild and incremental_update and self._has_changes():
             try:
-                self._update_matrix_increment
-                logger.info('Обновление матрицы оценок')
+                self._update_matrix_increment()
         # если не удалось обновить, строим матрицу заново 
             except Exception as e:
-                logger.warning('Не удалось обнонвить матрицу оценок')
+                logger.warning(f'Не удалось обнонвить матрицу оценок: {e}')
                 rebuild = True
 
         if rebuild:
             logger.info('Загрузка матрицы из БД')
             self.load_matrix_from_db()
 
-        if format_csr:
-            matrix = self.rating_csr_matrix
-        else:
-            if self.rating_csc_matrix is None:
-                self.rating_csc_matrix = self.rating_csr_matrix.tocsc()
-                
-            matrix = self.rating_csc_matrix
+        self._maybe_schedule_merge()
+        return self._get_view(format_csr)
+
+    def _get_view(self, format_csr: bool = True, fresh: bool = False) -> Union[csr_matrix, csc_matrix]:
+        # читатели видят базу + дельту. После записи представление пересобирается не чаще
+        # раза в view_refresh_interval_seconds (до этого - прежнее, без последних оценок);
+        # fresh=True - пересобрать сразу (снапшот на диск должен содержать все оценки)
+        with self._lock:
+            rebuild = self._view_csr is None or (
+                self._view_stale and
+                (fresh or time.monotonic() - self._view_built_at >= self.view_refresh_interval_seconds)
+            )
+            if rebuild:
+                shape = (len(self.user_mapping), len(self.perfume_mapping))
+                entries = self.delta.snapshot()
+                self._view_csr = DeltaBuffer.apply(self.rating_csr_matrix, entries, shape)
+                self._view_csc = None if entries else self.rating_csc_matrix
+                self._view_stale = False
+                self._view_built_at = time.monotonic()
+                # производные структуры считались по прежнему представлению
+                self._similarity_cache = {}
+
+            if format_csr:
+                return self._view_csr
+
+            if self._view_csc is None:
+                self._view_csc = self._view_csr.tocsc()
+                if self._view_csr is self.rating_csr_matrix:
+                    self.rating_csc_matrix = self._view_csc
+
+            return self._view_csc
+
+    def get_or_compute(self, key: str, factory: Callable[[], Any]) -> Any:
+        # кеш производных структур сбрасывается при любом изменении представления
+        with self._lock:
+            if key not in self._similarity_cache:
+                self._similarity_cache[key] = factory()
+            return self._similarity_cache[key]
+
+    def _invalidate_view(self):
+        # сменилась база или маппинги - представление собирается заново при первом чтении
+        self._view_csr = None
+        self._view_csc = None
+        self._view_stale = False
+        self._similarity_cache = {}
+
+    def _grow_view(self):
+        # новый пользователь/парфюм: устаревшее представление расширяется пустыми строками
+        # и столбцами (O(строк + столбцов), данные не копируются), чтобы его индексы оставались валидны
+        shape = (len(self.user_mapping), len(self.perfume_mapping))
+        if self._view_csr is None or self._view_csr.shape == shape:
+            return
+        self._view_csr = grow_csr(self._view_csr, shape)
+        if self._view_csc is not None:
+            self._view_csc = grow_csr(self._view_csc.T.tocsr(copy=False), shape[::-1]).T.tocsc(copy=False)
+
+    def apply_rating(self, user_id: int, perfume_id: int, rate: float):
+        # новая или изменённая оценка: новые пользователи и парфюмы получают
+        # следующие свободные индексы, полное перестроение не требуется
+        with self._lock:
+            user_idx = self.user_mapping.add(user_id)
+            perfume_idx = self.perfume_mapping.add(perfume_id)
+            self.delta.add(user_idx, perfume_idx, rate)
+            self._grow_view()
+            self._view_stale = True
+
+    def _maybe_schedule_merge(self):
+        if not self.delta.should_merge():
+            return
+
+        with self._lock:
+            if self._merge_thread is not None and self._merge_thread.is_alive():
+                return
+            self._merge_thread = threading.Thread(target=self._merge_delta, name='matrix-delta-merge', daemon=True)
+            self._merge_thread.start()
+
+    def _merge_delta(self):
+        # слияние дельты с базой в фоне; читатели до замены продолжают видеть база+дельта
+        try:
+            with self._lock:
+                base = self.rating_csr_matrix
+                shape = (len(self.user_mapping), len(self.perfume_mapping))
+                entries = self.delta.snapshot()
 
-        return matrix
+            merged_csr = DeltaBuffer.apply(base, entries, shape)
+            merged_csc = merged_csr.tocsc()
 
-    def load_matrix_from_db(self):
+            with self._lock:
+                # за время слияния матрицу могли перестроить целиком
+                if self.rating_csr_matrix is not base:
+                    return
+
+                self.rating_csr_matrix = merged_csr
+                self.rating_csc_matrix = merged_csc
+                self.user_mapping = self.user_mapping.compacted()
+                self.perfume_mapping = self.perfume_mapping.compacted()
+                self.reverse_user_mapping = self.user_mapping.reverse()
+                self.reverse_perfume_mapping = self.perfume_mapping.reverse()
+                self.delta.discard(entries)
+                self._invalidate_view()
+                self._update_stats()
+
+            logger.info(f'Дельта слита с базовой матрицей: {len(entries)} оценок')
+
+        except Exception as e:
+            logger.error(f'Ошибка слияния дельты с матрицей: {e}')
+
+    def load_matrix_from_db(self, batch_size: int = 100_000, load_mode: str = 'auto'):
         # используем не всех пользователей и парфюмы для экономии памяти
         # однако позже следует добавить дугие рекомендательные методы,
         # чтобы пространство возможных рекомендаций не снижалось
-        users_with_rates = self.db.query(Ratings.user_id).distinct().order_by(Ratings.user_id).all()
-        perfumes_with_rates = self.db.query(Ratings.perfume_id).distinct().order_by(Ratings.perfume_id).all()
-
-        # маппинги
-        self.user_mapping = {user_id: idx for idx, (user_id,) in enumerate(users_with_rates)}
-        self.perfume_mapping = {perfume_id: idx for idx, (perfume_id,) in enumerate(perfumes_with_rates)}
-        self.reverse_user_mapping = {v: k for k, v in self.user_mapping.items()}
-        self.reverse_perfume_mapping = {v: k for k, v in self.perfume_mapping.items()}
-
-        data = []
-        rows = []
-        cols = []
-
-        batch_size = 50000
-        offset = 0
-
-        while True:
-            batch = self.db.query(Ratings).limit(batch_size).offset(offset).all()
-            if not batch:
-                break
-                
-            for rating in batch:
-                user_idx = self.user_mapping.get(rating.user_id)
-                perfume_idx = self.perfume_mapping.get(rating.perfume_id)
-                
-                if user_idx is not None and perfume_idx is not None:
-                    data.append(rating.rate)
-                    rows.append(user_idx)
-                    cols.append(perfume_idx)
-            
-            offset += batch_size
-            logger.debug(f'Обработано {offset} записей...')
-
-        n_users = len(users_with_rates)
-        n_perfumes = len(perfumes_with_rates)
-        
-        self.rating_matrix = csr_matrix(
-            (data, (rows, cols)),
+
+        # водяной знак журнала - до выгрузки: изменения во время неё применятся следующим инкрементом
+        last_change_id = RatingDAO(self.db).get_latest_change_id()
+
+        # читаем только (user_id, perfume_id, rate) сразу в массивы int32/float32,
+        # без ORM-объектов и без OFFSET
+        columns = load_rating_columns(self.db, batch_size=batch_size, mode=load_mode)
+
+        # маппинги: отсортированные уникальные ID, индексы - векторно
+        user_ids, rows = np.unique(columns.user_ids, return_inverse=True)
+        perfume_ids, cols = np.unique(columns.perfume_ids, return_inverse=True)
+        rows = rows.astype(np.int32, copy=False)
+        cols = cols.astype(np.int32, copy=False)
+
+        n_users = len(user_ids)
+        n_perfumes = len(perfume_ids)
+
+        rating_csr_matrix = csr_matrix(
+            (columns.rates, (rows, cols)),
             shape=(n_users, n_perfumes),
             dtype=np.float32
         )
+        del rows, cols
+
+        with self._lock:
+            self.rating_csr_matrix = rating_csr_matrix
+            self.rating_csc_matrix = None
+            self.user_mapping = IdMapping(user_ids)
+            self.perfume_mapping = IdMapping(perfume_ids)
+            self.reverse_user_mapping = self.user_mapping.reverse()
+            self.reverse_perfume_mapping = self.perfume_mapping.reverse()
+            # всё, что было в дельте, уже есть в свежей выгрузке
+            self.delta.clear()
+            self._invalidate_view()
+
+        now = datetime.now()
+        self.metadata['created_at'] = self.metadata['created_at'] or now
+        self.metadata['last_updated'] = now
+        self.metadata['last_rating_id'] = columns.max_rating_id
+        self.metadata['last_change_id'] = last_change_id
+        self._update_stats()
 
-        self._save_to_disk()
+        self.load_to_disk()
 
         logger.info(f"Матрица построена. Пользователей: {n_users}, парфюмов: {n_perfumes}")
 
+    def _update_stats(self):
+        matrix = self.rating_csr_matrix
+        n_users, n_perfumes = matrix.shape
+        n_ratings = matrix.nnz
+        values, counts = np.unique(matrix.data, return_counts=True)
+
+        self.stats = {
+            'n_users': n_users,
+            'n_perfumes': n_perfumes,
+            'n_ratings': n_ratings,
+            'sparsity': 1.0 - n_ratings / (n_users * n_perfumes) if n_users and n_perfumes else 0.0,
+            'avg_ratings_per_user': n_ratings / n_users if n_users else 0.0,
+            'avg_ratings_per_perfume': n_ratings / n_perfumes if n_perfumes else 0.0,
+            'rating_distribution': {float(v): int(c) for v, c in zip(values, counts)}
+        }
+
     def _update_matrix_increment(self):
-        # Получаем последние оценки, которых нет в текущей матрице
-        last_update = self.metadata['last_updated'] or datetime.min
-        
-        new_ratings = self.db.query(Ratings).filter(
-            Ratings.created_at > last_update
-        ).all()
-        
-        if not new_ratings:
-            logger.debug("Нет новых оценок для инкрементального обновления")
+        # Изменения оценок (новые, изменённые, удалённые) из журнала после последнего применённого id -
+        # O(изменений), таблица оценок не читается
+        last_change_id = self.metadata.get('last_change_id') or 0
+        if self.change_cursor.watermark != last_change_id:
+            self.change_cursor = ChangeCursor(last_change_id)
+        changes = self.change_cursor.read(RatingDAO(self.db))
+
+        if not changes:
+            logger.debug("Нет новых изменений оценок для инкрементального обновления")
             return
-        
-        logger.info(f"Инкрементальное обновление: {len(new_ratings)} новых оценок")
-        
-        # Обновляем матрицу
-        for rating in new_ratings:
-            user_idx = self.user_mapping.get(rating.user_id)
-            perfume_idx = self.perfume_mapping.get(rating.perfume_id)
-            
-            # Если новый пользователь или парфюм - требуется полное перестроение
-            if user_idx is None or perfume_idx is None:
-                logger.warning("Обнаружен новый пользователь или парфюм, требуется полное перестроение")
-                self._build_from_scratch()
-                return
-            
-            # Обновляем существующую ячейку
-            self.rating_matrix[user_idx, perfume_idx] = rating.rate
-        
+
+        logger.info(f"Инкрементальное обновление: {len(changes)} изменений оценок")
+
+        # только новые изменения, последнее на пару; удалённая оценка (rate = None) - ноль,
+        # при слиянии элемент исчезает из матрицы
+        for change_id, user_id, perfume_id, rate in changes:
+            self.apply_rating(user_id, perfume_id, 0.0 if rate is None else rate)
+
+        self.metadata['last_change_id'] = self.change_cursor.watermark
+
         logger.info("Инкрементальное обновление завершено")
     
     def _is_matrix_data_fresh(self):
@@ -175,77 +305,67 @@ class MatrixManager:
             return False
         
         # Матрица считается устаревшей, если ей больше суток
-        stale_threshold = datetime.timedelta(days=1)
-        return ~(datetime.now() - self.metadata['last_updated'] > stale_threshold)
-
-    def _compute_data_hash(self):
-        # Используем агрегированные данные для вычисления хеша
-        rating_stats = self.db.query(
-            func.count(Ratings.id).label('count'),
-            func.max(Ratings.created_at).label('max_date')
-        ).first()
-        
-        hash_data = f"{rating_stats.count}_{rating_stats.max_date}"
-        return hashlib.md5(hash_data.encode()).hexdigest()
+        stale_threshold = timedelta(days=1)
+        return not (datetime.now() - self.metadata['last_updated'] > stale_threshold)
 
-    def _has_changes(self):
-        current_hash = self._compute_data_hash()
-        
-        # Если это первая загрузка
-        if not self.metadata['data_hash']:
-            self.metadata['data_hash'] = current_hash
-            return True
-        
-        # Сравниваем хеши
-        return current_hash != self.metadata['data_hash']
+    def _latest_change_id(self) -> int:
+        if self.change_feed is not None:
+            return self.change_feed.latest_id
+        return RatingDAO(self.db).get_latest_change_id()
 
-    def load_to_disk(self):
-        if self.rating_csc_matrix is None:
-            return
-        
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        matrix_path = f'{self.storage_path}_csc_matrix_{ts}'
-        save_npz(matrix_path, self.rating_csc_matrix)
-
-        metadata_path = self.storage_path / f"metadata_{ts}.pkl"
-        metadata = {
-            'user_mapping': self.user_mapping,
-            'perfume_mapping': self.perfume_mapping,
-            'metadata': self.metadata,
-            'stats': self.stats
-        }
+    def _has_changes(self) -> bool:
+        # сравнение id журнала изменений с применённым - без агрегатов по таблице оценок
+        return self._latest_change_id() > (self.metadata.get('last_change_id') or 0)
 
-        with open(metadata_path, 'wb') as f:
-            pickle.dump(metadata, f)
-        
-        # Симлинк 
-        latest_matrix = self.storage_path / "_csc_matrix_latest.npz"
-        latest_metadata = self.storage_path / "metadata_latest.pkl"
-        
-        if latest_matrix.exists():
-            latest_matrix.unlink()
-        if latest_metadata.exists():
-            latest_metadata.unlink()
-        
-        latest_matrix.symlink_to(matrix_path.name)
-        latest_metadata.symlink_to(metadata_path.name)
-        
-        logger.info(f"Матрица сохранена: {matrix_path}")
+    def load_to_disk(self) -> Optional[str]:
+        # сохраняем текущее состояние (база + дельта) как новый снапшот
+        if self.rating_csr_matrix is None:
+            return None
 
-    def _cleanup_old_versions(self, max_versions: int = 5):
-        matrix_files = sorted(
-            self.storage_path.glob("rating_matrix_*.npz"),
-            key=lambda x: x.name  # Сортировка по имени = по времени
-        )
-        
-        metadata_files = sorted(
-            self.storage_path.glob("metadata_*.pkl"),
-            key=lambda x: x.name
+        with self._lock:
+            rating_csr_matrix = self._get_view(format_csr=True, fresh=True)
+            rating_csc_matrix = self._view_csc
+            user_mapping = self.user_mapping
+            perfume_mapping = self.perfume_mapping
+            metadata = dict(self.metadata)
+            stats = dict(self.stats)
+
+        name = self.snapshot_store.write(
+            rating_csr_matrix,
+            user_mapping,
+            perfume_mapping,
+            metadata=metadata,
+            stats=stats,
+            rating_csc_matrix=rating_csc_matrix
         )
-        for files in (matrix_files, metadata_files):
-            if len(files) > max_versions:
-                for old_file in files[:-max_versions]:
-                    # Не удаляем файлы, на которые ссылаются симлинки
-                    if not old_file.is_symlink():
-                        old_file.unlink()
-                        logger.debug(f"Удалён старый файл: {old_file.name}")
\ No newline at end of file
+        self.metadata['snapshot'] = name
+        return name
+
+    def load_from_disk(self, name: Optional[str] = None, verify: bool = False) -> bool:
+        # открываем последний (или указанный) снапшот через mmap, без чтения данных в память
+        try:
+            snapshot = self.snapshot_store.open(name, verify=verify)
+        except SnapshotError as e:
+            logger.info(f'Снапшот матрицы не загружен: {e}')
+            return False
+
+        metadata = dict(snapshot.metadata)
+        for key in ('created_at', 'last_updated'):
+            if metadata.get(key):
+                metadata[key] = datetime.fromisoformat(metadata[key])
+
+        with self._lock:
+            self.rating_csr_matrix = snapshot.rating_csr_matrix
+            self.rating_csc_matrix = snapshot.rating_csc_matrix
+            self.user_mapping = snapshot.user_mapping
+            self.perfume_mapping = snapshot.perfume_mapping
+            self.reverse_user_mapping = self.user_mapping.reverse()
+            self.reverse_perfume_mapping = self.perfume_mapping.reverse()
+            self.metadata.update(metadata)
+            self.metadata['snapshot'] = snapshot.name
+            self.stats = dict(snapshot.stats)
+            self.delta.clear()
+            self._invalidate_view()
+
+        logger.info(f'Матрица загружена из снапшота {snapshot.name}')
+        return True
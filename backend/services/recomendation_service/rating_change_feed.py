@@ -0,0 +1,155 @@
+import logging
+import select
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from db.connection import SessionLocal, db_engine
+from ratings.ratings_dao import CHANGE_NOTIFY_CHANNEL, RatingDAO
+
+logger = logging.getLogger(__name__)
+
+# Окно перечитывания журнала: транзакция, получившая id раньше, может зафиксироваться позже соседней.
+# Пропуск id в последних CHANGE_REREAD_IDS перечитывается, пока не заполнится или не выйдет из окна
+CHANGE_REREAD_IDS = 1000
+
+
+class RatingChangeFeed:
+    # Последний id журнала изменений оценок (rating_change_log) в памяти процесса.
+    # PostgreSQL + psycopg2: значение приходит через LISTEN/NOTIFY, запросов нет вовсе;
+    # иначе (или если подписка упала) - poll(): max по первичному ключу, O(1).
+    # Проверка «есть ли изменения» - сравнение двух чисел, без агрегатов по таблице оценок
+    def __init__(
+            self,
+            session_factory=SessionLocal,
+            listen: bool = True,
+            on_change: Optional[Callable[[int], None]] = None
+    ):
+        self._session_factory = session_factory
+        self._listen = listen
+        self._on_change = on_change
+        self._latest_id = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.listening = False
+
+    @property
+    def latest_id(self) -> int:
+        return self._latest_id
+
+    def pending(self, after_id: int) -> int:
+        # число изменений после after_id (по id; пропуски последовательности - верхняя оценка)
+        return max(self._latest_id - after_id, 0)
+
+    def start(self):
+        # триггер NOTIFY создаёт миграция 0003_rating_change_notify
+        db = self._session_factory()
+        try:
+            dao = RatingDAO(db)
+            if self._listen and self._supports_listen(db):
+                self._stop_event.clear()
+                self._thread = threading.Thread(target=self._run, name='rating-change-feed', daemon=True)
+                self._thread.start()
+            self._advance(dao.get_latest_change_id())
+        finally:
+            db.close()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.listening = False
+
+    def poll(self) -> int:
+        # при живой подписке значение уже актуально
+        if self.listening:
+            return self._latest_id
+
+        self._advance(self._read_latest())
+        return self._latest_id
+
+    def _advance(self, latest_id: int):
+        with self._lock:
+            if latest_id <= self._latest_id:
+                return
+            self._latest_id = latest_id
+
+        if self._on_change is not None:
+            try:
+                self._on_change(latest_id)
+            except Exception as e:
+                logger.error(f'Ошибка обработчика журнала изменений оценок: {e}')
+
+    @staticmethod
+    def _supports_listen(db) -> bool:
+        bind = db.get_bind()
+        return bind.dialect.name == 'postgresql' and bind.dialect.driver == 'psycopg2'
+
+    def _run(self):
+        # отдельное соединение в autocommit: LISTEN и ожидание уведомлений через select()
+        connection = None
+        try:
+            connection = db_engine.raw_connection()
+            # соединение в autocommit не должно вернуться в пул
+            connection.detach()
+            dbapi_connection = connection.dbapi_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {CHANGE_NOTIFY_CHANNEL}')
+            self.listening = True
+            # изменения между start() и LISTEN
+            self._advance(self._read_latest())
+            logger.info('Журнал изменений оценок: подписка LISTEN/NOTIFY')
+
+            while not self._stop_event.is_set():
+                if select.select([dbapi_connection], [], [], 1.0) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                payloads = [notify.payload for notify in dbapi_connection.notifies]
+                dbapi_connection.notifies.clear()
+                latest = max((int(payload) for payload in payloads if payload.isdigit()), default=0)
+                if latest:
+                    self._advance(latest)
+
+        except Exception as e:
+            logger.error(f'Подписка на изменения оценок прервана, переход на опрос: {e}')
+        finally:
+            self.listening = False
+            if connection is not None:
+                connection.close()
+
+    def _read_latest(self) -> int:
+        db = self._session_factory()
+        try:
+            return RatingDAO(db).get_latest_change_id()
+        finally:
+            db.close()
+
+
+class ChangeCursor:
+    # Позиция одного читателя журнала: водяной знак и id, уже учтённые в окне перечитывания.
+    # Читается только хвост от первого пропуска в окне (обычно - от водяного знака), из прочитанного
+    # отдаются лишь новые изменения, по одному последнему на пару: поздно зафиксированное изменение
+    # не перекрывает более позднее, уже применённое. Состояние - в памяти процесса
+    def __init__(self, watermark: int = 0):
+        self.watermark = watermark
+        self._seen: Set[int] = set()
+
+    def read(self, dao: RatingDAO) -> List[Tuple[int, int, int, Optional[int]]]:
+        # (id, user_id, perfume_id, rate) по возрастанию id; водяной знак сдвигается
+        floor = max(self.watermark - CHANGE_REREAD_IDS, 0)
+        self._seen = {change_id for change_id in self._seen if change_id > floor}
+        start = next(
+            (change_id - 1 for change_id in range(floor + 1, self.watermark + 1) if change_id not in self._seen),
+            self.watermark
+        )
+        changes = dao.get_changes(start)
+
+        latest: Dict[Tuple[int, int], Tuple[int, int, int, Optional[int]]] = {}
+        for change in changes:
+            latest[(change[1], change[2])] = change
+        fresh = sorted(change for change in latest.values() if change[0] not in self._seen)
+
+        self._seen.update(change[0] for change in changes)
+        self.watermark = max([self.watermark, *(change[0] for change in changes)])
+        return fresh
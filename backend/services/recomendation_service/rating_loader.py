@@ -0,0 +1,166 @@
+import logging
+from dataclasses import dataclass
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from ratings.models import Ratings
+
+logger = logging.getLogger(__name__)
+
+
+# Формат одной строки бинарного COPY для (user_id, perfume_id, rate):
+# int16 число полей, затем для каждого поля int32 длина + int32 значение (big-endian)
+COPY_ROW_DTYPE = np.dtype([
+    ('n_fields', '>i2'),
+    ('user_len', '>i4'), ('user_id', '>i4'),
+    ('perfume_len', '>i4'), ('perfume_id', '>i4'),
+    ('rate_len', '>i4'), ('rate', '>i4'),
+])
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_TRAILER = b'\xff\xff'
+
+
+@dataclass
+class RatingColumns:
+    # Колоночное представление таблицы оценок
+    user_ids: np.ndarray      # int32
+    perfume_ids: np.ndarray   # int32
+    rates: np.ndarray         # float32
+    max_rating_id: int        # водяной знак для инкрементальных обновлений
+
+    def __len__(self):
+        return len(self.rates)
+
+
+class _ColumnBuffer:
+    # Предвыделенные массивы, которые заполняются потоком строк
+    def __init__(self, capacity: int):
+        self.user_ids = np.empty(capacity, dtype=np.int32)
+        self.perfume_ids = np.empty(capacity, dtype=np.int32)
+        self.rates = np.empty(capacity, dtype=np.float32)
+        self.size = 0
+
+    def append(self, user_ids, perfume_ids, rates):
+        n = len(rates)
+        end = self.size + n
+
+        # если строк больше, чем насчитал count (не должно происходить при фильтре по id)
+        if end > len(self.rates):
+            new_capacity = max(end, int(len(self.rates) * 1.25) + 1)
+            self.user_ids = np.resize(self.user_ids, new_capacity)
+            self.perfume_ids = np.resize(self.perfume_ids, new_capacity)
+            self.rates = np.resize(self.rates, new_capacity)
+
+        self.user_ids[self.size:end] = user_ids
+        self.perfume_ids[self.size:end] = perfume_ids
+        self.rates[self.size:end] = rates
+        self.size = end
+
+    def finish(self, max_rating_id: int) -> RatingColumns:
+        return RatingColumns(
+            user_ids=self.user_ids[:self.size],
+            perfume_ids=self.perfume_ids[:self.size],
+            rates=self.rates[:self.size],
+            max_rating_id=max_rating_id
+        )
+
+
+class _BinaryCopySink:
+    # file-like объект для cursor.copy_expert: разбирает поток COPY BINARY
+    # по мере поступления, не накапливая весь вывод в памяти
+    def __init__(self, buffer: _ColumnBuffer):
+        self._buffer = buffer
+        self._tail = b''
+        self._header_done = False
+
+    def write(self, chunk) -> int:
+        data = self._tail + bytes(chunk)
+
+        if not self._header_done:
+            # сигнатура (11) + флаги (4) + длина расширения заголовка (4)
+            if len(data) < 19:
+                self._tail = data
+                return len(chunk)
+            if data[:11] != COPY_SIGNATURE:
+                raise ValueError('Неожиданный формат COPY BINARY')
+            ext_len = int.from_bytes(data[15:19], 'big')
+            if len(data) < 19 + ext_len:
+                self._tail = data
+                return len(chunk)
+            data = data[19 + ext_len:]
+            self._header_done = True
+
+        n_rows = len(data) // COPY_ROW_DTYPE.itemsize
+        if n_rows:
+            rows = np.frombuffer(data, dtype=COPY_ROW_DTYPE, count=n_rows)
+            self._buffer.append(rows['user_id'], rows['perfume_id'], rows['rate'])
+
+        self._tail = data[n_rows * COPY_ROW_DTYPE.itemsize:]
+        return len(chunk)
+
+    def close(self):
+        if self._tail and self._tail != COPY_TRAILER:
+            raise ValueError('Поток COPY BINARY оборвался посреди строки')
+
+
+def _supports_copy(db: Session) -> bool:
+    bind = db.get_bind()
+    return bind.dialect.name == 'postgresql' and bind.dialect.driver == 'psycopg2'
+
+
+def _load_with_copy(db: Session, buffer: _ColumnBuffer, max_rating_id: int):
+    dbapi_connection = db.connection().connection
+    sink = _BinaryCopySink(buffer)
+
+    with dbapi_connection.cursor() as cursor:
+        cursor.copy_expert(
+            'COPY (SELECT user_id, perfume_id, rate FROM ratings '
+            f'WHERE id <= {int(max_rating_id)}) TO STDOUT WITH (FORMAT binary)',
+            sink
+        )
+    sink.close()
+
+
+def _load_with_keyset(db: Session, buffer: _ColumnBuffer, max_rating_id: int, batch_size: int):
+    # постраничное чтение по первичному ключу вместо OFFSET:
+    # каждая страница - индексный range scan, а не пропуск уже прочитанных строк
+    last_id = 0
+    while last_id < max_rating_id:
+        batch = db.query(Ratings.id, Ratings.user_id, Ratings.perfume_id, Ratings.rate)\
+            .filter(Ratings.id > last_id, Ratings.id <= max_rating_id)\
+            .order_by(Ratings.id)\
+            .limit(batch_size)\
+            .all()
+        if not batch:
+            break
+
+        chunk = np.array(batch, dtype=np.int64)
+        buffer.append(chunk[:, 1], chunk[:, 2], chunk[:, 3])
+        last_id = int(chunk[-1, 0])
+        logger.debug(f'Загружено {buffer.size} оценок...')
+
+
+def load_rating_columns(db: Session, batch_size: int = 100_000, mode: str = 'auto') -> RatingColumns:
+    # mode: 'copy' - COPY ... TO STDOUT (FORMAT binary), только postgresql+psycopg2
+    #       'keyset' - постраничное чтение по id
+    #       'auto' - copy, если драйвер поддерживает, иначе keyset
+    n_ratings, max_rating_id = db.query(func.count(Ratings.id), func.max(Ratings.id)).one()
+    n_ratings = n_ratings or 0
+    max_rating_id = max_rating_id or 0
+
+    buffer = _ColumnBuffer(n_ratings)
+    if n_ratings == 0:
+        return buffer.finish(max_rating_id)
+
+    if mode == 'auto':
+        mode = 'copy' if _supports_copy(db) else 'keyset'
+
+    if mode == 'copy':
+        _load_with_copy(db, buffer, max_rating_id)
+    elif mode == 'keyset':
+        _load_with_keyset(db, buffer, max_rating_id, batch_size)
+    else:
+        raise ValueError(f'Неизвестный режим загрузки оценок: {mode}')
+
+    logger.info(f'Загружено {buffer.size} оценок (режим: {mode})')
+    return buffer.finish(max_rating_id)
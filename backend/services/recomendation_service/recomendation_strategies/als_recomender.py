@@ -0,0 +1,174 @@
+from typing import List, Dict, Any, Iterable
+import numpy as np
+from scipy.sparse import csr_matrix
+from services.recomendation_service.als_model import AlsModel
+from .base_recomendation import BaseRecommenderStrategy, RecommendationItem
+
+
+class AlsStrategy(BaseRecommenderStrategy):
+    def __init__(self):
+        super().__init__(
+            name='als',
+            description='Рекомендации на основе матричной факторизации (ALS)'
+        )
+        self.data_provider = None
+        # оценок, при которых уверенность достигает 0.5
+        self.confidence_ratings = 5
+
+    def setup(self, data_provider) -> None:
+        self.data_provider = data_provider
+        self._setup_done = True
+
+    def can_recommend(self, user_id: int, data_provider = None) -> bool:
+        if not self._setup_done and data_provider:
+            self.setup(data_provider)
+
+        if not self.data_provider:
+            return False
+
+        user_ratings = self.data_provider.get_user_ratings(user_id)
+        return len(user_ratings) >= 1
+
+    def get_requirements(self) -> Dict[str, Any]:
+        base_reqs = super().get_requirements()
+        base_reqs.update({
+            'min_user_ratings': 1,
+            'supports_new_users': True,   # вектор считается fold-in по текущим оценкам
+            'supports_new_items': False
+        })
+        return base_reqs
+
+    def recommend(
+        self,
+        user_id: int,
+        top_n: int = 10,
+        exclude_rated: bool = True,
+        **kwargs
+    ) -> List[RecommendationItem]:
+
+        user_ratings = self.data_provider.get_user_ratings(user_id)
+        if not user_ratings:
+            return self._get_fallback_recommendations(top_n)
+
+        model = self._get_model()
+
+        # текущие оценки из БД: оценки после обучения модели учитываются fold-in
+        rating_row = model.rating_rows(
+            np.array([r['perfume_id'] for r in user_ratings], dtype=np.int64),
+            np.array([r['rating'] for r in user_ratings], dtype=np.float32)
+        )
+        if rating_row.nnz == 0:
+            return self._get_fallback_recommendations(top_n)
+
+        vectors, folded_in = model.user_vectors(np.array([user_id], dtype=np.int64), rating_row)
+        top, scores = model.top_n(vectors, top_n, exclude=rating_row if exclude_rated else None)
+
+        return self._to_items(model, top[0], scores[0], rating_row.nnz, bool(folded_in[0]))
+
+    def recommend_many(
+        self,
+        user_ids: Iterable[int],
+        top_n: int = 10,
+        exclude_rated: bool = True,
+        block_size: int = 1024,
+        **kwargs
+    ) -> Dict[int, List[RecommendationItem]]:
+        # Пакетные рекомендации: векторы блока пользователей (из модели или fold-in по строкам
+        # снапшота), оценки каталога - одно произведение (блок × k) · (k × парфюмы)
+        user_ids = list(user_ids)
+        matrix_manager = self.data_provider._matrix_manager
+        rating_matrix = self.data_provider.get_rating_matrix(format_csr=True)
+        model = self._get_model()
+
+        known, results = self._split_batch_users(user_ids, matrix_manager, top_n)
+        column_map = self._column_map(model, matrix_manager)
+
+        for start in range(0, len(known), block_size):
+            block = known[start:start + block_size]
+            block_ids = np.array([user_id for user_id, _ in block], dtype=np.int64)
+            block_rows = rating_matrix[np.array([idx for _, idx in block], dtype=np.int64)]
+            if column_map is not None:
+                block_rows = self._remap_columns(block_rows, column_map, model.n_items)
+
+            vectors, folded_in = model.user_vectors(block_ids, block_rows)
+            top, scores = model.top_n(vectors, top_n, exclude=block_rows if exclude_rated else None)
+
+            for row, user_id in enumerate(block_ids.tolist()):
+                n_ratings = block_rows.indptr[row + 1] - block_rows.indptr[row]
+                results[user_id] = self._to_items(model, top[row], scores[row], n_ratings, bool(folded_in[row]))
+
+        return results
+
+    def score_candidates(
+        self,
+        user_id: int,
+        user_ratings: List[Dict[str, Any]],
+        perfume_ids: np.ndarray
+    ) -> np.ndarray:
+        # O(k · кандидатов): строки факторов только кандидатов
+        model = self._get_model()
+        scores = np.full(len(perfume_ids), np.nan, dtype=np.float32)
+
+        rating_row = model.rating_rows(
+            np.array([r['perfume_id'] for r in user_ratings], dtype=np.int64),
+            np.array([r['rating'] for r in user_ratings], dtype=np.float32)
+        )
+        if rating_row.nnz == 0:
+            return scores
+
+        vectors, _ = model.user_vectors(np.array([user_id], dtype=np.int64), rating_row)
+        item_idx = model.item_mapping.indices_of(perfume_ids)
+        known = item_idx >= 0
+        scores[known] = np.clip(model.item_factors[item_idx[known]] @ vectors[0] + model.global_mean, 0.0, 5.0)
+        return scores
+
+    def _get_model(self) -> AlsModel:
+        return self.data_provider.get_als_model()
+
+    @staticmethod
+    def _column_map(model: AlsModel, matrix_manager):
+        # столбцы снапшота -> столбцы модели (None - совпадают)
+        perfume_ids = matrix_manager.perfume_mapping.ids
+        if np.array_equal(perfume_ids, model.item_ids):
+            return None
+        return model.item_mapping.indices_of(perfume_ids)
+
+    @staticmethod
+    def _remap_columns(rows: csr_matrix, column_map: np.ndarray, n_items: int) -> csr_matrix:
+        # парфюмы, которых не было при обучении, отбрасываются
+        rows = rows.tocoo()
+        columns = column_map[rows.col]
+        known = columns >= 0
+        return csr_matrix(
+            (rows.data[known], (rows.row[known], columns[known])),
+            shape=(rows.shape[0], n_items)
+        )
+
+    def _to_items(
+        self,
+        model: AlsModel,
+        top: np.ndarray,
+        scores: np.ndarray,
+        n_ratings: int,
+        folded_in: bool
+    ) -> List[RecommendationItem]:
+        confidence = n_ratings / (n_ratings + self.confidence_ratings)
+
+        recommendations = []
+        for item_idx, score in zip(top, scores):
+            if not np.isfinite(score):
+                break
+            recommendations.append(
+                RecommendationItem(
+                    perfume_id=int(model.item_ids[item_idx]),
+                    score=float(np.clip(score, 0.0, 5.0)),
+                    confidence=float(confidence),
+                    explanation={
+                        'method': self.name,
+                        'factors': model.n_factors,
+                        'folded_in': folded_in
+                    }
+                )
+            )
+
+        return recommendations
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Iterable, Optional
 import numpy as np
 from dataclasses import dataclass
 
@@ -8,6 +8,7 @@ class RecommendationItem:
     perfume_id: int
     score: float
     confidence: float = 1.0
+    explanation: Optional[Dict[str, Any]] = None
     
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -37,6 +38,31 @@ class BaseRecommenderStrategy(ABC):
     ) -> List[RecommendationItem]:
         pass
     
+    def recommend_many(
+        self,
+        user_ids: Iterable[int],
+        top_n: int = 10,
+        exclude_rated: bool = True,
+        **kwargs
+    ) -> Dict[int, List[RecommendationItem]]:
+        # базовая реализация - по одному пользователю; стратегии переопределяют
+        # её блочными матричными произведениями
+        return {
+            user_id: self.recommend(user_id, top_n=top_n, exclude_rated=exclude_rated, **kwargs)
+            for user_id in user_ids
+        }
+    
+    def score_candidates(
+        self,
+        user_id: int,
+        user_ratings: List[Dict[str, Any]],
+        perfume_ids: np.ndarray
+    ) -> np.ndarray:
+        # оценки только для переданных кандидатов (второй этап CandidatePipeline);
+        # NaN - стратегия не может оценить парфюм. Базовая реализация не оценивает никого:
+        # кандидаты отбрасываются, и двухэтапная стратегия уходит в запасные рекомендации
+        return np.full(len(perfume_ids), np.nan, dtype=np.float32)
+    
     def can_recommend(self, user_id: int, data_provider) -> bool:
         return True
     
@@ -48,16 +74,101 @@ class BaseRecommenderStrategy(ABC):
             'supports_new_items': True
         }
     
+    def _generate_explanation(self, user_id: int, perfume_id: int, prediction: Any) -> Dict[str, Any]:
+        explanation = {'method': self.name}
+        if isinstance(prediction, dict):
+            # несколько самых весомых источников предсказания
+            for key in ('sources', 'neighbors'):
+                if prediction.get(key):
+                    explanation[key] = prediction[key][:3]
+        return explanation
+    
+    @staticmethod
+    def _select_top_n(scores: np.ndarray, top_n: int) -> np.ndarray:
+        # позиции top_n максимальных значений по убыванию, без полной сортировки
+        if len(scores) > top_n:
+            top = np.argpartition(-scores, top_n - 1)[:top_n]
+        else:
+            top = np.arange(len(scores))
+        return top[np.argsort(-scores[top], kind='stable')]
+    
+    def _split_batch_users(self, user_ids: List[int], matrix_manager, top_n: int):
+        # (user_id, индекс строки) для пользователей из матрицы; остальным - запасной вариант
+        user_idx = matrix_manager.user_mapping.indices_of(user_ids)
+        known = [(user_id, idx) for user_id, idx in zip(user_ids, user_idx.tolist()) if idx >= 0]
+        unknown = [user_id for user_id, idx in zip(user_ids, user_idx.tolist()) if idx < 0]
+        
+        results = {}
+        if unknown:
+            fallback = self._get_fallback_recommendations(top_n)
+            results.update({user_id: fallback for user_id in unknown})
+        
+        return known, results
+    
+    def _rank_batch_rows(
+        self,
+        user_ids: List[int],
+        weighted_sum,
+        similarity_sum,
+        n_sources,
+        rated_rows,
+        reverse_mapping,
+        top_n: int,
+        confidence_factor: float
+    ) -> Dict[int, List[RecommendationItem]]:
+        # weighted_sum, similarity_sum, n_sources - CSR (блок пользователей x парфюмы)
+        # с одинаковой структурой; rated_rows - оценки блока для исключения (или None)
+        for matrix in (weighted_sum, similarity_sum, n_sources):
+            matrix.sort_indices()
+        
+        results = {}
+        for row, user_id in enumerate(user_ids):
+            start, end = similarity_sum.indptr[row], similarity_sum.indptr[row + 1]
+            items = similarity_sum.indices[start:end]
+            sims = similarity_sum.data[start:end]
+            keep = sims > 0
+            
+            if rated_rows is not None:
+                rated = rated_rows.indices[rated_rows.indptr[row]:rated_rows.indptr[row + 1]]
+                keep &= ~np.isin(items, rated)
+            
+            items = items[keep]
+            sims = sims[keep]
+            scores = np.clip(weighted_sum.data[start:end][keep] / sims, 0.0, 5.0)
+            counts = n_sources.data[start:end][keep]
+            
+            recommendations = []
+            for pos in self._select_top_n(scores, top_n):
+                recommendations.append(
+                    RecommendationItem(
+                        perfume_id=reverse_mapping[int(items[pos])],
+                        score=float(scores[pos]),
+                        confidence=min(1.0, float(sims[pos] / counts[pos]) * confidence_factor),
+                        explanation={'method': self.name}
+                    )
+                )
+            results[user_id] = recommendations
+        
+        return results
+    
     def _get_fallback_recommendations(self, top_n: int) -> List[RecommendationItem]:
         try:
-            all_perfumes = self.data_provider.get_all_perfumes()
-            recommendations = []
+            # самые популярные парфюмы, если оценённых мало - дополняем по каталогу
+            perfume_ids = self.data_provider.get_popular_perfumes(top_n).tolist()
+            if len(perfume_ids) < top_n:
+                popular = set(perfume_ids)
+                perfume_ids.extend(
+                    [perfume['id'] for perfume in self.data_provider.get_all_perfumes()
+                     if perfume['id'] not in popular][:top_n - len(perfume_ids)]
+                )
             
-            for perfume in all_perfumes[:top_n]:
+            recommendations = []
+            for perfume_id in perfume_ids:
+                stats = self.data_provider.get_perfume_rating_stats(perfume_id)
                 recommendations.append(
                     RecommendationItem(
-                        perfume_id=perfume['id'],
-                        score=3.5,
+                        perfume_id=perfume_id,
+                        score=stats['rating_mean'] if stats else 3.5,
                         confidence=0.2,
                         explanation={
                             'method': self.name,
@@ -1,6 +1,7 @@
-from typing import List, Dict, Any, Optional, Set
+from typing import List, Dict, Any, Iterable, Optional
 import numpy as np
-from collections import defaultdict
+from scipy.sparse import csr_matrix
+from services.recomendation_service.feature_matrix import PerfumeFeatureMatrix
 from .base_recomendation import BaseRecommenderStrategy, RecommendationItem
 
 class ContentBasedStrategy(BaseRecommenderStrategy):
@@ -16,7 +17,6 @@ class ContentBasedStrategy(BaseRecommenderStrategy):
             'price_category': 0.1,
             'notes': 0.15 
         }
-        self._perfume_vectors = {}  # кеш векторов признаков
     
     def setup(self, data_provider) -> None:
         self.data_provider = data_provider
@@ -54,165 +54,120 @@ class ContentBasedStrategy(BaseRecommenderStrategy):
         user_ratings = self.data_provider.get_user_ratings(user_id)
         if not user_ratings:
             return self._get_fallback_recommendations(top_n)
-
-        rated_perfume_ids = [r['perfume_id'] for r in user_ratings]
-        rated_perfumes = set(rated_perfume_ids)
-
-        user_profile = self._build_user_profile(rated_perfume_ids, user_ratings)
-        
-        all_perfumes = self.data_provider.get_all_perfumes()
         
-        similarities = []
-        for perfume in all_perfumes:
-            perfume_id = perfume['id']
-            
-            if exclude_rated and perfume_id in rated_perfumes:
-                continue
-            
-            perfume_vector = self._get_perfume_vector(perfume_id, perfume)
-            if perfume_vector is None:
-                continue
-            
-            similarity = self._calculate_similarity(user_profile, perfume_vector)
+        # Матрица парфюм x признак предвычислена и общая для всех запросов
+        feature_matrix = self.data_provider.get_perfume_feature_matrix()
+        rating_row = self._build_rating_row(feature_matrix, user_ratings)
+        
+        # Профиль пользователя - разреженный вектор признаков,
+        # оценка всего каталога - одно произведение матрицы на вектор
+        profile = feature_matrix.build_profiles(rating_row)
+        scores = feature_matrix.score(profile, self.feature_weights)[0]
+        
+        return self._rank_scores(
+            feature_matrix,
+            scores,
+            profile,
+            rated_rows=rating_row.indices if exclude_rated else None,
+            top_n=top_n
+        )
+    
+    def recommend_many(
+        self,
+        user_ids: Iterable[int],
+        top_n: int = 10,
+        exclude_rated: bool = True,
+        block_size: int = 1024,
+        **kwargs
+    ) -> Dict[int, List[RecommendationItem]]:
+        # Оценки пользователей берутся из строк матрицы снапшота (без запросов на пользователя),
+        # профили и оценки каталога для блока пользователей - произведения разреженных матриц
+        user_ids = list(user_ids)
+        matrix_manager = self.data_provider._matrix_manager
+        rating_matrix = self.data_provider.get_rating_matrix(format_csr=True)
+        feature_matrix = self.data_provider.get_perfume_feature_matrix()
+        
+        # столбцы матрицы оценок -> строки каталога признаков
+        selection = feature_matrix.selection_matrix(matrix_manager.perfume_mapping.ids)
+        
+        known, results = self._split_batch_users(user_ids, matrix_manager, top_n)
+        
+        for start in range(0, len(known), block_size):
+            block = known[start:start + block_size]
+            rating_rows = (rating_matrix[np.array([idx for _, idx in block], dtype=np.int64)] @ selection).tocsr()
+            profiles = feature_matrix.build_profiles(rating_rows)
+            scores = feature_matrix.score(profiles, self.feature_weights)
             
-            if similarity > 0:
-                similarities.append((perfume_id, similarity))
+            for row, (user_id, _) in enumerate(block):
+                rated_rows = rating_rows.indices[rating_rows.indptr[row]:rating_rows.indptr[row + 1]]
+                results[user_id] = self._rank_scores(
+                    feature_matrix,
+                    scores[row],
+                    profiles[row],
+                    rated_rows=rated_rows if exclude_rated else None,
+                    top_n=top_n
+                )
         
-        similarities.sort(key=lambda x: x[1], reverse=True)
+        return results
+    
+    def score_candidates(
+        self,
+        user_id: int,
+        user_ratings: List[Dict[str, Any]],
+        perfume_ids: np.ndarray
+    ) -> np.ndarray:
+        # профиль пользователя сравнивается только со строками кандидатов
+        feature_matrix = self.data_provider.get_perfume_feature_matrix()
+        scores = np.full(len(perfume_ids), np.nan, dtype=np.float32)
+        
+        rows = feature_matrix.rows_of(perfume_ids)
+        known = rows >= 0
+        rating_row = self._build_rating_row(feature_matrix, user_ratings)
+        if rating_row.nnz == 0 or not known.any():
+            return scores
+        
+        profile = feature_matrix.build_profiles(rating_row)
+        scores[known] = feature_matrix.score(profile, self.feature_weights, rows=rows[known])[0]
+        return scores
+    
+    def _build_rating_row(self, feature_matrix: PerfumeFeatureMatrix, user_ratings: List[Dict]) -> csr_matrix:
+        # оценки пользователя как строка (1 x парфюмы каталога)
+        return feature_matrix.rating_row(
+            [r['perfume_id'] for r in user_ratings],
+            [r['rating'] for r in user_ratings]
+        )
+    
+    def _rank_scores(
+        self,
+        feature_matrix: PerfumeFeatureMatrix,
+        scores: np.ndarray,
+        profile: csr_matrix,
+        rated_rows: Optional[np.ndarray],
+        top_n: int
+    ) -> List[RecommendationItem]:
+        if rated_rows is not None and len(rated_rows):
+            scores = scores.copy()
+            scores[rated_rows] = 0.0
+        
+        profile_dense = profile.toarray().ravel()
+        perfume_ids = feature_matrix.perfume_mapping.ids
         
         recommendations = []
-        for perfume_id, score in similarities[:top_n]:
-
-            explanation = self._generate_explanation(
-                user_profile, 
-                perfume_id, 
-                score
-            )
+        for row in self._select_top_n(scores, top_n):
+            score = float(scores[row])
+            if score <= 0:
+                break
             
             recommendations.append(
                 RecommendationItem(
-                    perfume_id=perfume_id,
-                    score=float(score),
-                    confidence=min(score * 2, 1.0)
+                    perfume_id=int(perfume_ids[row]),
+                    score=score,
+                    confidence=min(score * 2, 1.0),
+                    explanation={
+                        'method': self.name,
+                        'matched_features': feature_matrix.explain(int(row), profile_dense, self.feature_weights)
+                    }
                 )
             )
         
         return recommendations
-    
-    def _build_user_profile(self, perfume_ids: List[int], user_ratings: List[Dict]) -> Dict[str, Any]:
-        profile = {
-            'brand_preferences': defaultdict(float),
-            'intensity_preferences': defaultdict(float),
-            'price_preferences': defaultdict(float),
-            'notes_preferences': defaultdict(float),
-            'total_weight': 0
-        }
-        
-        for rating in user_ratings:
-            perfume_id = rating['perfume_id']
-            rating_score = rating['rating']  # 1-5
-            
-            features = self.data_provider.get_perfume_features(perfume_id)
-            if not features:
-                continue
-
-            weight = rating_score / 5.0
-            
-            # агрегируем предпочтения
-            if features.get('brand'):
-                profile['brand_preferences'][features['brand']] += weight
-            if features.get('gender'):
-                profile['gender_preferences'][features['gender']] += weight
-            if features.get('season'):
-                for season in features['season']:
-                    profile['season_preferences'][season] += weight
-            if features.get('intensity'):
-                profile['intensity_preferences'][features['intensity']] += weight
-            if features.get('price_category'):
-                profile['price_preferences'][features['price_category']] += weight
-            if features.get('notes'):
-                for note_type, notes in features['notes'].items():
-                    for note in notes:
-                        profile['notes_preferences'][note] += weight
-            
-            profile['total_weight'] += weight
-        
-
-        if profile['total_weight'] > 0:
-            for key in ['brand', 'gender', 'season', 'intensity', 'price', 'notes']:
-                pref_key = f'{key}_preferences'
-                for pref in profile[pref_key]:
-                    profile[pref_key][pref] /= profile['total_weight']
-        
-        return profile
-    
-    def _get_perfume_vector(self, perfume_id: int, perfume_data: Dict = None) -> Optional[Dict]:
-        if perfume_id in self._perfume_vectors:
-            return self._perfume_vectors[perfume_id]
-        
-        if perfume_data is None:
-            features = self.data_provider.get_perfume_features(perfume_id)
-        else:
-            features = perfume_data
-        
-        if not features:
-            return None
-        
-        vector = {}
-        
-        if features.get('brand'):
-            vector['brand'] = {features['brand']: 1.0}
-        if features.get('intensity'):
-            vector['intensity'] = {features['intensity']: 1.0}
-        if features.get('price_category'):
-            vector['price_category'] = {features['price_category']: 1.0}
-        if features.get('notes'):
-            notes_dict = {}
-            for note_type, notes in features['notes'].items():
-                for note in notes:
-                    notes_dict[note] = 1.0
-            vector['notes'] = notes_dict
-        
-        self._perfume_vectors[perfume_id] = vector
-        return vector
-    
-    def _calculate_similarity(
-        self, 
-        user_profile: Dict, 
-        perfume_vector: Dict
-    ) -> float:
-        total_similarity = 0.0
-        total_weight = 0.0
-        
-        for feature_type, weight in self.feature_weights.items():
-            user_pref_key = f'{feature_type}_preferences'
-            perfume_feat_key = feature_type
-            
-            if user_pref_key in user_profile and perfume_feat_key in perfume_vector:
-
-                feature_similarity = self._calculate_feature_similarity(
-                    user_profile[user_pref_key],
-                    perfume_vector[perfume_feat_key]
-                )
-                
-                total_similarity += feature_similarity * weight
-                total_weight += weight
-        
-        return total_similarity / total_weight if total_weight > 0 else 0
-    
-    def _calculate_feature_similarity(
-        self, 
-        user_preferences: Dict[str, float], 
-        perfume_features: Dict[str, float]
-    ) -> float:
-        if not user_preferences or not perfume_features:
-            return 0.0
-        
-        similarity = 0.0
-        for feature, perfume_weight in perfume_features.items():
-            if feature in user_preferences:
-                similarity += user_preferences[feature] * perfume_weight
-        
-        max_similarity = sum(perfume_features.values())
-        return similarity / max_similarity if max_similarity > 0 else 0
-    
\ No newline at end of file
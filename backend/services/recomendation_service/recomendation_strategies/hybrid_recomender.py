@@ -0,0 +1,95 @@
+from typing import List, Dict, Any, Optional, Type
+from services.recomendation_service.hybrid_orchestrator import (
+    DEFAULT_HYBRID_BUDGET_SECONDS, DEFAULT_HYBRID_WEIGHTS, HybridOrchestrator, StrategyRun
+)
+from .base_recomendation import BaseRecommenderStrategy, RecommendationItem
+from .content_based_recomender import ContentBasedStrategy
+from .item_based_recomender import ItemBasedStrategy
+from .user_based_recomender import UserBasedStrategy
+
+
+# Стратегии, которые гибрид умеет смешивать
+COMPONENTS: Dict[str, Type[BaseRecommenderStrategy]] = {
+    'item_based_cf': ItemBasedStrategy,
+    'user_based': UserBasedStrategy,
+    'content_based': ContentBasedStrategy,
+}
+
+
+class HybridStrategy(BaseRecommenderStrategy):
+    def __init__(self):
+        super().__init__(
+            name='hybrid',
+            description='Гибридные рекомендации: смесь стратегий, успевших к сроку запроса'
+        )
+        self.data_provider = None
+        self.weights = dict(DEFAULT_HYBRID_WEIGHTS)
+        self.budget_seconds = DEFAULT_HYBRID_BUDGET_SECONDS
+        # итоги стратегий последнего запроса (статус и время)
+        self.last_runs: List[StrategyRun] = []
+
+    def setup(self, data_provider) -> None:
+        self.data_provider = data_provider
+        self._setup_done = True
+
+    def can_recommend(self, user_id: int, data_provider = None) -> bool:
+        if not self._setup_done and data_provider:
+            self.setup(data_provider)
+
+        return self.data_provider is not None
+
+    def get_requirements(self) -> Dict[str, Any]:
+        base_reqs = super().get_requirements()
+        base_reqs.update({
+            'min_user_ratings': 1,
+            'components': self.weights,
+            'budget_seconds': self.budget_seconds
+        })
+        return base_reqs
+
+    def recommend(
+        self,
+        user_id: int,
+        top_n: int = 10,
+        exclude_rated: bool = True,
+        budget_seconds: Optional[float] = None,
+        **kwargs
+    ) -> List[RecommendationItem]:
+
+        # оценки читаются из БД один раз; стратегии получают их из контекста
+        user_ratings = self.data_provider.get_user_ratings(user_id)
+        if not user_ratings:
+            self.last_runs = []
+            return self._get_fallback_recommendations(top_n)
+
+        provider = self.data_provider.with_user_context(user_id, user_ratings)
+        components = {}
+        for name in self.weights:
+            component = COMPONENTS[name]()
+            component.setup(provider)
+            components[name] = component
+
+        orchestrator = HybridOrchestrator(components, self.weights, self.budget_seconds)
+        blended, self.last_runs = orchestrator.run(user_id, top_n, exclude_rated, budget_seconds)
+        timings = {run.name: run.to_dict() for run in self.last_runs}
+
+        if not blended:
+            # ни одна стратегия не успела или не нашла кандидатов
+            recommendations = self._get_fallback_recommendations(top_n)
+            for item in recommendations:
+                item.explanation['strategies'] = timings
+            return recommendations
+
+        return [
+            RecommendationItem(
+                perfume_id=perfume_id,
+                score=score,
+                confidence=confidence,
+                explanation={
+                    'method': self.name,
+                    'contributions': contributions,
+                    'strategies': timings
+                }
+            )
+            for perfume_id, score, confidence, contributions in blended
+        ]
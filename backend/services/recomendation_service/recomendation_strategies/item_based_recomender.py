@@ -1,8 +1,8 @@
-from typing import List, Dict, Any, Optional, Set
+from typing import List, Dict, Any, Iterable, Optional, Set, Tuple
 import numpy as np
 from collections import defaultdict
 from scipy.sparse import csr_matrix
-from sklearn.metrics.pairwise import cosine_similarity
+from services.recomendation_service.item_neighbors import ItemNeighborIndex
 from .base_recomendation import BaseRecommenderStrategy, RecommendationItem
 
 
@@ -15,8 +15,6 @@ class ItemBasedStrategy(BaseRecommenderStrategy):
         self.data_provider = None
         self.min_similarity = 0.1
         self.k_neighbors = 50
-        self._item_similarity_cache = {}
-        self._perfume_vectors_cache = {}
     
     def setup(self, data_provider) -> None:
         self.data_provider = data_provider
@@ -59,8 +57,6 @@ class ItemBasedStrategy(BaseRecommenderStrategy):
         if not user_ratings:
             return self._get_fallback_recommendations(top_n)
         
-        # Получаем матрицу оценок
-        rating_matrix = self.data_provider.get_rating_matrix(format_csr=True)
         matrix_manager = self.data_provider._matrix_manager
         
         # Маппинги ID - индекс
@@ -69,10 +65,8 @@ class ItemBasedStrategy(BaseRecommenderStrategy):
         
         # Собираем оценки пользователя
         rated_items = {}
-        user_rated_ids = set()
         for rating in user_ratings:
             perfume_id = rating['perfume_id']
-            user_rated_ids.add(perfume_id)
             if perfume_id in perfume_mapping:
                 idx = perfume_mapping[perfume_id]
                 rated_items[idx] = rating['rating']
@@ -80,27 +74,20 @@ class ItemBasedStrategy(BaseRecommenderStrategy):
         if not rated_items:
             return self._get_fallback_recommendations(top_n)
         
-        # Вычисляем или получаем матрицу схожести
-        item_sim_matrix = self._get_item_similarity_matrix(rating_matrix)
+        # Индекс top-K соседей парфюмов (предвычислен для снапшота)
+        neighbor_index = self._get_item_neighbors()
         
-        # Предсказываем оценки
-        predictions = self._predict_ratings(
+        # Предсказываем оценки и сразу выбираем топ-N
+        sorted_predictions = self._predict_ratings(
             rated_items, 
-            item_sim_matrix, 
+            neighbor_index, 
             reverse_perfume_mapping,
-            exclude_rated=exclude_rated,
-            user_rated_ids=user_rated_ids
-        )
-        
-        # Сортируем и выбираем топ-N
-        sorted_predictions = sorted(
-            predictions.items(), 
-            key=lambda x: x[1]['score'], 
-            reverse=True
+            top_n=top_n,
+            exclude_rated=exclude_rated
         )
         
         recommendations = []
-        for perfume_id, pred_data in sorted_predictions[:top_n]:
+        for perfume_id, pred_data in sorted_predictions:
             explanation = self._generate_explanation(
                 user_id, 
                 perfume_id, 
@@ -118,106 +105,185 @@ class ItemBasedStrategy(BaseRecommenderStrategy):
         
         return recommendations
     
-    def _get_item_similarity_matrix(self, rating_matrix: csr_matrix) -> csr_matrix:
-        cache_key = 'item_similarity'
+    def recommend_many(
+        self,
+        user_ids: Iterable[int],
+        top_n: int = 10,
+        exclude_rated: bool = True,
+        block_size: int = 1024,
+        **kwargs
+    ) -> Dict[int, List[RecommendationItem]]:
+        # Пакетные рекомендации: оценки берутся из строк матрицы снапшота,
+        # предсказания для блока пользователей - произведение матриц (блок x парфюмы) · (парфюмы x парфюмы)
+        user_ids = list(user_ids)
+        matrix_manager = self.data_provider._matrix_manager
+        rating_matrix = self.data_provider.get_rating_matrix(format_csr=True)
         
-        if cache_key in self._item_similarity_cache:
-            return self._item_similarity_cache[cache_key]
+        # схожесть top-K соседей без слабых связей
+        similarity = self._get_item_neighbors().to_csr().copy()
+        similarity.data[similarity.data < self.min_similarity] = 0
+        similarity.eliminate_zeros()
+        similarity_mask = similarity.copy()
+        similarity_mask.data = np.ones_like(similarity_mask.data)
         
-        # Пытаемся получить предвычисленную матрицу
-        try:
-            item_sim_matrix = self.data_provider.get_item_similarity_matrix()
-            if item_sim_matrix is not None:
-                self._item_similarity_cache[cache_key] = item_sim_matrix
-                return item_sim_matrix
-        except Exception as e:
-            print(f"Не удалось получить предвычисленную матрицу схожести: {e}")
+        known, results = self._split_batch_users(user_ids, matrix_manager, top_n)
         
-        # Вычисляем схожесть самостоятельно
-        print("Вычисление матрицы схожести парфюмов...")
+        for start in range(0, len(known), block_size):
+            block = known[start:start + block_size]
+            block_rows = rating_matrix[np.array([idx for _, idx in block], dtype=np.int64)]
+            rated_mask = block_rows.copy()
+            rated_mask.data = np.ones_like(rated_mask.data)
+            
+            results.update(self._rank_batch_rows(
+                [user_id for user_id, _ in block],
+                weighted_sum=block_rows @ similarity,
+                similarity_sum=rated_mask @ similarity,
+                n_sources=rated_mask @ similarity_mask,
+                rated_rows=block_rows if exclude_rated else None,
+                reverse_mapping=matrix_manager.reverse_perfume_mapping,
+                top_n=top_n,
+                confidence_factor=2.0
+            ))
         
-        # Транспонируем для работы с парфюмами
-        item_matrix = rating_matrix.T.astype(np.float32)
+        return results
+    
+    def score_candidates(
+        self,
+        user_id: int,
+        user_ratings: List[Dict[str, Any]],
+        perfume_ids: np.ndarray
+    ) -> np.ndarray:
+        # Взвешенное среднее оценок по соседям-кандидатам: просматриваются только
+        # K соседей каждого оценённого парфюма (|оценки| * K), а не столбцы каталога
+        perfume_mapping = self.data_provider._matrix_manager.perfume_mapping
+        scores = np.full(len(perfume_ids), np.nan, dtype=np.float32)
+        
+        rated_idx = perfume_mapping.indices_of([r['perfume_id'] for r in user_ratings])
+        ratings = np.array([r['rating'] for r in user_ratings], dtype=np.float32)
+        known = rated_idx >= 0
+        if not known.any() or len(perfume_ids) == 0:
+            return scores
         
-        # Нормализуем (убираем среднее)
-        item_means = item_matrix.mean(axis=1)
-        item_matrix_normalized = item_matrix - item_means.reshape(-1, 1)
+        similarity_rows = self._get_item_neighbors().to_csr()[rated_idx[known]]
         
-        # Вычисляем косинусную схожесть
-        similarity = cosine_similarity(item_matrix_normalized, dense_output=False)
+        candidate_idx = perfume_mapping.indices_of(perfume_ids)
+        order = np.argsort(candidate_idx, kind='stable')
+        sorted_idx = candidate_idx[order]
+        positions = np.minimum(np.searchsorted(sorted_idx, similarity_rows.indices), len(sorted_idx) - 1)
+        match = (sorted_idx[positions] == similarity_rows.indices) & (similarity_rows.data >= self.min_similarity)
         
-        # Кешируем результат
-        self._item_similarity_cache[cache_key] = similarity
+        candidate_pos = order[positions[match]]
+        similarities = similarity_rows.data[match]
+        source_ratings = np.repeat(ratings[known], np.diff(similarity_rows.indptr))[match]
         
-        return similarity
+        weighted_sum = np.bincount(candidate_pos, weights=similarities * source_ratings, minlength=len(perfume_ids))
+        similarity_sum = np.bincount(candidate_pos, weights=similarities, minlength=len(perfume_ids))
+        scored = similarity_sum > 0
+        scores[scored] = np.clip(weighted_sum[scored] / similarity_sum[scored], 0.0, 5.0)
+        return scores
+    
+    def _get_item_neighbors(self) -> ItemNeighborIndex:
+        return self.data_provider.get_item_neighbors(self.k_neighbors)
+    
+    def similar_perfumes(self, perfume_id: int, top_n: int = 10) -> List[RecommendationItem]:
+        # "похожие парфюмы": читаем только K соседей, а не строку размером с каталог
+        matrix_manager = self.data_provider._matrix_manager
+        perfume_idx = matrix_manager.perfume_mapping.get(perfume_id)
+        if perfume_idx is None:
+            return []
+        
+        neighbor_indices, similarities = self._get_item_neighbors().neighbors(perfume_idx)
+        
+        recommendations = []
+        for item_idx, similarity in zip(neighbor_indices[:top_n], similarities[:top_n]):
+            if similarity < self.min_similarity:
+                break
+            recommendations.append(
+                RecommendationItem(
+                    perfume_id=matrix_manager.reverse_perfume_mapping[int(item_idx)],
+                    score=float(similarity),
+                    confidence=min(1.0, float(similarity) * 2),
+                    explanation={'method': self.name, 'similar_to': perfume_id}
+                )
+            )
+        
+        return recommendations
     
     def _predict_ratings(
         self,
         rated_items: Dict[int, float],
-        similarity_matrix: csr_matrix,
+        neighbor_index: ItemNeighborIndex,
         reverse_mapping: Dict[int, int],
-        exclude_rated: bool = True,
-        user_rated_ids: Set[int] = None
-    ) -> Dict[int, Dict[str, Any]]:
-        predictions = {}
-        
-        # Для каждого оцененного парфюма
-        for rated_idx, rating in rated_items.items():
-            # Получаем схожести с другими парфюмами
-            similarities = similarity_matrix[rated_idx].toarray().flatten()
+        top_n: int = 10,
+        exclude_rated: bool = True
+    ) -> List[Tuple[int, Dict[str, Any]]]:
+        rated_idx = np.fromiter(rated_items.keys(), dtype=np.int64, count=len(rated_items))
+        ratings = np.fromiter(rated_items.values(), dtype=np.float32, count=len(rated_items))
+        
+        # Строки схожести только оцененных парфюмов (в каждой не более K соседей),
+        # слабые связи отбрасываем
+        similarity_rows = neighbor_index.to_csr()[rated_idx]
+        similarity_rows.data[similarity_rows.data < self.min_similarity] = 0
+        similarity_rows.eliminate_zeros()
+        
+        # Числитель и знаменатель взвешенного среднего - два произведения разреженной матрицы на вектор
+        similarity_by_item = similarity_rows.T.tocsr()
+        weighted_sum = similarity_by_item @ ratings
+        similarity_sum = similarity_by_item @ np.ones_like(ratings)
+        n_sources = np.diff(similarity_by_item.indptr)
+        
+        # Кандидаты - парфюмы хотя бы с одним источником, уже оцененные исключаем маской
+        candidates = similarity_sum > 0
+        if exclude_rated:
+            candidates[rated_idx] = False
+        candidate_idx = np.flatnonzero(candidates)
+        if len(candidate_idx) == 0:
+            return []
+        
+        # Взвешенное среднее, нормализуем к 0-5
+        scores = np.clip(weighted_sum[candidate_idx] / similarity_sum[candidate_idx], 0.0, 5.0)
+        
+        # Топ-N без полной сортировки
+        top = self._select_top_n(scores, top_n)
+        
+        predictions = []
+        for pos in top:
+            item_idx = int(candidate_idx[pos])
+            perfume_id = reverse_mapping.get(item_idx)
+            if perfume_id is None:
+                continue
             
-            # Находим индексы схожих парфюмов
-            similar_indices = np.where(similarities >= self.min_similarity)[0]
+            # Уверенность на основе силы схожести
+            avg_similarity = similarity_sum[item_idx] / n_sources[item_idx]
+            confidence = min(1.0, float(avg_similarity) * 2)
             
-            for item_idx in similar_indices:
-                # Пропускаем сам парфюм
-                if item_idx == rated_idx:
-                    continue
-                
-                # Получаем ID парфюма
-                perfume_id = reverse_mapping.get(item_idx)
-                if not perfume_id:
-                    continue
-                
-                # Пропускаем уже оцененные
-                if exclude_rated and user_rated_ids and perfume_id in user_rated_ids:
-                    continue
-                
-                similarity = similarities[item_idx]
-                
-                if perfume_id not in predictions:
-                    predictions[perfume_id] = {
-                        'weighted_sum': 0.0,
-                        'similarity_sum': 0.0,
-                        'source_items': []
-                    }
-                
-                predictions[perfume_id]['weighted_sum'] += rating * similarity
-                predictions[perfume_id]['similarity_sum'] += similarity
-                predictions[perfume_id]['source_items'].append({
-                    'source_perfume': reverse_mapping.get(rated_idx),
-                    'similarity': float(similarity),
-                    'rating': rating
-                })
-        
-        # Вычисляем итоговые оценки
-        final_predictions = {}
-        for perfume_id, data in predictions.items():
-            if data['similarity_sum'] > 0:
-                # Взвешенное среднее
-                score = data['weighted_sum'] / data['similarity_sum']
-                
-                # Нормализуем к 0-5
-                score = max(0.0, min(5.0, score))
-                
-                # Уверенность на основе силы схожести
-                avg_similarity = data['similarity_sum'] / len(data['source_items'])
-                confidence = min(1.0, avg_similarity * 2)
-                
-                final_predictions[perfume_id] = {
-                    'score': score,
-                    'confidence': confidence,
-                    'sources': data['source_items']
-                }
-        
-        return final_predictions
\ No newline at end of file
+            predictions.append((perfume_id, {
+                'score': float(scores[pos]),
+                'confidence': confidence,
+                'sources': self._collect_sources(similarity_by_item, item_idx, rated_idx, ratings, reverse_mapping)
+            }))
+        
+        return predictions
+    
+    def _collect_sources(
+        self,
+        similarity_by_item,
+        item_idx: int,
+        rated_idx: np.ndarray,
+        ratings: np.ndarray,
+        reverse_mapping: Dict[int, int]
+    ) -> List[Dict[str, Any]]:
+        # источники предсказания считаем только для попавших в топ-N
+        start, end = similarity_by_item.indptr[item_idx], similarity_by_item.indptr[item_idx + 1]
+        positions = similarity_by_item.indices[start:end]
+        similarities = similarity_by_item.data[start:end]
+        order = np.argsort(-similarities, kind='stable')
+        
+        return [
+            {
+                'source_perfume': reverse_mapping.get(int(rated_idx[p])),
+                'similarity': float(similarities[o]),
+                'rating': float(ratings[p])
+            }
+            for o, p in zip(order, positions[order])
+        ]
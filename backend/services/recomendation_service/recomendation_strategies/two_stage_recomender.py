@@ -0,0 +1,97 @@
+from typing import List, Dict, Any, Type
+from services.recomendation_service.candidate_pipeline import (
+    DEFAULT_CANDIDATE_COUNTS, DEFAULT_RECENT_RATINGS, CandidatePipeline
+)
+from .als_recomender import AlsStrategy
+from .base_recomendation import BaseRecommenderStrategy, RecommendationItem
+from .content_based_recomender import ContentBasedStrategy
+from .item_based_recomender import ItemBasedStrategy
+
+
+# Стратегии, умеющие оценивать только переданных кандидатов (score_candidates)
+RERANKERS: Dict[str, Type[BaseRecommenderStrategy]] = {
+    'als': AlsStrategy,
+    'item_based_cf': ItemBasedStrategy,
+    'content_based': ContentBasedStrategy,
+}
+
+
+class TwoStageStrategy(BaseRecommenderStrategy):
+    def __init__(self, reranker: str = 'als'):
+        super().__init__(
+            name='two_stage',
+            description='Двухэтапные рекомендации: отбор кандидатов из нескольких источников и их ранжирование'
+        )
+        if reranker not in RERANKERS:
+            raise ValueError(f'Неизвестная стратегия ранжирования: {reranker}')
+        
+        self.data_provider = None
+        self.reranker_name = reranker
+        self.reranker = RERANKERS[reranker]()
+        # кандидатов из каждого источника: recent_neighbors, popular, content
+        self.candidate_counts = dict(DEFAULT_CANDIDATE_COUNTS)
+        self.recent_ratings = DEFAULT_RECENT_RATINGS
+    
+    def setup(self, data_provider) -> None:
+        self.data_provider = data_provider
+        self.reranker.setup(data_provider)
+        self._setup_done = True
+    
+    def can_recommend(self, user_id: int, data_provider = None) -> bool:
+        if not self._setup_done and data_provider:
+            self.setup(data_provider)
+        
+        if not self.data_provider:
+            return False
+        
+        user_ratings = self.data_provider.get_user_ratings(user_id)
+        return len(user_ratings) >= 1
+    
+    def get_requirements(self) -> Dict[str, Any]:
+        base_reqs = super().get_requirements()
+        base_reqs.update({
+            'min_user_ratings': 1,
+            'supports_new_users': False,
+            'reranker': self.reranker_name,
+            'candidate_counts': self.candidate_counts,
+            'candidate_budget': sum(self.candidate_counts.values())
+        })
+        return base_reqs
+    
+    def recommend(
+        self,
+        user_id: int,
+        top_n: int = 10,
+        exclude_rated: bool = True,
+        **kwargs
+    ) -> List[RecommendationItem]:
+        
+        user_ratings = self.data_provider.get_user_ratings(user_id)
+        if not user_ratings:
+            return self._get_fallback_recommendations(top_n)
+        
+        pipeline = CandidatePipeline(
+            self.data_provider,
+            candidate_counts=self.candidate_counts,
+            recent_ratings=self.recent_ratings,
+            feature_weights=ContentBasedStrategy().feature_weights
+        )
+        ranked = pipeline.rank(self.reranker, user_id, user_ratings, top_n=top_n, exclude_rated=exclude_rated)
+        if not ranked:
+            return self._get_fallback_recommendations(top_n)
+        
+        n_sources = sum(1 for count in self.candidate_counts.values() if count > 0)
+        return [
+            RecommendationItem(
+                perfume_id=perfume_id,
+                score=score,
+                # кандидат, найденный несколькими источниками, надёжнее
+                confidence=len(sources) / n_sources,
+                explanation={
+                    'method': self.name,
+                    'reranker': self.reranker_name,
+                    'sources': sources
+                }
+            )
+            for perfume_id, score, sources in ranked
+        ]
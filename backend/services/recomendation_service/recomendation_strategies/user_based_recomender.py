@@ -1,8 +1,8 @@
-from typing import List, Dict, Any, Optional, Set
+from typing import List, Dict, Any, Iterable, Optional, Set, Tuple
 import numpy as np
 from collections import defaultdict
 from scipy.sparse import csr_matrix
-from sklearn.metrics.pairwise import cosine_similarity
+from services.recomendation_service.user_index import DEFAULT_USER_INDEX_PROBES
 from .base_recomendation import BaseRecommenderStrategy, RecommendationItem
 
 
@@ -15,7 +15,8 @@ class UserBasedStrategy(BaseRecommenderStrategy):
         self.data_provider = None
         self.min_similarity = 0.1
         self.k_neighbors = 30
-        self._user_similarity_cache = {}
+        # соседних корзин LSH на таблицу: больше - выше полнота поиска соседей и дольше запрос
+        self.n_probes = DEFAULT_USER_INDEX_PROBES
     
     def setup(self, data_provider) -> None:
         self.data_provider = data_provider
@@ -41,7 +42,8 @@ class UserBasedStrategy(BaseRecommenderStrategy):
             'supports_new_users': False,
             'supports_new_items': True,
             'similarity_threshold': self.min_similarity,
-            'neighbors_count': self.k_neighbors
+            'neighbors_count': self.k_neighbors,
+            'neighbor_probes': self.n_probes
         })
         return base_reqs
     
@@ -69,39 +71,34 @@ class UserBasedStrategy(BaseRecommenderStrategy):
         # Получаем матрицу оценок
         rating_matrix = self.data_provider.get_rating_matrix(format_csr=True)
         
-        # Получаем матрицу схожести пользователей
-        user_sim_matrix = self._get_user_similarity_matrix(rating_matrix)
-        
-        # Находим схожих пользователей
+        # Находим схожих пользователей через индекс LSH
         similar_users = self._find_similar_users(
             user_idx, 
-            user_sim_matrix, 
+            rating_matrix, 
             matrix_manager.reverse_user_mapping
         )
         
         if not similar_users:
             return self._get_fallback_recommendations(top_n)
         
-        # Собираем оценки схожих пользователей
+        # Собираем оценки схожих пользователей из строк матрицы (без запросов к БД)
         neighbor_predictions = self._collect_neighbor_ratings(
             similar_users,
+            rating_matrix,
             matrix_manager,
             exclude_rated=exclude_rated,
             user_rated_ids=user_rated_ids
         )
         
-        # Вычисляем финальные предсказания
-        final_predictions = self._compute_predictions(neighbor_predictions)
-        
-        # Сортируем и выбираем топ-N
-        sorted_predictions = sorted(
-            final_predictions.items(), 
-            key=lambda x: x[1]['score'], 
-            reverse=True
+        # Вычисляем финальные предсказания и сразу выбираем топ-N
+        sorted_predictions = self._compute_predictions(
+            neighbor_predictions,
+            matrix_manager.reverse_perfume_mapping,
+            top_n=top_n
         )
         
         recommendations = []
-        for perfume_id, pred_data in sorted_predictions[:top_n]:
+        for perfume_id, pred_data in sorted_predictions:
             explanation = self._generate_explanation(
                 user_id, 
                 perfume_id, 
@@ -119,139 +116,177 @@ class UserBasedStrategy(BaseRecommenderStrategy):
         
         return recommendations
     
-    def _get_user_similarity_matrix(self, rating_matrix: csr_matrix) -> csr_matrix:
-        cache_key = 'user_similarity'
-        
-        if cache_key in self._user_similarity_cache:
-            return self._user_similarity_cache[cache_key]
-        
-        # Пытаемся получить предвычисленную матрицу
-        try:
-            user_sim_matrix = self.data_provider.get_user_similarity_matrix()
-            if user_sim_matrix is not None:
-                self._user_similarity_cache[cache_key] = user_sim_matrix
-                return user_sim_matrix
-        except Exception as e:
-            print(f"Не удалось получить предвычисленную матрицу схожести: {e}")
-        
-        # Вычисляем схожесть самостоятельно
-        print("Вычисление матрицы схожести пользователей...")
+    def recommend_many(
+        self,
+        user_ids: Iterable[int],
+        top_n: int = 10,
+        exclude_rated: bool = True,
+        block_size: int = 1024,
+        **kwargs
+    ) -> Dict[int, List[RecommendationItem]]:
+        # Пакетные рекомендации блоками пользователей: top-K соседей каждого пользователя блока
+        # (из индекса LSH) собираются в разреженную матрицу весов W, предсказания - W · R
+        user_ids = list(user_ids)
+        matrix_manager = self.data_provider._matrix_manager
+        rating_matrix = self.data_provider.get_rating_matrix(format_csr=True)
+        user_index = self.data_provider.get_user_neighbors()
         
-        # Нормализуем матрицу оценок
-        user_means = rating_matrix.mean(axis=1)
-        rating_matrix_normalized = rating_matrix - user_means.reshape(-1, 1)
+        rated_mask = rating_matrix.copy()
+        rated_mask.data = np.ones_like(rated_mask.data)
         
-        # Вычисляем косинусную схожесть
-        similarity = cosine_similarity(rating_matrix_normalized, dense_output=False)
+        known, results = self._split_batch_users(user_ids, matrix_manager, top_n)
+        n_users = rating_matrix.shape[0]
         
-        # Кешируем результат
-        self._user_similarity_cache[cache_key] = similarity
+        for start in range(0, len(known), block_size):
+            block = known[start:start + block_size]
+            block_idx = np.array([idx for _, idx in block], dtype=np.int64)
+            
+            neighbors = user_index.query_users(
+                rating_matrix, block_idx, self.k_neighbors, self.n_probes, self.min_similarity
+            )
+            counts = np.array([len(rows) for rows, _ in neighbors], dtype=np.int64)
+            weights = csr_matrix(
+                (
+                    np.concatenate([sims for _, sims in neighbors]) if neighbors else np.empty(0, dtype=np.float32),
+                    (
+                        np.repeat(np.arange(len(block)), counts),
+                        np.concatenate([rows for rows, _ in neighbors]) if neighbors else np.empty(0, dtype=np.int64)
+                    )
+                ),
+                shape=(len(block), n_users)
+            )
+            weights.eliminate_zeros()
+            weights_mask = weights.copy()
+            weights_mask.data = np.ones_like(weights_mask.data)
+            
+            results.update(self._rank_batch_rows(
+                [user_id for user_id, _ in block],
+                weighted_sum=weights @ rating_matrix,
+                similarity_sum=weights @ rated_mask,
+                n_sources=weights_mask @ rated_mask,
+                rated_rows=rating_matrix[block_idx] if exclude_rated else None,
+                reverse_mapping=matrix_manager.reverse_perfume_mapping,
+                top_n=top_n,
+                confidence_factor=1.5
+            ))
         
-        return similarity
+        return results
     
     def _find_similar_users(
         self,
         user_idx: int,
-        similarity_matrix: csr_matrix,
+        rating_matrix: csr_matrix,
         reverse_mapping: Dict[int, int]
     ) -> List[Dict[str, Any]]:
-
-        # Получаем схожести для текущего пользователя
-        similarities = similarity_matrix[user_idx].toarray().flatten()
-        
-        # Ищем пользователей с достаточной схожестью (исключая самого себя)
-        similar_indices = np.where(
-            (similarities >= self.min_similarity) & 
-            (np.arange(len(similarities)) != user_idx)
-        )[0]
-        
-        # Сортируем по схожести и берем топ-K
-        top_indices = sorted(
-            similar_indices, 
-            key=lambda x: similarities[x], 
-            reverse=True
-        )[:self.k_neighbors]
+        # Кандидаты - пользователи из тех же корзин LSH, схожесть считается точно только для них;
+        # top-K уже отсортирован по убыванию схожести
+        user_index = self.data_provider.get_user_neighbors()
+        neighbor_idx, similarities = user_index.query_user(
+            rating_matrix,
+            user_idx,
+            self.k_neighbors,
+            n_probes=self.n_probes,
+            min_similarity=self.min_similarity
+        )
         
         # Формируем список схожих пользователей
-        similar_users = []
-        for idx in top_indices:
-            similar_users.append({
-                'user_id': reverse_mapping[idx],
-                'similarity': float(similarities[idx]),
-                'index': idx
-            })
-        
-        return similar_users
+        return [
+            {
+                'user_id': reverse_mapping[int(idx)],
+                'similarity': float(similarity),
+                'index': int(idx)
+            }
+            for idx, similarity in zip(neighbor_idx, similarities)
+        ]
     
     def _collect_neighbor_ratings(
         self,
         similar_users: List[Dict[str, Any]],
+        rating_matrix: csr_matrix,
         matrix_manager,
         exclude_rated: bool = True,
         user_rated_ids: Set[int] = None
-    ) -> Dict[int, Dict[str, Any]]:
-
-        neighbor_ratings = {}
+    ) -> Dict[str, Any]:
+        # Оценки соседей уже есть в матрице: берем их строки и считаем
+        # взвешенные суммы одним произведением вектора схожести на эти строки
+        neighbor_idx = np.array([n['index'] for n in similar_users], dtype=np.int64)
+        similarities = np.array([n['similarity'] for n in similar_users], dtype=np.float32)
         
-        for neighbor in similar_users:
-            neighbor_id = neighbor['user_id']
-            similarity = neighbor['similarity']
-            
-            # Получаем оценки соседа
-            neighbor_ratings_list = self.data_provider.get_user_ratings(neighbor_id)
-            
-            for rating in neighbor_ratings_list:
-                perfume_id = rating['perfume_id']
-                
-                # Пропускаем если парфюм не в матрице
-                if perfume_id not in matrix_manager.perfume_mapping:
-                    continue
-                
-                # Пропускаем уже оцененные пользователем
-                if exclude_rated and user_rated_ids and perfume_id in user_rated_ids:
-                    continue
-                
-                if perfume_id not in neighbor_ratings:
-                    neighbor_ratings[perfume_id] = {
-                        'weighted_sum': 0.0,
-                        'similarity_sum': 0.0,
-                        'neighbors': []
-                    }
-                
-                neighbor_ratings[perfume_id]['weighted_sum'] += rating['rating'] * similarity
-                neighbor_ratings[perfume_id]['similarity_sum'] += similarity
-                neighbor_ratings[perfume_id]['neighbors'].append({
-                    'user_id': neighbor_id,
-                    'similarity': similarity,
-                    'rating': rating['rating']
-                })
+        neighbor_rows = rating_matrix[neighbor_idx]
+        rated_mask = neighbor_rows.copy()
+        rated_mask.data = np.ones_like(rated_mask.data)
+        
+        weighted_sum = neighbor_rows.T @ similarities
+        similarity_sum = rated_mask.T @ similarities
+        n_neighbors = np.diff(rated_mask.tocsc().indptr)
         
-        return neighbor_ratings
+        # Кандидаты - парфюмы, оцененные хотя бы одним соседом
+        candidates = n_neighbors > 0
+        if exclude_rated and user_rated_ids:
+            rated_idx = matrix_manager.perfume_mapping.indices_of(list(user_rated_ids))
+            candidates[rated_idx[rated_idx >= 0]] = False
+        
+        return {
+            'candidates': np.flatnonzero(candidates),
+            'weighted_sum': weighted_sum,
+            'similarity_sum': similarity_sum,
+            'n_neighbors': n_neighbors,
+            'neighbor_rows': neighbor_rows.tocsc(),
+            'similar_users': similar_users
+        }
     
     def _compute_predictions(
         self, 
-        neighbor_ratings: Dict[int, Dict[str, Any]]
-    ) -> Dict[int, Dict[str, Any]]:
+        neighbor_ratings: Dict[str, Any],
+        reverse_mapping: Dict[int, int],
+        top_n: int = 10
+    ) -> List[Tuple[int, Dict[str, Any]]]:
 
-        predictions = {}
+        candidates = neighbor_ratings['candidates']
+        similarity_sum = neighbor_ratings['similarity_sum'][candidates]
+        candidates = candidates[similarity_sum > 0]
+        if len(candidates) == 0:
+            return []
+        
+        # Взвешенное среднее, нормализуем к 0-5
+        scores = np.clip(
+            neighbor_ratings['weighted_sum'][candidates] / neighbor_ratings['similarity_sum'][candidates],
+            0.0, 5.0
+        )
+        
+        # Топ-N без полной сортировки
+        top = self._select_top_n(scores, top_n)
         
-        for perfume_id, data in neighbor_ratings.items():
-            if data['similarity_sum'] > 0:
-                # Взвешенное среднее
-                score = data['weighted_sum'] / data['similarity_sum']
-                
-                # Нормализуем к 0-5
-                score = max(0.0, min(5.0, score))
-                
-                # Уверенность на основе силы схожести и количества соседей
-                avg_similarity = data['similarity_sum'] / len(data['neighbors'])
-                confidence = min(1.0, avg_similarity * 1.5)
-                
-                predictions[perfume_id] = {
-                    'score': score,
-                    'confidence': confidence,
-                    'neighbors': data['neighbors']
+        neighbor_rows = neighbor_ratings['neighbor_rows']
+        similar_users = neighbor_ratings['similar_users']
+        
+        predictions = []
+        for pos in top:
+            item_idx = int(candidates[pos])
+            perfume_id = reverse_mapping.get(item_idx)
+            if perfume_id is None:
+                continue
+            
+            # Соседи, оценившие парфюм (для уверенности и объяснения)
+            start, end = neighbor_rows.indptr[item_idx], neighbor_rows.indptr[item_idx + 1]
+            neighbors = [
+                {
+                    'user_id': similar_users[row]['user_id'],
+                    'similarity': similar_users[row]['similarity'],
+                    'rating': float(rate)
                 }
+                for row, rate in zip(neighbor_rows.indices[start:end], neighbor_rows.data[start:end])
+            ]
+            neighbors.sort(key=lambda n: n['similarity'], reverse=True)
+            
+            # Уверенность на основе силы схожести и количества соседей
+            avg_similarity = neighbor_ratings['similarity_sum'][item_idx] / neighbor_ratings['n_neighbors'][item_idx]
+            confidence = min(1.0, float(avg_similarity) * 1.5)
+            
+            predictions.append((perfume_id, {
+                'score': float(scores[pos]),
+                'confidence': confidence,
+                'neighbors': neighbors
+            }))
         
         return predictions
-    
\ No newline at end of file
@@ -0,0 +1,203 @@
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Set, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# (user_id, стратегия, top_n, фильтры, версия снапшота)
+CacheKey = Tuple[int, str, int, Tuple, Optional[str]]
+
+
+def make_cache_key(
+        user_id: int,
+        strategy: str,
+        top_n: int,
+        snapshot_version: Optional[str],
+        filters: Optional[Dict[str, Hashable]] = None
+) -> CacheKey:
+    return (user_id, strategy, top_n, tuple(sorted((filters or {}).items())), snapshot_version)
+
+
+class LocalGenerations:
+    # Счётчики инвалидаций пользователей в памяти процесса (один воркер)
+    def __init__(self):
+        self._generations: Dict[int, int] = {}
+
+    def get(self, user_id: int) -> int:
+        return self._generations.get(user_id, 0)
+
+    def bump(self, user_id: int):
+        self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+    def close(self):
+        pass
+
+
+class SharedGenerations:
+    # Счётчики инвалидаций в shared memory: общие для всех воркеров на хосте.
+    # Пользователи раскладываются по n_slots ячейкам; коллизия приводит только к лишнему промаху.
+    # Потерянный при гонке инкремент не страшен - любой инкремент делает записи устаревшими.
+    # Каждый процесс держит разделяемую flock-блокировку файла рядом с сегментом; при close()
+    # последний процесс на хосте (получивший эксклюзивную) удаляет сегмент из /dev/shm
+    def __init__(self, name: str = 'perfumes_rec_cache', n_slots: int = 1 << 16):
+        from multiprocessing import resource_tracker, shared_memory
+
+        # пока закрывающий процесс удаляет сегмент, новый ждёт здесь и затем создаёт свой
+        self._lock_file = open(os.path.join(tempfile.gettempdir(), f'{name}.lock'), 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_SH)
+
+        size = n_slots * np.dtype(np.int64).itemsize
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            np.ndarray((n_slots,), dtype=np.int64, buffer=self._shm.buf)[:] = 0
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+        # удалением управляет close(), а не resource_tracker процесса (он удалил бы сегмент
+        # при выходе любого воркера, в том числе из-под остальных)
+        self._resource_tracker = resource_tracker
+        resource_tracker.unregister(self._shm._name, 'shared_memory')
+        self._counters = np.ndarray((n_slots,), dtype=np.int64, buffer=self._shm.buf)
+        self._n_slots = n_slots
+
+    def get(self, user_id: int) -> int:
+        return int(self._counters[user_id % self._n_slots])
+
+    def bump(self, user_id: int):
+        self._counters[user_id % self._n_slots] += 1
+
+    def close(self) -> bool:
+        # отсоединиться от сегмента; True - процесс был последним и сегмент удалён
+        if self._lock_file.closed:
+            return False
+        self._counters = None
+        self._shm.close()
+
+        unlinked = False
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            # unlink() снимает регистрацию в resource_tracker - возвращаем её для пары
+            self._resource_tracker.register(self._shm._name, 'shared_memory')
+            self._shm.unlink()
+            unlinked = True
+        except BlockingIOError:
+            # сегментом ещё пользуются другие воркеры
+            pass
+        except FileNotFoundError:
+            pass
+        finally:
+            self._lock_file.close()
+        return unlinked
+
+
+class RecommendationResultCache:
+    # LRU-кеш готовых рекомендаций с TTL. Ключ содержит версию снапшота, поэтому
+    # после подмены снапшота старые записи недостижимы и удаляются одним clear().
+    # Запись хранит поколение пользователя на момент вычисления: после его оценки
+    # (в этом или, с SharedGenerations, в другом воркере) запись считается устаревшей
+    def __init__(self, max_entries: int = 10_000, ttl_seconds: float = 600.0, generations=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._generations = generations or LocalGenerations()
+
+        self._entries: 'OrderedDict[CacheKey, Tuple[float, int, Any]]' = OrderedDict()
+        self._keys_by_user: Dict[int, Set[CacheKey]] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: CacheKey) -> Optional[Any]:
+        user_id = key[0]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, generation, value = entry
+                if expires_at > time.monotonic() and generation == self._generations.get(user_id):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+
+            self.misses += 1
+            return None
+
+    def generation(self, user_id: int) -> int:
+        return self._generations.get(user_id)
+
+    def set(self, key: CacheKey, value: Any, generation: Optional[int] = None):
+        # generation - поколение пользователя, прочитанное до вычисления: если он успел
+        # что-то оценить, пока считались рекомендации, запись сразу будет устаревшей
+        user_id = key[0]
+        with self._lock:
+            if generation is None:
+                generation = self._generations.get(user_id)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, generation, value)
+            self._entries.move_to_end(key)
+            self._keys_by_user.setdefault(user_id, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: int):
+        # точечная инвалидация после оценки пользователя
+        with self._lock:
+            self._generations.bump(user_id)
+            for key in list(self._keys_by_user.get(user_id, ())):
+                self._remove(key)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def close(self):
+        # при остановке процесса: общие счётчики (SharedGenerations) освобождаются
+        with self._lock:
+            self.clear()
+            self._generations.close()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+
+    def _remove(self, key: CacheKey):
+        self._entries.pop(key, None)
+        user_keys = self._keys_by_user.get(key[0])
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._keys_by_user[key[0]]
+
+
+def create_result_cache(backend: str = 'local', max_entries: int = 10_000,
+                        ttl_seconds: float = 600.0) -> RecommendationResultCache:
+    # backend: 'local' - один воркер; 'shared' - несколько воркеров uvicorn/gunicorn на одном хосте
+    if backend == 'shared':
+        try:
+            return RecommendationResultCache(max_entries, ttl_seconds, SharedGenerations())
+        except (ImportError, OSError) as e:
+            logger.warning(f'Shared memory для кеша рекомендаций недоступна, используется локальный кеш: {e}')
+    return RecommendationResultCache(max_entries, ttl_seconds)
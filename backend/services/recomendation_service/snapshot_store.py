@@ -0,0 +1,267 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional, Union
+import numpy as np
+from scipy.sparse import csr_matrix, csc_matrix
+from services.recomendation_service.id_mapping import IdMapping, ReverseIdMapping
+
+logger = logging.getLogger(__name__)
+
+# Версия формата каталога снапшота; при несовместимых изменениях увеличивается
+SNAPSHOT_FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+LATEST_NAME = 'LATEST'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class MatrixSnapshot:
+    # Неизменяемый снимок матрицы оценок и маппингов ID.
+    # Массивы открыты через np.load(mmap_mode='r'): открытие не читает данные,
+    # а несколько процессов на одном хосте делят одни и те же страницы page cache
+    name: str
+    path: Path
+    rating_csr_matrix: csr_matrix
+    rating_csc_matrix: csc_matrix
+    user_mapping: IdMapping
+    perfume_mapping: IdMapping
+    metadata: Dict[str, Any] = field(default_factory=dict)
+    stats: Dict[str, Any] = field(default_factory=dict)
+    # производные структуры (матрицы схожести и т.п.) живут вместе со снапшотом
+    _cache: Dict[str, Any] = field(default_factory=dict, repr=False, compare=False)
+    _cache_lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+
+    @property
+    def version(self) -> str:
+        return self.name
+
+    @property
+    def reverse_user_mapping(self) -> ReverseIdMapping:
+        return self.user_mapping.reverse()
+
+    @property
+    def reverse_perfume_mapping(self) -> ReverseIdMapping:
+        return self.perfume_mapping.reverse()
+
+    def create_matrix(self, format_csr: bool = True, **kwargs) -> Union[csr_matrix, csc_matrix]:
+        # тот же интерфейс чтения, что у MatrixManager, но снапшот никогда не перестраивается
+        return self.rating_csr_matrix if format_csr else self.rating_csc_matrix
+
+    def get_or_compute(self, key: str, factory: Callable[[], Any]) -> Any:
+        if key in self._cache:
+            return self._cache[key]
+
+        # вычисляем под блокировкой, чтобы параллельные запросы не считали одно и то же
+        with self._cache_lock:
+            if key not in self._cache:
+                self._cache[key] = factory()
+            return self._cache[key]
+
+
+def _sha256(path: Path, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Не удаётся сериализовать {type(value).__name__}')
+
+
+class SnapshotStore:
+    # Каталог версионированных снапшотов:
+    #   <root>/<name>/{csr,csc}_{indptr,indices,data}.npy, user_ids.npy, perfume_ids.npy,
+    #                 [user_sorter.npy, perfume_sorter.npy], manifest.json
+    #   <root>/LATEST - имя последнего полностью записанного снапшота
+    def __init__(self, root: str, max_versions: int = 5):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_versions = max_versions
+
+    def write(
+            self,
+            rating_csr_matrix: csr_matrix,
+            user_mapping: IdMapping,
+            perfume_mapping: IdMapping,
+            metadata: Optional[Dict[str, Any]] = None,
+            stats: Optional[Dict[str, Any]] = None,
+            rating_csc_matrix: Optional[csc_matrix] = None
+    ) -> str:
+        if rating_csc_matrix is None:
+            rating_csc_matrix = rating_csr_matrix.tocsc()
+
+        # время с наносекундами (фиксированной ширины) перед uuid: снапшоты одной секунды
+        # тоже упорядочены по имени
+        now_ns = time.time_ns()
+        ts = datetime.fromtimestamp(now_ns // 10 ** 9).strftime("%Y%m%d_%H%M%S")
+        name = f'v{SNAPSHOT_FORMAT_VERSION}_{ts}_{now_ns % 10 ** 9:09d}_{uuid.uuid4().hex[:8]}'
+        tmp_dir = self.root / f'.tmp_{name}'
+        tmp_dir.mkdir()
+
+        user_mapping = user_mapping.compacted()
+        perfume_mapping = perfume_mapping.compacted()
+
+        arrays = {
+            'csr_indptr': rating_csr_matrix.indptr,
+            'csr_indices': rating_csr_matrix.indices,
+            'csr_data': rating_csr_matrix.data.astype(np.float32, copy=False),
+            'csc_indptr': rating_csc_matrix.indptr,
+            'csc_indices': rating_csc_matrix.indices,
+            'csc_data': rating_csc_matrix.data.astype(np.float32, copy=False),
+            'user_ids': user_mapping.ids,
+            'perfume_ids': perfume_mapping.ids,
+        }
+        # перестановки для поиска сохраняем, чтобы при открытии не сортировать ID заново
+        if user_mapping.sorter is not None:
+            arrays['user_sorter'] = user_mapping.sorter
+        if perfume_mapping.sorter is not None:
+            arrays['perfume_sorter'] = perfume_mapping.sorter
+
+        try:
+            files = {}
+            for array_name, array in arrays.items():
+                file_path = tmp_dir / f'{array_name}.npy'
+                np.save(file_path, np.ascontiguousarray(array))
+                files[array_name] = {
+                    'file': file_path.name,
+                    'dtype': str(array.dtype),
+                    'shape': list(array.shape),
+                    'sha256': _sha256(file_path)
+                }
+
+            manifest = {
+                'format_version': SNAPSHOT_FORMAT_VERSION,
+                'name': name,
+                'created_at': datetime.now(),
+                'shape': list(rating_csr_matrix.shape),
+                'nnz': int(rating_csr_matrix.nnz),
+                'files': files,
+                # контрольная сумма всего снапшота - по контрольным суммам файлов
+                'checksum': hashlib.sha256(
+                    ''.join(files[k]['sha256'] for k in sorted(files)).encode()
+                ).hexdigest(),
+                'metadata': metadata or {},
+                'stats': stats or {}
+            }
+            with open(tmp_dir / MANIFEST_NAME, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2, default=_json_default)
+
+            # каталог становится видимым только целиком
+            os.rename(tmp_dir, self.root / name)
+
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        self._set_latest(name)
+        self._cleanup_old_versions()
+
+        logger.info(f'Снапшот матрицы сохранён: {self.root / name}')
+        return name
+
+    def latest_name(self) -> Optional[str]:
+        latest_path = self.root / LATEST_NAME
+        if not latest_path.exists():
+            return None
+        return latest_path.read_text(encoding='utf-8').strip() or None
+
+    def open(self, name: Optional[str] = None, verify: bool = False) -> MatrixSnapshot:
+        name = name or self.latest_name()
+        if name is None:
+            raise SnapshotError(f'В {self.root} нет сохранённых снапшотов')
+
+        snapshot_path = self.root / name
+        manifest = self.read_manifest(name)
+
+        if manifest.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+            raise SnapshotError(
+                f"Неподдерживаемая версия формата снапшота: {manifest.get('format_version')}"
+            )
+
+        if verify:
+            self.verify(name, manifest)
+
+        arrays = {
+            array_name: np.load(snapshot_path / info['file'], mmap_mode='r')
+            for array_name, info in manifest['files'].items()
+        }
+
+        shape = tuple(manifest['shape'])
+        rating_csr_matrix = csr_matrix(
+            (arrays['csr_data'], arrays['csr_indices'], arrays['csr_indptr']),
+            shape=shape, copy=False
+        )
+        rating_csc_matrix = csc_matrix(
+            (arrays['csc_data'], arrays['csc_indices'], arrays['csc_indptr']),
+            shape=shape, copy=False
+        )
+
+        # порядок ID уже известен из снапшота: без повторной проверки сортировки
+        user_mapping = IdMapping(arrays['user_ids'], sorter=arrays.get('user_sorter'), check_order=False)
+        perfume_mapping = IdMapping(arrays['perfume_ids'], sorter=arrays.get('perfume_sorter'), check_order=False)
+
+        return MatrixSnapshot(
+            name=name,
+            path=snapshot_path,
+            rating_csr_matrix=rating_csr_matrix,
+            rating_csc_matrix=rating_csc_matrix,
+            user_mapping=user_mapping,
+            perfume_mapping=perfume_mapping,
+            metadata=manifest.get('metadata', {}),
+            stats=manifest.get('stats', {})
+        )
+
+    def read_manifest(self, name: str) -> Dict[str, Any]:
+        manifest_path = self.root / name / MANIFEST_NAME
+        if not manifest_path.exists():
+            raise SnapshotError(f'Снапшот {name} не найден или повреждён')
+        with open(manifest_path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def verify(self, name: str, manifest: Optional[Dict[str, Any]] = None):
+        # полная проверка контрольных сумм - O(размер снапшота), при открытии не обязательна
+        manifest = manifest or self.read_manifest(name)
+        for array_name, info in manifest['files'].items():
+            actual = _sha256(self.root / name / info['file'])
+            if actual != info['sha256']:
+                raise SnapshotError(f'Контрольная сумма {array_name} в снапшоте {name} не совпадает')
+
+    def _set_latest(self, name: str):
+        tmp_path = self.root / f'.{LATEST_NAME}.{uuid.uuid4().hex[:8]}'
+        tmp_path.write_text(name, encoding='utf-8')
+        os.replace(tmp_path, self.root / LATEST_NAME)
+
+    def _cleanup_old_versions(self):
+        latest = self.latest_name()
+        # имена начинаются с версии формата и времени, поэтому сортировка по имени = по времени
+        snapshots = sorted(
+            p for p in self.root.iterdir()
+            if p.is_dir() and p.name.startswith('v') and (p / MANIFEST_NAME).exists()
+        )
+        for old_snapshot in snapshots[:-self.max_versions]:
+            # Не удаляем снапшот, на который указывает LATEST
+            if old_snapshot.name != latest:
+                # открытые через mmap файлы остаются доступны процессам, которые их уже открыли
+                shutil.rmtree(old_snapshot, ignore_errors=True)
+                logger.debug(f"Удалён старый снапшот: {old_snapshot.name}")
@@ -0,0 +1,498 @@
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from dataclasses import dataclass, replace
+from functools import cached_property
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from scipy.sparse import csr_matrix
+
+logger = logging.getLogger(__name__)
+
+USER_INDEX_DIR = 'user_index'
+USER_INDEX_FORMAT_VERSION = 1
+DEFAULT_USER_INDEX_TABLES = 16
+DEFAULT_USER_INDEX_PROBES = 2
+# до этого числа пользователей - точный поиск (одно разреженное произведение по матрице оценок):
+# по замеру benchmark_user_index он до ~300k пользователей не медленнее поиска по корзинам
+# и даёт полноту 1.0. USER_INDEX_EXACT_MAX_USERS=0 - всегда поиск по корзинам
+EXACT_SEARCH_MAX_USERS = int(os.getenv('USER_INDEX_EXACT_MAX_USERS', '100000'))
+# пользователей (столбцов) в одном плотном блоке точного пакетного поиска
+EXACT_SEARCH_CHUNK_USERS = 16_384
+# целевой средний размер корзины при автоматическом выборе числа бит
+TARGET_BUCKET_SIZE = 256
+
+_INDEX_ARRAYS = ('projections', 'sorted_codes', 'order', 'means', 'norms', 'counts', 'fingerprints')
+
+
+def _row_stats(rating_matrix: csr_matrix) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # Схожесть - косинус векторов оценок, центрированных средним пользователя по всем парфюмам
+    # (как в прежней полной матрице схожести). Центрированный вектор не строится:
+    # (x - μx)·(y - μy) = x·y - n·μx·μy, ||x - μx||² = ||x||² - n·μx²
+    n_items = rating_matrix.shape[1]
+    counts = np.diff(rating_matrix.indptr).astype(np.int32)
+    sums = np.asarray(rating_matrix.sum(axis=1), dtype=np.float64).ravel()
+    squares = np.asarray(rating_matrix.multiply(rating_matrix).sum(axis=1), dtype=np.float64).ravel()
+
+    means = sums / n_items if n_items else np.zeros_like(sums)
+    norms = np.sqrt(np.maximum(squares - n_items * means ** 2, 0.0))
+
+    # отпечаток строки: меняется при изменении любой оценки пользователя
+    fingerprints = rating_matrix @ np.arange(1, n_items + 1, dtype=np.float64)
+    return means.astype(np.float32), norms.astype(np.float32), counts, np.asarray(fingerprints, dtype=np.float64)
+
+
+def _extended(array: np.ndarray, size: int) -> np.ndarray:
+    # копия массива, дополненная нулями до size
+    result = np.zeros(size, dtype=array.dtype)
+    n = min(len(array), size)
+    result[:n] = array[:n]
+    return result
+
+
+def _pack_codes(bits: np.ndarray) -> np.ndarray:
+    # (..., n_bits) bool -> int64 код корзины
+    weights = np.left_shift(np.int64(1), np.arange(bits.shape[-1], dtype=np.int64))
+    return (bits.astype(np.int64) * weights).sum(axis=-1)
+
+
+@dataclass(frozen=True)
+class UserNeighborIndex:
+    # LSH по случайным гиперплоскостям (SimHash): n_tables таблиц по n_bits бит.
+    # Пользователь попадает в корзину по знакам проекций центрированного вектора,
+    # соседи ищутся только среди пользователей из тех же (и соседних по одному биту) корзин
+    # и переранжируются точной схожестью. В таблице t пользователи отсортированы
+    # по коду корзины: sorted_codes[t], order[t] - корзина находится бинарным поиском
+    projections: np.ndarray
+    sorted_codes: np.ndarray
+    order: np.ndarray
+    means: np.ndarray
+    norms: np.ndarray
+    counts: np.ndarray
+    fingerprints: np.ndarray
+    n_tables: int
+    n_bits: int
+    seed: int = 0
+    snapshot: Optional[str] = None
+    # порог точного поиска; 0 - всегда поиск по корзинам (замер полноты LSH)
+    exact_search_max_users: int = EXACT_SEARCH_MAX_USERS
+
+    @property
+    def n_users(self) -> int:
+        return len(self.means)
+
+    @property
+    def n_items(self) -> int:
+        return self.projections.shape[0]
+
+    @property
+    def uses_exact_search(self) -> bool:
+        return self.n_users <= self.exact_search_max_users
+
+    @cached_property
+    def column_sums(self) -> np.ndarray:
+        return self.projections.sum(axis=0)
+
+    def hash_rows(self, rating_rows: csr_matrix, means: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        # проекции (n_rows, n_tables, n_bits) и коды корзин (n_rows, n_tables)
+        projected = np.asarray(rating_rows @ self.projections, dtype=np.float32) - np.outer(means, self.column_sums)
+        projected = projected.reshape(-1, self.n_tables, self.n_bits)
+        return projected, _pack_codes(projected > 0)
+
+    def candidates(self, projected: np.ndarray, n_probes: int = DEFAULT_USER_INDEX_PROBES) -> np.ndarray:
+        # projected - проекции одного пользователя (n_tables, n_bits). Кроме своей корзины
+        # проверяются n_probes соседних: инвертируется бит с наименьшим |проекцией|
+        codes = _pack_codes(projected > 0)
+        n_probes = min(n_probes, self.n_bits)
+        flips = np.argsort(np.abs(projected), axis=1)[:, :n_probes]
+        probes = np.concatenate([codes[:, None], codes[:, None] ^ np.left_shift(np.int64(1), flips)], axis=1)
+
+        found = []
+        for table in range(self.n_tables):
+            lo = np.searchsorted(self.sorted_codes[table], probes[table], side='left')
+            hi = np.searchsorted(self.sorted_codes[table], probes[table], side='right')
+            found.extend(self.order[table][start:end] for start, end in zip(lo, hi) if end > start)
+
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(found)).astype(np.int64)
+
+    def query(
+            self,
+            rating_matrix: csr_matrix,
+            rating_row: csr_matrix,
+            k: int,
+            n_probes: int = DEFAULT_USER_INDEX_PROBES,
+            min_similarity: float = 0.0,
+            exclude: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # top-k соседей вектора оценок rating_row (1 × n_items) среди строк rating_matrix,
+        # по убыванию схожести. Больше n_probes - выше полнота и дольше поиск
+        query_mean, query_norm, _, _ = _row_stats(rating_row)
+        if query_norm[0] == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        if self.uses_exact_search:
+            rows = np.arange(self.n_users, dtype=np.int64)
+        else:
+            projected, _ = self.hash_rows(rating_row, query_mean)
+            rows = self.candidates(projected[0], n_probes)
+
+        return self._rank(rating_matrix, rating_row, query_mean[0], query_norm[0], rows, k, min_similarity, exclude)
+
+    def query_user(
+            self,
+            rating_matrix: csr_matrix,
+            user_idx: int,
+            k: int,
+            n_probes: int = DEFAULT_USER_INDEX_PROBES,
+            min_similarity: float = 0.0
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        return self.query(rating_matrix, rating_matrix[user_idx], k, n_probes, min_similarity, exclude=user_idx)
+
+    def query_users(
+            self,
+            rating_matrix: csr_matrix,
+            user_idx: np.ndarray,
+            k: int,
+            n_probes: int = DEFAULT_USER_INDEX_PROBES,
+            min_similarity: float = 0.0,
+            block_size: int = 128
+    ) -> List[Tuple[np.ndarray, np.ndarray]]:
+        # соседи для пакета пользователей; при точном поиске - блоками строк R_block · Rᵀ
+        if not self.uses_exact_search:
+            return [self.query_user(rating_matrix, idx, k, n_probes, min_similarity) for idx in user_idx]
+
+        rating_t = rating_matrix.T.tocsc()
+        results = []
+        for start in range(0, len(user_idx), block_size):
+            block = np.asarray(user_idx[start:start + block_size], dtype=np.int64)
+            top, top_sims = self._exact_block(rating_matrix[block], rating_t, block, k)
+            for neighbors, sims in zip(top, top_sims):
+                keep = sims >= min_similarity
+                results.append((neighbors[keep].astype(np.int64), sims[keep]))
+        return results
+
+    def _exact_block(
+            self,
+            block_rows: csr_matrix,
+            rating_t,
+            block: np.ndarray,
+            k: int,
+            chunk_users: int = EXACT_SEARCH_CHUNK_USERS
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # top-k по всем пользователям для строк блока: схожесть считается по кускам
+        # из chunk_users столбцов (плотный массив block × chunk_users, а не block × n_users),
+        # лучшие k каждого куска сливаются с текущими через argpartition
+        n_rows, n_users = len(block), rating_t.shape[1]
+        top_k = min(k, n_users)
+        if top_k <= 0:
+            return np.empty((n_rows, 0), dtype=np.int64), np.empty((n_rows, 0), dtype=np.float32)
+
+        best = np.empty((n_rows, 0), dtype=np.int64)
+        best_sims = np.empty((n_rows, 0), dtype=np.float32)
+        for chunk_start in range(0, n_users, chunk_users):
+            chunk_end = min(chunk_start + chunk_users, n_users)
+            dots = np.asarray((block_rows @ rating_t[:, chunk_start:chunk_end]).toarray(), dtype=np.float32)
+            dots -= self.n_items * np.outer(self.means[block], self.means[chunk_start:chunk_end])
+            norms = np.outer(self.norms[block], self.norms[chunk_start:chunk_end])
+            similarities = np.divide(dots, norms, out=np.full_like(dots, -np.inf), where=norms > 0)
+            # сам пользователь - не сосед
+            own = (block >= chunk_start) & (block < chunk_end)
+            similarities[np.flatnonzero(own), block[own] - chunk_start] = -np.inf
+
+            candidates = np.concatenate([best, np.broadcast_to(np.arange(chunk_start, chunk_end), dots.shape)], axis=1)
+            candidate_sims = np.concatenate([best_sims, similarities], axis=1)
+            if candidate_sims.shape[1] > top_k:
+                keep = np.argpartition(-candidate_sims, top_k - 1, axis=1)[:, :top_k]
+                candidates = np.take_along_axis(candidates, keep, axis=1)
+                candidate_sims = np.take_along_axis(candidate_sims, keep, axis=1)
+            best, best_sims = candidates, candidate_sims
+
+        order = np.argsort(-best_sims, axis=1, kind='stable')
+        return np.take_along_axis(best, order, axis=1), np.take_along_axis(best_sims, order, axis=1)
+
+    def exact_query(
+            self,
+            rating_matrix: csr_matrix,
+            rating_row: csr_matrix,
+            k: int,
+            min_similarity: float = 0.0,
+            exclude: Optional[int] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # полный перебор (эталон для оценки полноты)
+        query_mean, query_norm, _, _ = _row_stats(rating_row)
+        if query_norm[0] == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        rows = np.arange(self.n_users, dtype=np.int64)
+        return self._rank(rating_matrix, rating_row, query_mean[0], query_norm[0], rows, k, min_similarity, exclude)
+
+    def _rank(self, rating_matrix, rating_row, query_mean, query_norm, rows, k, min_similarity, exclude):
+        if exclude is not None:
+            rows = rows[rows != exclude]
+        rows = rows[self.norms[rows] > 0]
+        if len(rows) == 0 or k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        query = rating_row.toarray().ravel()
+        if len(rows) * 4 > self.n_users:
+            # кандидатов много - одно произведение по всей матрице дешевле выборки строк
+            dots = np.asarray(rating_matrix @ query, dtype=np.float64)[rows]
+        else:
+            dots = np.asarray(rating_matrix[rows] @ query, dtype=np.float64)
+        similarities = (dots - self.n_items * self.means[rows] * query_mean) / (self.norms[rows] * query_norm)
+
+        keep = similarities >= min_similarity
+        rows, similarities = rows[keep], similarities[keep].astype(np.float32)
+        if len(rows) > k:
+            top = np.argpartition(-similarities, k - 1)[:k]
+            rows, similarities = rows[top], similarities[top]
+
+        order = np.argsort(-similarities, kind='stable')
+        return rows[order], similarities[order]
+
+    def add_users(self, rows: Iterable[int], rating_matrix: csr_matrix) -> 'UserNeighborIndex':
+        # Инкрементальная вставка: новый индекс, в котором строки rows (новые пользователи
+        # или изменившие оценки) перехешированы. Остальные корзины не пересчитываются,
+        # новые записи вставляются в отсортированные массивы бинарным поиском
+        rows = np.unique(np.asarray(list(rows), dtype=np.int64))
+        n_users = rating_matrix.shape[0]
+        if rating_matrix.shape[1] != self.n_items:
+            raise ValueError('Число парфюмов изменилось - индекс пользователей нужно перестроить')
+
+        means, norms, counts, fingerprints = (
+            _extended(array, n_users) for array in (self.means, self.norms, self.counts, self.fingerprints)
+        )
+        if len(rows) == 0:
+            return self
+
+        row_means, row_norms, row_counts, row_fingerprints = _row_stats(rating_matrix[rows])
+        means[rows], norms[rows], counts[rows], fingerprints[rows] = row_means, row_norms, row_counts, row_fingerprints
+
+        _, codes = self.hash_rows(rating_matrix[rows], row_means)
+        # пользователи без оценок (нулевой вектор) в корзины не попадают
+        indexed = row_norms > 0
+
+        sorted_codes, order = [], []
+        for table in range(self.n_tables):
+            keep = ~np.isin(self.order[table], rows)
+            table_codes = self.sorted_codes[table][keep]
+            table_order = self.order[table][keep]
+
+            new_codes = codes[indexed, table]
+            new_rows = rows[indexed]
+            by_code = np.argsort(new_codes, kind='stable')
+            positions = np.searchsorted(table_codes, new_codes[by_code], side='right')
+
+            sorted_codes.append(np.insert(table_codes, positions, new_codes[by_code]))
+            order.append(np.insert(table_order, positions, new_rows[by_code].astype(np.int32)))
+
+        return replace(
+            self,
+            sorted_codes=np.stack(sorted_codes),
+            order=np.stack(order),
+            means=means,
+            norms=norms,
+            counts=counts,
+            fingerprints=fingerprints
+        )
+
+    def changed_rows(self, rating_matrix: csr_matrix) -> np.ndarray:
+        # строки, изменившиеся относительно индекса (включая дописанных пользователей)
+        n_known = min(self.n_users, rating_matrix.shape[0])
+        _, _, counts, fingerprints = _row_stats(rating_matrix[:n_known])
+        changed = np.flatnonzero((counts != self.counts[:n_known]) | (fingerprints != self.fingerprints[:n_known]))
+        return np.concatenate([changed, np.arange(n_known, rating_matrix.shape[0])])
+
+    def save(self, snapshot_path: Path) -> Path:
+        target = Path(snapshot_path) / USER_INDEX_DIR
+        tmp_dir = Path(snapshot_path) / f'.tmp_{USER_INDEX_DIR}_{uuid.uuid4().hex[:8]}'
+        tmp_dir.mkdir()
+
+        try:
+            for array_name in _INDEX_ARRAYS:
+                np.save(tmp_dir / f'{array_name}.npy', getattr(self, array_name))
+
+            with open(tmp_dir / 'manifest.json', 'w', encoding='utf-8') as f:
+                json.dump({
+                    'format_version': USER_INDEX_FORMAT_VERSION,
+                    'n_tables': self.n_tables,
+                    'n_bits': self.n_bits,
+                    'seed': self.seed,
+                    'n_users': self.n_users,
+                    'n_items': self.n_items,
+                    'snapshot': self.snapshot
+                }, f, ensure_ascii=False, indent=2)
+
+            os.rename(tmp_dir, target)
+
+        except OSError:
+            # индекс для этого снапшота уже сохранил другой процесс
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            if not target.exists():
+                raise
+
+        return target
+
+    @classmethod
+    def load(cls, snapshot_path: Path) -> Optional['UserNeighborIndex']:
+        source = Path(snapshot_path) / USER_INDEX_DIR
+        manifest_path = source / 'manifest.json'
+        if not manifest_path.exists():
+            return None
+
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('format_version') != USER_INDEX_FORMAT_VERSION:
+            return None
+
+        return cls(
+            **{array_name: np.load(source / f'{array_name}.npy', mmap_mode='r') for array_name in _INDEX_ARRAYS},
+            n_tables=manifest['n_tables'],
+            n_bits=manifest['n_bits'],
+            seed=manifest.get('seed', 0),
+            snapshot=manifest.get('snapshot')
+        )
+
+
+def default_n_bits(n_users: int) -> int:
+    # в среднем TARGET_BUCKET_SIZE пользователей на корзину
+    return int(np.clip(np.round(np.log2(max(n_users, 1) / TARGET_BUCKET_SIZE)), 1, 24))
+
+
+def build_user_index(
+        rating_matrix: csr_matrix,
+        n_tables: int = DEFAULT_USER_INDEX_TABLES,
+        n_bits: Optional[int] = None,
+        seed: int = 0,
+        snapshot: Optional[str] = None
+) -> UserNeighborIndex:
+    # Хеширование - одно разреженное произведение R · P (O(nnz · n_tables · n_bits)),
+    # вместо O(n_users²) попарной схожести
+    n_users, n_items = rating_matrix.shape
+    n_bits = n_bits or default_n_bits(n_users)
+    rng = np.random.default_rng(seed)
+
+    empty = UserNeighborIndex(
+        projections=rng.standard_normal((n_items, n_tables * n_bits)).astype(np.float32),
+        sorted_codes=np.empty((n_tables, 0), dtype=np.int64),
+        order=np.empty((n_tables, 0), dtype=np.int32),
+        means=np.empty(0, dtype=np.float32),
+        norms=np.empty(0, dtype=np.float32),
+        counts=np.empty(0, dtype=np.int32),
+        fingerprints=np.empty(0, dtype=np.float64),
+        n_tables=n_tables,
+        n_bits=n_bits,
+        seed=seed,
+        snapshot=snapshot
+    )
+    index = empty.add_users(np.arange(n_users), rating_matrix)
+    logger.info(f'Индекс пользователей построен: {n_users} пользователей, {n_tables} таблиц по {n_bits} бит')
+    return index
+
+
+def _same_ids(old_ids: np.ndarray, new_ids: np.ndarray) -> bool:
+    return len(new_ids) >= len(old_ids) and np.array_equal(new_ids[:len(old_ids)], old_ids)
+
+
+def load_or_build_user_index(snapshot, previous=None, **index_params) -> UserNeighborIndex:
+    # snapshot - MatrixSnapshot (индекс хранится в его каталоге) или MatrixManager (только в памяти).
+    # previous - прошлый снапшот: если парфюмы те же, а пользователи только дописаны,
+    # его индекс обновляется вставкой изменившихся пользователей вместо полного построения
+    snapshot_path = getattr(snapshot, 'path', None)
+    snapshot_name = getattr(snapshot, 'name', None)
+
+    if snapshot_path is not None:
+        index = UserNeighborIndex.load(snapshot_path)
+        if index is not None:
+            return index
+
+    rating_matrix = snapshot.create_matrix(format_csr=True)
+    index = None
+    previous_path = getattr(previous, 'path', None)
+    if previous_path is not None and previous_path != snapshot_path:
+        previous_index = UserNeighborIndex.load(previous_path)
+        if (
+                previous_index is not None and
+                np.array_equal(previous.perfume_mapping.ids, snapshot.perfume_mapping.ids) and
+                _same_ids(previous.user_mapping.ids, snapshot.user_mapping.ids)
+        ):
+            changed = previous_index.changed_rows(rating_matrix)
+            index = previous_index.add_users(changed, rating_matrix)
+            index = replace(index, snapshot=snapshot_name)
+            logger.info(f'Индекс пользователей обновлён инкрементально: {len(changed)} пользователей')
+
+    if index is None:
+        index = build_user_index(rating_matrix, snapshot=snapshot_name, **index_params)
+    if snapshot_path is not None:
+        index.save(snapshot_path)
+    return index
+
+
+def get_user_index(source, previous=None) -> UserNeighborIndex:
+    # один индекс на снапшот: кешируется в нём же
+    return source.get_or_compute('user_index', lambda: load_or_build_user_index(source, previous))
+
+
+def benchmark_user_index(
+        rating_matrix: csr_matrix,
+        index: UserNeighborIndex,
+        k: int = 30,
+        n_queries: int = 200,
+        probes: Iterable[int] = (0, 1, 2, 4, 8),
+        seed: int = 0
+) -> List[Dict[str, Any]]:
+    # Полнота recall@k поиска по корзинам относительно точного перебора и время запроса
+    # для разных n_probes. Порог точного поиска на время замера отключается - иначе на малых
+    # матрицах query_user сам идёт полным перебором и замер не показывает LSH
+    index = replace(index, exact_search_max_users=0)
+    rng = np.random.default_rng(seed)
+    users = np.flatnonzero(index.norms > 0)
+    users = rng.choice(users, size=min(n_queries, len(users)), replace=False)
+
+    exact = []
+    started = time.perf_counter()
+    for user_idx in users:
+        rows, _ = index.exact_query(rating_matrix, rating_matrix[user_idx], k, exclude=user_idx)
+        exact.append(set(rows.tolist()))
+    exact_ms = (time.perf_counter() - started) * 1000 / max(len(users), 1)
+
+    results = []
+    for n_probes in probes:
+        found = expected = 0
+        started = time.perf_counter()
+        for user_idx, exact_rows in zip(users, exact):
+            rows, _ = index.query_user(rating_matrix, user_idx, k, n_probes)
+            found += len(exact_rows.intersection(rows.tolist()))
+            expected += len(exact_rows)
+        elapsed_ms = (time.perf_counter() - started) * 1000 / max(len(users), 1)
+
+        projected, _ = index.hash_rows(rating_matrix[users], index.means[users])
+        n_candidates = np.mean([len(index.candidates(p, n_probes)) for p in projected])
+
+        results.append({
+            'n_probes': n_probes,
+            'recall': found / expected if expected else 1.0,
+            'avg_candidates': float(n_candidates),
+            'query_ms': elapsed_ms,
+            'exact_query_ms': exact_ms
+        })
+        logger.info(
+            f'n_probes={n_probes}: recall@{k}={results[-1]["recall"]:.3f}, '
+            f'кандидатов {n_candidates:.0f} из {index.n_users}, {elapsed_ms:.2f} мс (точный поиск {exact_ms:.2f} мс)'
+        )
+    return results
+
+
+if __name__ == '__main__':
+    # python -m services.recomendation_service.user_index [каталог снапшотов]
+    import sys
+    from services.recomendation_service.snapshot_store import SnapshotStore
+
+    logging.basicConfig(level=logging.INFO)
+    snapshot = SnapshotStore(sys.argv[1] if len(sys.argv) > 1 else './data/matrices').open()
+    benchmark_user_index(snapshot.create_matrix(format_csr=True), get_user_index(snapshot))
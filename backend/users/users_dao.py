@@ -1,64 +1,146 @@
-import datetime
+from datetime import datetime
 from typing import Any, Dict, List, Optional
-from backend.perfumes.schemas import Perfume
+from perfumes.models import Brands, Perfumes as Perfume
 from ratings.models import Ratings
 from users.models import Users
-from sqlalchemy import Session
-from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy import Select, desc, func, select
 
 
-class UserDAO:
-    def __init__(self, db_session: Session):
-        self.db = db_session
-    
-    def get_by_id(self, user_id: int) -> Optional[Users]:
-        return self.db.query(Users).filter(Users.id == user_id).first()
-    
-    def get_all_active(self, limit: int = 1000) -> List[Users]:
-        return self.db.query(Users)\
-            .order_by(Users.created_at.desc())\
-            .limit(limit)\
-            .all()
-    
-    def update_last_active(self, user_id: int):
-        user = self.get_by_id(user_id)
-        if user and hasattr(user, 'last_active'):
-            user.last_active = datetime.now()
-            self.db.commit()
-    
-    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
-        stats = self.db.query(
+class _UserQueries:
+    # запросы в стиле SQLAlchemy 2.0 - общие для синхронного и асинхронного DAO
+    @staticmethod
+    def _by_id_query(user_id: int) -> Select:
+        return select(Users).where(Users.id == user_id)
+
+    @staticmethod
+    def _by_email_query(email: str) -> Select:
+        return select(Users).where(Users.email == email)
+
+    @staticmethod
+    def _by_nickname_query(nickname: str) -> Select:
+        return select(Users).where(Users.nickname == nickname)
+
+    @staticmethod
+    def _ratings_query(user_id: int) -> Select:
+        # свежие оценки первыми - по ним стратегии выбирают недавние интересы пользователя
+        return select(Ratings.perfume_id, Ratings.rate, Ratings.rate_date)\
+            .where(Ratings.user_id == user_id)\
+            .order_by(Ratings.rate_date.desc(), Ratings.id.desc())
+
+    @staticmethod
+    def _all_active_query(limit: int) -> Select:
+        return select(Users).order_by(Users.reg_date.desc()).limit(limit)
+
+    @staticmethod
+    def _stats_query(user_id: int) -> Select:
+        return select(
             func.count(Ratings.id).label('total_ratings'),
             func.avg(Ratings.rate).label('avg_rating'),
-            func.min(Ratings.created_at).label('first_rating'),
-            func.max(Ratings.created_at).label('last_rating')
-        ).filter(
+            func.min(Ratings.rate_date).label('first_rating'),
+            func.max(Ratings.rate_date).label('last_rating')
+        ).where(
             Ratings.user_id == user_id
-        ).first()
-        
-        return {
-            'total_ratings': stats.total_ratings or 0,
-            'avg_rating': float(stats.avg_rating or 0),
-            'first_rating': stats.first_rating,
-            'last_rating': stats.last_rating
-        }
-    
-    def _get_user_favorite_brands(self, user_id: int) -> List[str]:
-        from sqlalchemy import desc
-        brand_stats = self.db.query(
-            Perfume.brand,
+        )
+
+    @staticmethod
+    def _favorite_brands_query(user_id: int) -> Select:
+        return select(
+            Brands.name,
             func.avg(Ratings.rate).label('avg_rating'),
             func.count(Ratings.id).label('rating_count')
+        ).join(
+            Perfume, Perfume.brand_id == Brands.id
         ).join(
             Ratings, Perfume.id == Ratings.perfume_id
-        ).filter(
-            Ratings.user_id == user_id,
-            Perfume.brand.isnot(None)
+        ).where(
+            Ratings.user_id == user_id
         ).group_by(
-            Perfume.brand
+            Brands.name
         ).order_by(
             desc('avg_rating'),
             desc('rating_count')
-        ).limit(5).all()
-        
-        return [brand for brand, _, _ in brand_stats]
\ No newline at end of file
+        ).limit(5)
+
+    @staticmethod
+    def _ratings_to_dicts(ratings) -> List[Dict[str, Any]]:
+        return [
+            {'perfume_id': perfume_id, 'rating': rate, 'rated_at': rate_date}
+            for perfume_id, rate, rate_date in ratings
+        ]
+
+    @staticmethod
+    def _stats_to_dict(stats) -> Dict[str, Any]:
+        return {
+            'total_ratings': stats.total_ratings or 0,
+            'avg_rating': float(stats.avg_rating or 0),
+            'first_rating': stats.first_rating,
+            'last_rating': stats.last_rating
+        }
+
+
+class UserDAO(_UserQueries):
+    def __init__(self, db_session: Session):
+        self.db = db_session
+
+    def get_by_id(self, user_id: int) -> Optional[Users]:
+        return self.db.scalars(self._by_id_query(user_id)).first()
+
+    def get_by_email(self, email: str) -> Optional[Users]:
+        return self.db.scalars(self._by_email_query(email)).first()
+
+    def get_by_nickname(self, nickname: str) -> Optional[Users]:
+        return self.db.scalars(self._by_nickname_query(nickname)).first()
+
+    def get_ratings(self, user_id: int) -> List[Dict[str, Any]]:
+        return self._ratings_to_dicts(self.db.execute(self._ratings_query(user_id)).all())
+
+    def get_all_active(self, limit: int = 1000) -> List[Users]:
+        return list(self.db.scalars(self._all_active_query(limit)))
+
+    def update_last_active(self, user_id: int):
+        user = self.get_by_id(user_id)
+        if user and hasattr(user, 'last_active'):
+            user.last_active = datetime.now()
+            self.db.commit()
+
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        return self._stats_to_dict(self.db.execute(self._stats_query(user_id)).first())
+
+    def _get_user_favorite_brands(self, user_id: int) -> List[str]:
+        brand_stats = self.db.execute(self._favorite_brands_query(user_id)).all()
+        return [brand for brand, _, _ in brand_stats]
+
+
+class AsyncUserDAO(_UserQueries):
+    def __init__(self, db_session: AsyncSession):
+        self.db = db_session
+
+    async def get_by_id(self, user_id: int) -> Optional[Users]:
+        return (await self.db.scalars(self._by_id_query(user_id))).first()
+
+    async def get_by_email(self, email: str) -> Optional[Users]:
+        return (await self.db.scalars(self._by_email_query(email))).first()
+
+    async def get_by_nickname(self, nickname: str) -> Optional[Users]:
+        return (await self.db.scalars(self._by_nickname_query(nickname))).first()
+
+    async def get_ratings(self, user_id: int) -> List[Dict[str, Any]]:
+        return self._ratings_to_dicts((await self.db.execute(self._ratings_query(user_id))).all())
+
+    async def get_all_active(self, limit: int = 1000) -> List[Users]:
+        return list(await self.db.scalars(self._all_active_query(limit)))
+
+    async def update_last_active(self, user_id: int):
+        user = await self.get_by_id(user_id)
+        if user and hasattr(user, 'last_active'):
+            user.last_active = datetime.now()
+            await self.db.commit()
+
+    async def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        return self._stats_to_dict((await self.db.execute(self._stats_query(user_id))).first())
+
+    async def _get_user_favorite_brands(self, user_id: int) -> List[str]:
+        brand_stats = (await self.db.execute(self._favorite_brands_query(user_id))).all()
+        return [brand for brand, _, _ in brand_stats]
@@ -0,0 +1,58 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# db.connection создаёт движок при импорте - база тестов задаётся до импорта модулей бэкенда
+TEST_DB_PATH = os.path.join(tempfile.mkdtemp(prefix='perfumes-tests-'), 'test.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{TEST_DB_PATH}'
+BACKEND_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+sys.path.insert(0, BACKEND_PATH)
+
+import users.models  # noqa: E402,F401
+import perfumes.models  # noqa: E402,F401
+import ratings.models  # noqa: E402,F401
+from db.connection import Base, SessionLocal, db_engine  # noqa: E402
+from db.migrations import run_migrations  # noqa: E402
+from perfumes.models import Brands, Concentration, Perfumes  # noqa: E402
+
+
+@pytest.fixture
+def database_url():
+    return os.environ['DATABASE_URL']
+
+
+@pytest.fixture
+def db():
+    # чистая схема и миграции на каждый тест
+    Base.metadata.drop_all(bind=db_engine)
+    with db_engine.begin() as connection:
+        connection.exec_driver_sql('DROP TABLE IF EXISTS schema_migrations')
+    Base.metadata.create_all(bind=db_engine)
+    run_migrations(db_engine)
+
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+
+
+@pytest.fixture
+def perfume_ids(db):
+    # небольшой каталог: 25 парфюмов двух брендов
+    brands = [Brands(name='Chanel'), Brands(name='Dior')]
+    concentration = Concentration(concentration_title='Eau de Parfum')
+    db.add_all([*brands, concentration])
+    db.flush()
+
+    perfumes = [
+        Perfumes(name=f'Perfume {number}', price=100.0 + number, brand_id=brands[number % 2].id,
+                 concentration_id=concentration.id)
+        for number in range(25)
+    ]
+    db.add_all(perfumes)
+    db.commit()
+    return [perfume.id for perfume in perfumes]
@@ -0,0 +1,35 @@
+from perfumes.perfumes_dao import PerfumeDAO
+from ratings.ratings_dao import RatingDAO
+
+
+def _walk(dao, limit):
+    # страницы по ключу: следующая начинается после последнего id предыдущей
+    pages, after_id = [], None
+    while True:
+        page = dao.get_page(after_id, limit)
+        if not page:
+            return pages
+        pages.append(page)
+        after_id = page[-1][0].id
+
+
+def test_keyset_pages_cover_catalog_once_in_order(db, perfume_ids):
+    pages = _walk(PerfumeDAO(db), limit=7)
+    ids = [perfume.id for page in pages for perfume, _, _ in page]
+
+    assert [len(page) for page in pages] == [7, 7, 7, 4]
+    assert ids == sorted(perfume_ids)
+
+
+def test_page_after_last_id_is_empty(db, perfume_ids):
+    assert PerfumeDAO(db).get_page(max(perfume_ids), 10) == []
+
+
+def test_page_carries_rating_aggregates(db, perfume_ids):
+    RatingDAO(db).upsert_many([(1, perfume_ids[0], 4), (2, perfume_ids[0], 2), (1, perfume_ids[1], 5)])
+    db.commit()
+
+    page = {perfume.id: (count, mean) for perfume, count, mean in PerfumeDAO(db).get_page(None, 3)}
+    assert page[perfume_ids[0]] == (2, 3.0)
+    assert page[perfume_ids[1]] == (1, 5.0)
+    assert page[perfume_ids[2]] == (None, None)
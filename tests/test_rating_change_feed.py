@@ -0,0 +1,66 @@
+from sqlalchemy import insert
+
+from ratings.models import RatingChangeLog
+from ratings.ratings_dao import RatingDAO
+from services.recomendation_service.matrix_manager import MatrixManager
+from services.recomendation_service.rating_change_feed import ChangeCursor
+
+
+def _log(db, change_id, user_id, perfume_id, rate):
+    db.execute(insert(RatingChangeLog).values(id=change_id, user_id=user_id, perfume_id=perfume_id, rate=rate))
+    db.commit()
+
+
+def test_cursor_returns_new_changes_once(db):
+    dao = RatingDAO(db)
+    _log(db, 1, 1, 10, 3)
+    _log(db, 2, 1, 11, 4)
+    cursor = ChangeCursor()
+
+    assert cursor.read(dao) == [(1, 1, 10, 3), (2, 1, 11, 4)]
+    assert cursor.watermark == 2
+    assert cursor.read(dao) == []
+
+    _log(db, 3, 2, 10, 5)
+    assert cursor.read(dao) == [(3, 2, 10, 5)]
+
+
+def test_cursor_picks_up_late_commit_without_overriding_newer_change(db):
+    dao = RatingDAO(db)
+    _log(db, 1, 1, 10, 3)
+    _log(db, 3, 1, 10, 5)
+    cursor = ChangeCursor()
+    assert cursor.read(dao) == [(3, 1, 10, 5)]
+
+    # транзакция с id 2 зафиксировалась позже id 3: той же пары - не применяется, другой - применяется
+    _log(db, 2, 1, 10, 1)
+    _log(db, 4, 2, 10, 2)
+    assert cursor.read(dao) == [(4, 2, 10, 2)]
+
+    _log(db, 5, 3, 10, 4)
+    _log(db, 6, 3, 10, None)
+    assert cursor.read(dao) == [(6, 3, 10, None)]
+
+
+def test_increment_applies_change_log_to_matrix(db, perfume_ids, tmp_path):
+    dao = RatingDAO(db)
+    dao.upsert_many([(1, perfume_ids[0], 4), (2, perfume_ids[1], 3)])
+    db.commit()
+
+    manager = MatrixManager(db=db, storage_path=str(tmp_path / 'matrices'))
+    manager.load_matrix_from_db()
+    db.commit()
+    assert manager.metadata['last_change_id'] == dao.get_latest_change_id()
+
+    dao.upsert_many([(1, perfume_ids[0], 2), (3, perfume_ids[2], 5)])
+    db.commit()
+    manager.create_matrix(incremental_update=True)
+    assert manager.metadata['last_change_id'] == dao.get_latest_change_id()
+
+    matrix = manager._get_view(format_csr=True, fresh=True)
+    cell = lambda user_id, perfume_id: matrix[manager.user_mapping.get(user_id), manager.perfume_mapping.get(perfume_id)]
+    assert cell(1, perfume_ids[0]) == 2
+    assert cell(2, perfume_ids[1]) == 3
+    assert cell(3, perfume_ids[2]) == 5
+    # полная выгрузка больше не чистит журнал - это делает фоновая чистка по возрасту
+    assert len(dao.get_changes(0)) == 4
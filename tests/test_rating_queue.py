@@ -0,0 +1,106 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.orm import sessionmaker
+
+from conftest import BACKEND_PATH
+from db.connection import SessionLocal
+from ratings.models import Ratings
+from ratings.rating_queue import LOG_PATTERN, REJECTED_LOG, RatingQueueFullError, RatingWriteQueue
+from users.models import Users
+
+
+def _ratings(db):
+    db.expire_all()
+    return {(user_id, perfume_id): rate for user_id, perfume_id, rate in
+            db.execute(select(Ratings.user_id, Ratings.perfume_id, Ratings.rate)).all()}
+
+
+def _crash_after_submit(log_path, ratings, database_url):
+    # процесс принимает оценки в журнал и падает до записи пачки в БД
+    script = textwrap.dedent(f'''
+        import os
+        import users.models, perfumes.models, ratings.models
+        from ratings.rating_queue import RatingWriteQueue
+        queue = RatingWriteQueue({log_path!r}, flush_size=10 ** 6, flush_interval_seconds=3600)
+        queue.start()
+        queue.submit_many({ratings!r})
+        os._exit(1)
+    ''')
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=BACKEND_PATH)
+    subprocess.run([sys.executable, '-c', script], env=env, check=False, timeout=60)
+
+
+def test_replays_log_of_crashed_process(db, perfume_ids, tmp_path, database_url):
+    log_path = str(tmp_path / 'rating_log')
+    submitted = [(1, perfume_ids[0], 4), (1, perfume_ids[1], 2), (2, perfume_ids[0], 5)]
+    _crash_after_submit(log_path, submitted, database_url)
+    assert _ratings(db) == {}
+    assert len(glob.glob(os.path.join(log_path, LOG_PATTERN))) == 1
+
+    events = []
+    queue = RatingWriteQueue(log_path, flush_interval_seconds=3600)
+    queue.subscribe(events.append)
+    queue.start()
+    queue.stop()
+
+    assert _ratings(db) == {(user_id, perfume_id): rate for user_id, perfume_id, rate in submitted}
+    assert [event.summary for event in events] == [{'inserted': 3, 'updated': 0, 'unchanged': 0}]
+    assert glob.glob(os.path.join(log_path, LOG_PATTERN)) == []
+
+
+def test_failed_batch_is_kept_and_queue_is_bounded(db, perfume_ids, tmp_path):
+    def unavailable():
+        raise RuntimeError('БД недоступна')
+
+    queue = RatingWriteQueue(
+        str(tmp_path / 'rating_log'), flush_interval_seconds=3600, session_factory=unavailable, max_pending=3
+    )
+    queue.start()
+    queue.submit_many([(1, perfume_ids[0], 4), (1, perfume_ids[1], 2)])
+    with pytest.raises(RuntimeError):
+        queue.flush()
+    assert len(queue) == 2
+
+    queue.submit(2, perfume_ids[0], 5)
+    with pytest.raises(RatingQueueFullError):
+        queue.submit(3, perfume_ids[0], 1)
+
+    queue._session_factory = SessionLocal
+    assert queue.flush() == 3
+    queue.stop()
+    assert len(_ratings(db)) == 3
+
+
+def test_rejected_ratings_are_parked_and_rest_written(db, perfume_ids, tmp_path, database_url):
+    # отдельный движок с внешними ключами SQLite - как ограничения PostgreSQL
+    engine = create_engine(database_url)
+    event.listen(engine, 'connect', lambda connection, _: connection.execute('PRAGMA foreign_keys = ON'))
+    session_with_foreign_keys = sessionmaker(bind=engine)
+
+    db.add_all([Users(id=user_id, nickname=f'user{user_id}', email=f'user{user_id}@example.com',
+                      password_enc='x') for user_id in (1, 2)])
+    db.commit()
+
+    log_path = tmp_path / 'rating_log'
+    events = []
+    queue = RatingWriteQueue(str(log_path), flush_interval_seconds=3600, session_factory=session_with_foreign_keys)
+    queue.subscribe(events.append)
+    queue.start()
+    missing = max(perfume_ids) + 1
+    queue.submit_many([(1, perfume_ids[0], 4), (1, missing, 5), (2, perfume_ids[1], 3), (2, perfume_ids[0], 1)])
+
+    assert queue.flush() == 3
+    assert len(queue) == 0
+    assert _ratings(db) == {(1, perfume_ids[0]): 4, (2, perfume_ids[1]): 3, (2, perfume_ids[0]): 1}
+    assert sum(event.summary['inserted'] for event in events) == 3
+    with open(log_path / REJECTED_LOG, encoding='utf-8') as file:
+        assert [json.loads(line) for line in file] == [{'user_id': 1, 'perfume_id': missing, 'rate': 5}]
+    queue.stop()
+    engine.dispose()
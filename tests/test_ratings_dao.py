@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select, update
+
+from ratings.models import RatingChangeLog, Ratings
+from ratings.ratings_dao import RatingDAO
+
+
+def _stats(dao):
+    return {row[0]: (row[1], row[2]) for row in dao.get_rating_stats()}
+
+
+def _assert_stats_match_ratings(db):
+    # агрегаты, накопленные приращениями, совпадают с пересчётом по таблице оценок
+    dao = RatingDAO(db)
+    accumulated = _stats(dao)
+    dao.rebuild_rating_stats()
+    assert accumulated == _stats(dao)
+
+
+def test_upsert_many_counts_inserts_updates_and_unchanged(db, perfume_ids):
+    dao = RatingDAO(db)
+    first, second = perfume_ids[:2]
+
+    summary, stats = dao.upsert_many([(1, first, 4), (2, first, 2), (1, second, 5)])
+    db.commit()
+    assert summary == {'inserted': 3, 'updated': 0, 'unchanged': 0}
+    assert {row[0]: (row[1], row[2]) for row in stats} == {first: (2, 6), second: (1, 5)}
+
+    # повтор пары в пачке - побеждает последняя оценка
+    summary, _ = dao.upsert_many([(1, first, 1), (1, first, 3), (2, first, 2)])
+    db.commit()
+    assert summary == {'inserted': 0, 'updated': 1, 'unchanged': 1}
+    assert _stats(dao)[first] == (2, 5)
+    assert db.scalar(select(Ratings.rate).where(Ratings.user_id == 1, Ratings.perfume_id == first)) == 3
+    _assert_stats_match_ratings(db)
+
+
+def test_upsert_many_does_not_count_existing_row_as_insert(db, perfume_ids):
+    # строка, вставленная конкурентом до пачки, - перезапись, а не вторая оценка в агрегатах
+    dao = RatingDAO(db)
+    perfume_id = perfume_ids[0]
+    dao.upsert_many([(1, perfume_id, 3)])
+    db.commit()
+    # конкурент записал оценку и свои агрегаты
+    db.execute(insert(Ratings).values(user_id=2, perfume_id=perfume_id, rate=5))
+    dao.record_rating_stats(perfume_id, 5)
+    db.commit()
+
+    summary, _ = dao.upsert_many([(2, perfume_id, 1), (3, perfume_id, 4)])
+    db.commit()
+    assert summary == {'inserted': 1, 'updated': 1, 'unchanged': 0}
+    assert _stats(dao)[perfume_id] == (3, 3 + 1 + 4)
+    _assert_stats_match_ratings(db)
+
+
+def test_upsert_many_logs_only_changed_ratings(db, perfume_ids):
+    dao = RatingDAO(db)
+    dao.upsert_many([(1, perfume_ids[0], 4), (1, perfume_ids[1], 2)])
+    db.commit()
+    latest = dao.get_latest_change_id()
+
+    dao.upsert_many([(1, perfume_ids[0], 4), (1, perfume_ids[1], 5)])
+    db.commit()
+    assert [change[1:] for change in dao.get_changes(latest)] == [(1, perfume_ids[1], 5)]
+
+
+def test_prune_changes_removes_only_old_entries(db, perfume_ids):
+    dao = RatingDAO(db)
+    dao.upsert_many([(user_id, perfume_ids[0], 3) for user_id in range(1, 6)])
+    db.commit()
+    oldest = db.scalar(select(RatingChangeLog.id).order_by(RatingChangeLog.id))
+    db.execute(
+        update(RatingChangeLog)
+        .where(RatingChangeLog.id == oldest)
+        .values(changed_at=datetime.now() - timedelta(days=3))
+    )
+    db.commit()
+
+    assert dao.prune_changes(datetime.now() - timedelta(days=2)) == 1
+    db.commit()
+    assert len(dao.get_changes(0)) == 4
@@ -0,0 +1,17 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from services.recomendation_service.id_mapping import IdMapping
+from services.recomendation_service.snapshot_store import SnapshotStore
+
+
+def test_cleanup_keeps_latest_snapshots_written_within_one_second(tmp_path):
+    store = SnapshotStore(str(tmp_path / 'snapshots'), max_versions=3)
+    matrix = csr_matrix(np.array([[1.0, 0.0], [0.0, 5.0]]))
+    mapping = IdMapping(np.array([1, 2]))
+
+    # снапшоты пишутся подряд, большинство - в одну секунду
+    names = [store.write(matrix, mapping, mapping, metadata={'number': number}) for number in range(6)]
+
+    assert store.latest_name() == names[-1]
+    assert sorted(path.name for path in store.root.iterdir() if path.is_dir()) == names[-3:]